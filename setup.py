@@ -14,6 +14,15 @@ setup(
             'urllib3 >= 1.23',
             'requests >= 2.19.1'
         ],
+        "archive": [
+            'crc32c'
+        ],
+        "json": [
+            'orjson'
+        ],
+        "zstd": [
+            'zstandard'
+        ],
         "examples": [
             'jupyter >= 1.0.0'
         ],
@@ -23,7 +32,6 @@ setup(
         ],
         "test": [
             'checksumming_io == 0.0.1',
-            'atomicwrites == 1.3.0',
             'more_itertools == 7.0.0'
         ]
     },
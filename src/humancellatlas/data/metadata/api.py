@@ -3,21 +3,34 @@ from abc import (
     abstractmethod,
 )
 from collections import defaultdict
-from itertools import chain
+import collections.abc
+from contextlib import (
+    ExitStack,
+    contextmanager,
+)
+from functools import partial
+import gc
 from typing import (
     Any,
+    BinaryIO,
+    Callable,
     Iterable,
     List,
     Mapping,
     MutableMapping,
     Optional,
     Set,
+    Tuple,
     Type,
     TypeVar,
     Union,
 )
+import sys
+import threading
+import time
 from uuid import UUID
 import warnings
+import weakref
 
 from dataclasses import (
     dataclass,
@@ -25,6 +38,10 @@ from dataclasses import (
 )
 
 from humancellatlas.data.metadata.age_range import AgeRange
+from humancellatlas.data.metadata.instrumentation import (
+    Instrument,
+    timed,
+)
 
 # A few helpful type aliases
 #
@@ -70,6 +87,21 @@ class Entity:
     def schema_name(self):
         return schema_names[type(self)]
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        A hash of the type of this entity and of the values of its fields, excluding the raw JSON and the references
+        to other entities. Entities with the same fingerprint have the same extracted fields, even if their JSON
+        differs in ways that don't affect them. The fingerprint is computed once, on first access. See the
+        humancellatlas.data.metadata.fingerprint module for details.
+        """
+        try:
+            return self.__dict__['_fingerprint']
+        except KeyError:
+            from humancellatlas.data.metadata.fingerprint import entity_fingerprint
+            fingerprint = self.__dict__['_fingerprint'] = entity_fingerprint(self)
+            return fingerprint
+
     def accept(self, visitor: 'EntityVisitor') -> None:
         visitor.visit(self)
 
@@ -104,7 +136,7 @@ class LinkedEntity(Entity, ABC):
     def __init__(self, json: JSON) -> None:
         super().__init__(json)
         self.children = {}
-        self.parents = {}
+        self.parents = BackReferences()
 
     def connect_to(self, other: Entity, forward: bool) -> None:
         mapping = self.children if forward else self.parents
@@ -166,7 +198,7 @@ class ProjectContact:
     @classmethod
     def from_json(cls, json: JSON) -> 'ProjectContact':
         project_role = json.get('project_role')
-        project_role = ontology_label(project_role) if isinstance(project_role, dict) else project_role
+        project_role = ontology_label(project_role) if isinstance(project_role, dict) else intern(project_role)
         return cls(name=lookup(json, 'name', 'contact_name'),
                    email=json.get('email'),
                    institution=json.get('institution'),
@@ -237,7 +269,7 @@ class Biomaterial(LinkedEntity):
         self.biomaterial_id = content['biomaterial_core']['biomaterial_id']
         self.ncbi_taxon_id = content['biomaterial_core']['ncbi_taxon_id']
         self.has_input_biomaterial = content['biomaterial_core'].get('has_input_biomaterial')
-        self.from_processes = {}
+        self.from_processes = BackReferences()
         self.to_processes = {}
 
     def _connect_to(self, other: Entity, forward: bool) -> None:
@@ -265,7 +297,7 @@ class DonorOrganism(Biomaterial):
         self.diseases = {ontology_label(d) for d in lookup(content, 'diseases', 'disease', default=[]) if d}
         self.organism_age = content.get('organism_age')
         self.organism_age_unit = ontology_label(content.get('organism_age_unit'), default=None)
-        self.sex = lookup(content, 'sex', 'biological_sex')
+        self.sex = intern(lookup(content, 'sex', 'biological_sex'))
 
     @property
     def organism_age_in_seconds(self) -> Optional[AgeRange]:
@@ -299,8 +331,9 @@ class SpecimenFromOrganism(Biomaterial):
         super().__init__(json)
         content = json.get('content', json)
         preservation_storage = content.get('preservation_storage')
-        self.storage_method = preservation_storage.get('storage_method') if preservation_storage else None
-        self.preservation_method = preservation_storage.get('preservation_method') if preservation_storage else None
+        self.storage_method = intern(preservation_storage.get('storage_method')) if preservation_storage else None
+        self.preservation_method = (intern(preservation_storage.get('preservation_method'))
+                                    if preservation_storage else None)
         self.diseases = {ontology_label(d) for d in lookup(content, 'diseases', 'disease', default=[]) if d}
         self.organ = ontology_label(content.get('organ'), default=None)
 
@@ -365,7 +398,7 @@ class CellLine(Biomaterial):
     def __init__(self, json: JSON) -> None:
         super().__init__(json)
         content = json.get('content', json)
-        self.type = lookup(content, 'type', 'cell_line_type')
+        self.type = intern(lookup(content, 'type', 'cell_line_type'))
         self.model_organ = ontology_label(content.get('model_organ'), default=None)
 
     @property
@@ -403,8 +436,8 @@ class Process(LinkedEntity):
         process_core = content['process_core']
         self.process_id = process_core['process_id']
         self.process_name = process_core.get('process_name')
-        self.input_biomaterials = {}
-        self.input_files = {}
+        self.input_biomaterials = BackReferences()
+        self.input_files = BackReferences()
         self.output_biomaterials = {}
         self.output_files = {}
         self.protocols = {}
@@ -511,7 +544,7 @@ class LibraryPreparationProtocol(Protocol):
         super().__init__(json)
         content = json.get('content', json)
         temp = lookup(content, 'library_construction_method', 'library_construction_approach')
-        self.library_construction_method = ontology_label(temp) if isinstance(temp, dict) else temp
+        self.library_construction_method = ontology_label(temp) if isinstance(temp, dict) else intern(temp)
 
     @property
     def library_construction_approach(self) -> str:
@@ -584,6 +617,19 @@ class ImagingPreparationProtocol(Protocol):
 
 @dataclass
 class ManifestEntry:
+    # A bundle can have thousands of manifest entries so we avoid the per-instance dictionary
+    __slots__ = ('content_type',
+                 'crc32c',
+                 'indexed',
+                 'name',
+                 's3_etag',
+                 'sha1',
+                 'sha256',
+                 'size',
+                 'url',
+                 'uuid',
+                 'version')
+
     content_type: str
     crc32c: str
     indexed: bool
@@ -599,7 +645,7 @@ class ManifestEntry:
     @classmethod
     def from_json(cls, json: JSON):
         kwargs = dict(json)
-        kwargs['content_type'] = kwargs.pop('content-type')
+        kwargs['content_type'] = intern(kwargs.pop('content-type'))
         kwargs['uuid'] = UUID4(json['uuid'])
         kwargs.setdefault('url')
         return cls(**kwargs)
@@ -617,10 +663,10 @@ class File(LinkedEntity):
         super().__init__(json)
         content = json.get('content', json)
         core = content['file_core']
-        self.format = lookup(core, 'format', 'file_format')
+        self.format = intern(lookup(core, 'format', 'file_format'))
         self.manifest_entry = manifest[core['file_name']]
         self.content_description = {ontology_label(cd) for cd in core.get('content_description', [])}
-        self.from_processes = {}
+        self.from_processes = BackReferences()
         self.to_processes = {}
 
     def _connect_to(self, other: Entity, forward: bool) -> None:
@@ -673,37 +719,368 @@ class ImageFile(File):
 
 @dataclass
 class Link:
+    # Bundles can have tens of thousands of links so we avoid the per-instance dictionary
+    __slots__ = ('source_id', 'source_type', 'destination_id', 'destination_type')
     source_id: UUID4
     source_type: str
     destination_id: UUID4
     destination_type: str
 
     @classmethod
-    def from_json(cls, json: JSON) -> Iterable['Link']:
+    def from_json(cls, json: JSON, uuids: Optional[Mapping[str, UUID4]] = None) -> Iterable['Link']:
+        """
+        Parse one item of the `links` array in a links.json file into one or more links.
+
+        :param json: the JSON item to parse
+
+        :param uuids: an optional mapping from the string form of a UUID to the UUID, like UUIDCache. Pass the same
+                      mapping when parsing all items of a bundle in order to parse every distinct ID only once and to
+                      share the UUID objects between links.
+
+        >>> uuids = UUIDCache()
+        >>> json = {'source_id': 'b2216048-7eaa-45f4-8077-5a3fb4204953', 'source_type': 'biomaterial',
+        ...         'destination_id': '4e41a067-dbb7-439f-b72f-80240ce858f6', 'destination_type': 'process'}
+        >>> link1, = Link.from_json(json, uuids)
+        >>> link2, = Link.from_json(json, uuids)
+        >>> link1 == link2, link1.source_id is link2.source_id, len(uuids)
+        (True, True, 2)
+        """
+        uuid = UUID4 if uuids is None else uuids.__getitem__
         if 'source_id' in json:
             # v5
-            yield cls(source_id=UUID4(json['source_id']),
-                      source_type=json['source_type'],
-                      destination_id=UUID4(json['destination_id']),
-                      destination_type=json['destination_type'])
+            yield cls(source_id=uuid(json['source_id']),
+                      source_type=intern(json['source_type']),
+                      destination_id=uuid(json['destination_id']),
+                      destination_type=intern(json['destination_type']))
         else:
             # vx
-            process_id = UUID4(json['process'])
+            process_id = uuid(json['process'])
+            input_type = intern(json['input_type'])
             for source_id in json['inputs']:
-                yield cls(source_id=UUID4(source_id),
-                          source_type=json['input_type'],
+                yield cls(source_id=uuid(source_id),
+                          source_type=input_type,
                           destination_id=process_id,
                           destination_type='process')
+            output_type = intern(json['output_type'])
             for destination_id in json['outputs']:
                 yield cls(source_id=process_id,
                           source_type='process',
-                          destination_id=UUID4(destination_id),
-                          destination_type=json['output_type'])
+                          destination_id=uuid(destination_id),
+                          destination_type=output_type)
             for protocol in json['protocols']:
                 yield cls(source_id=process_id,
                           source_type='process',
-                          destination_id=UUID4(protocol['protocol_id']),
-                          destination_type=lookup(protocol, 'type', 'protocol_type'))
+                          destination_id=uuid(protocol['protocol_id']),
+                          destination_type=intern(lookup(protocol, 'type', 'protocol_type')))
+
+
+class UUIDCache(dict):
+    """
+    A dictionary of UUID objects by their string form that parses each string when it is first looked up.
+
+    >>> uuids = UUIDCache()
+    >>> uuid = uuids['b2216048-7eaa-45f4-8077-5a3fb4204953']
+    >>> uuid
+    UUID('b2216048-7eaa-45f4-8077-5a3fb4204953')
+    >>> uuids['b2216048-7eaa-45f4-8077-5a3fb4204953'] is uuid
+    True
+    """
+
+    def __missing__(self, key: str) -> UUID4:
+        value = self[key] = UUID4(key)
+        return value
+
+
+class _LazyManifest(dict):
+    """
+    A dictionary of manifest entries by file name, that creates each entry from the corresponding item in the given
+    manifest JSON when it is first looked up.
+    """
+
+    def __init__(self, manifest: List[JSON]) -> None:
+        super().__init__()
+        self._manifest = {entry['name']: entry for entry in manifest}
+
+    def __missing__(self, name: str) -> ManifestEntry:
+        entry = self[name] = ManifestEntry.from_json(self._manifest[name])
+        return entry
+
+
+# The names of the fields of linked entities that are populated by connecting the entities according to the links in
+# a bundle, as opposed to being extracted from the entity's JSON
+#
+link_fields = frozenset({
+    'children',
+    'parents',
+    'from_processes',
+    'to_processes',
+    'input_biomaterials',
+    'input_files',
+    'output_biomaterials',
+    'output_files',
+    'protocols',
+})
+
+# The names of the link fields that refer from the destination of a link back to its source. These fields hold weak
+# references, see BackReferences.
+#
+back_reference_fields = frozenset({
+    'parents',
+    'from_processes',
+    'input_biomaterials',
+    'input_files',
+})
+
+
+def new_link_field(field_name: str) -> MutableMapping[UUID4, Entity]:
+    """
+    Return an empty mapping for the link field of the given name.
+    """
+    return BackReferences() if field_name in back_reference_fields else {}
+
+
+def init_link_fields(entity: Entity) -> None:
+    """
+    Set every link field of the given entity to a new, empty mapping, as for an entity that is not connected to any
+    other entity. This is for entities created without calling their constructor.
+    """
+    entity_cls = type(entity)
+    try:
+        field_names = _entity_link_fields[entity_cls]
+    except KeyError:
+        field_names = _entity_link_fields[entity_cls] = [
+            field_name for field_name in entity_cls.__dataclass_fields__ if field_name in link_fields
+        ]
+    entity_attrs = entity.__dict__
+    for field_name in field_names:
+        entity_attrs[field_name] = new_link_field(field_name)
+
+
+_entity_link_fields: MutableMapping[Type[Entity], List[str]] = {}
+
+
+class BackReferences(collections.abc.MutableMapping):
+    """
+    A mapping from document ID to entity that only holds weak references to the entities.
+
+    The entities in a bundle are owned by the bundle. An entity holds strong references to the destinations of the
+    links it is the source of, and weak references to the sources of the links it is the destination of. Since links
+    form a directed acyclic graph, so do the strong references, and the entities of a bundle are freed by reference
+    counting as soon as the bundle is no longer referenced, without having to wait for the cyclic garbage collector.
+    An entity that outlives its bundle may lose its back references, as if the entity had no parents.
+
+    >>> from uuid import UUID
+    >>> class Thing:
+    ...     pass
+    >>> thing, other = Thing(), Thing()
+    >>> refs = BackReferences()
+    >>> refs[UUID(int=1)], refs[UUID(int=2)] = thing, other
+    >>> refs[UUID(int=1)] is thing, len(refs)
+    (True, 2)
+    >>> del other
+    >>> list(refs), UUID(int=2) in refs, len(refs), bool(refs)
+    ([UUID('00000000-0000-0000-0000-000000000001')], False, 1, True)
+    >>> refs == {UUID(int=1): thing}
+    True
+    """
+    # The number of live references is maintained by the callback of each weak reference, which is invoked when the
+    # referenced entity is freed, so that len() and truth tests don't have to dereference every weak reference. The
+    # callback is a separate object in order not to create a reference cycle through the mapping.
+    __slots__ = ('_refs', '_live')
+
+    def __init__(self) -> None:
+        self._refs: MutableMapping[UUID4, weakref.ref] = {}
+        self._live = _LiveCount()
+
+    def __getitem__(self, document_id: UUID4) -> Entity:
+        entity = self._refs[document_id]()
+        if entity is None:
+            raise KeyError(document_id)
+        return entity
+
+    def __setitem__(self, document_id: UUID4, entity: Entity) -> None:
+        old_ref = self._refs.get(document_id)
+        if old_ref is not None and old_ref() is not None:
+            self._live.count -= 1
+        self._refs[document_id] = weakref.ref(entity, self._live)
+        self._live.count += 1
+
+    def __delitem__(self, document_id: UUID4) -> None:
+        ref = self._refs.pop(document_id)
+        if ref() is not None:
+            self._live.count -= 1
+
+    def __iter__(self):
+        return (document_id for document_id, ref in list(self._refs.items()) if ref() is not None)
+
+    def __len__(self) -> int:
+        return self._live.count
+
+    def __bool__(self) -> bool:
+        return self._live.count > 0
+
+    def clear(self) -> None:
+        # Discarding the weak references also discards their pending callbacks
+        self._refs.clear()
+        self._live.count = 0
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({dict(self)!r})'
+
+
+class _LiveCount:
+    """
+    The weak reference callback of a BackReferences instance
+    """
+    __slots__ = ('count',)
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __call__(self, ref: weakref.ref) -> None:
+        self.count -= 1
+
+
+_gc_lock = threading.Lock()
+_gc_suspensions = 0
+_gc_was_enabled = False
+
+
+@contextmanager
+def gc_suspended():
+    """
+    A context manager that disables the cyclic garbage collector for its duration. Bulk construction of many small
+    container objects otherwise triggers repeated collections that scan every tracked object in the process, including
+    all bundles constructed earlier. The context can be nested and entered by multiple threads at once. The collector
+    is enabled again when the last context exits, unless it was already disabled when the first context was entered.
+
+    To exclude a large number of long-lived bundles from subsequent collections altogether, call `gc.freeze()` after
+    constructing them.
+
+    >>> with gc_suspended():
+    ...     with gc_suspended():
+    ...         gc.isenabled()
+    ...     gc.isenabled()
+    False
+    False
+    >>> gc.isenabled()
+    True
+    """
+    global _gc_suspensions, _gc_was_enabled
+    with _gc_lock:
+        if _gc_suspensions == 0:
+            _gc_was_enabled = gc.isenabled()
+            gc.disable()
+        _gc_suspensions += 1
+    try:
+        yield
+    finally:
+        with _gc_lock:
+            _gc_suspensions -= 1
+            if _gc_suspensions == 0 and _gc_was_enabled:
+                gc.enable()
+
+
+# The names of the metadata files in a bundle using the v5 layout, other than links.json
+#
+v5_file_names = frozenset({
+    'project.json',
+    'biomaterial.json',
+    'process.json',
+    'protocol.json',
+    'file.json',
+})
+
+
+class EntityPool:
+    """
+    A cache of entities that can be shared by Bundle instances in order to avoid holding multiple copies of the same
+    version of a metadata document in memory. Bundles from the same project typically contain the same project,
+    donor, specimen and protocol documents.
+
+    When a bundle is constructed with a pool, each entity is looked up in the pool by its document ID and the date of
+    the document's last update. If the pool already contains that version of the document, the bundle's entity is a
+    new object that shares the raw JSON and the extracted field values with the pooled entity. Only the references to
+    other entities in the bundle are specific to each bundle. File entities are not pooled because they refer to the
+    manifest entry of the containing bundle, nor are entities of which the update date is not known.
+
+    The extracted field values of pooled entities are shared by all bundles using the pool and must not be modified.
+
+    A pool can be used by multiple threads concurrently. It grows without bounds unless it is cleared explicitly.
+    """
+
+    def __init__(self) -> None:
+        self._entities: MutableMapping[Tuple[str, str], Tuple[Type[Entity], Mapping[str, Any]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entities)
+
+    def clear(self) -> None:
+        """
+        Remove all entities from this pool and reset its statistics.
+        """
+        self._entities.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def entity(self, json: JSON) -> Entity:
+        """
+        Return an entity for the given JSON document, reusing the field values of a previously pooled entity for the
+        same version of that document.
+        """
+        key = self._key(json)
+        if key is None:
+            return Entity.from_json(json)
+        try:
+            entity_cls, attrs = self._entities[key]
+        except KeyError:
+            self.misses += 1
+            entity = Entity.from_json(json)
+            attrs = {k: v for k, v in vars(entity).items() if k not in link_fields}
+            self._entities[key] = type(entity), attrs
+            return entity
+        else:
+            self.hits += 1
+            return _copy_entity(entity_cls, attrs)
+
+    @staticmethod
+    def _key(json: JSON) -> Optional[Tuple[str, str]]:
+        provenance = json.get('hca_ingest') or json['provenance']
+        update_date = lookup(provenance, 'update_date', 'updateDate', default=None)
+        return None if update_date is None else (provenance['document_id'], update_date)
+
+
+def _copy_entity(entity_cls: Type[E], attrs: Mapping[str, Any]) -> E:
+    """
+    Return a new, unconnected entity of the given type with the given field values.
+    """
+    entity = entity_cls.__new__(entity_cls)
+    entity.__dict__.update(attrs)
+    init_link_fields(entity)
+    return entity
+
+
+def _reused_entity(previous_entities: Mapping[UUID4, Entity],
+                   new_entity: Callable[[JSON], E],
+                   manifest: Mapping[str, ManifestEntry],
+                   json: JSON) -> E:
+    """
+    Return a copy of the entity with the same document ID in a previous version of a bundle if that entity was
+    created from the same JSON, or a new entity otherwise.
+    """
+    provenance = json.get('hca_ingest') or json['provenance']
+    entity = previous_entities.get(UUID4(provenance['document_id']))
+    if entity is None or entity.json is None or entity.json is not json and entity.json != json:
+        return new_entity(json)
+    else:
+        attrs = {**vars(entity), 'json': json}
+        if isinstance(entity, File):
+            attrs['manifest_entry'] = manifest[entity.manifest_entry.name]
+            # The fingerprint covers the manifest entry
+            attrs.pop('_fingerprint', None)
+        return _copy_entity(type(entity), attrs)
 
 
 @dataclass(init=False)
@@ -720,69 +1097,204 @@ class Bundle:
     entities: MutableMapping[UUID4, Entity] = field(repr=False)
     links: List[Link]
 
-    def __init__(self, uuid: str, version: str, manifest: List[JSON], metadata_files: Mapping[str, JSON]):
+    def __init__(self,
+                 uuid: str,
+                 version: str,
+                 manifest: List[JSON],
+                 metadata_files: Mapping[str, JSON],
+                 pool: Optional[EntityPool] = None,
+                 manifest_referenced_only: bool = False,
+                 instrument: Optional[Instrument] = None,
+                 allow_missing_entities: bool = False,
+                 suspend_gc: bool = False,
+                 previous: Optional['Bundle'] = None):
+        """
+        :param uuid: the UUID of the bundle
+
+        :param version: the version of the bundle
+
+        :param manifest: the bundle's manifest, a list of manifest entries for all files (data and metadata) in the
+                         bundle
+
+        :param metadata_files: a dictionary mapping the file name of each metadata file in the bundle to the JSON
+                               contents of that file
+
+        :param pool: an optional pool of entities to share with other bundles. See EntityPool for details.
+
+        :param manifest_referenced_only: if True, only create manifest entries for the files referenced by File
+                                         entities. The `manifest` attribute of the bundle will not contain any entries
+                                         for metadata files or for data files not described by a File entity.
+
+        :param instrument: an optional instrument to report the time spent constructing the bundle to
+
+        :param allow_missing_entities: if True, accept metadata files for only a subset of the bundle's entities, as
+                                       downloaded by download_bundle_metadata() with a `file_filter`. Links to or from
+                                       an omitted entity are dropped. Entities connected only through omitted
+                                       entities will be missing those connections, so properties like
+                                       `sequencing_output` may be incomplete unless processes and protocols were
+                                       included.
+
+        :param suspend_gc: if True, disable the cyclic garbage collector while the bundle is constructed, see
+                           gc_suspended()
+
+        :param previous: an optional previous version of this bundle. Entities with the same document ID and the same
+                         JSON as an entity in the previous version are created by copying the field values of that
+                         entity instead of extracting them from the JSON again. The JSON is compared by identity
+                         first, so reusing the metadata files of the previous version for unchanged files, as
+                         download_bundle_metadata() does when passed the previous version, makes this particularly
+                         cheap. Likewise, if links.json is the very same object, the previous bundle's links are
+                         reused instead of being parsed again. The previous bundle is not modified.
+        """
         self.uuid = UUID4(uuid)
         self.version = version
-        self.manifest = {m.name: m for m in map(ManifestEntry.from_json, manifest)}
-
-        def from_json(core_cls: Type[E], json_entities: List[JSON], **kwargs) -> MutableMapping[UUID4, E]:
-            entities = (core_cls.from_json(entity, **kwargs) for entity in json_entities)
-            return {entity.document_id: entity for entity in entities}
-
-        if 'project.json' in metadata_files:
+        with gc_suspended() if suspend_gc else ExitStack():
+            if manifest_referenced_only:
+                self.manifest = _LazyManifest(manifest)
+            else:
+                with timed(instrument, 'manifest', len(manifest)):
+                    self.manifest = {m.name: m for m in map(ManifestEntry.from_json, manifest)}
 
-            def from_json_v5(core_cls: Type[E], file_name, key=None, **kwargs) -> MutableMapping[UUID4, E]:
-                file_content = metadata_files.get(file_name)
-                if file_content:
-                    json_entities = file_content[key] if key else [file_content]
-                    return from_json(core_cls, json_entities, **kwargs)
+            def from_json(core_cls: Type[E], json_entities: List[JSON], **kwargs) -> MutableMapping[UUID4, E]:
+                if pool is None or core_cls is File:
+                    new_entity = partial(core_cls.from_json, **kwargs)
+                else:
+                    new_entity = pool.entity
+                if previous is not None:
+                    new_entity = partial(_reused_entity, previous.entities, new_entity, self.manifest)
+                if instrument is None:
+                    entities = map(new_entity, json_entities)
                 else:
-                    return {}
-
-            self.projects = from_json_v5(Project, 'project.json')
-            self.biomaterials = from_json_v5(Biomaterial, 'biomaterial.json', 'biomaterials')
-            self.processes = from_json_v5(Process, 'process.json', 'processes')
-            self.protocols = from_json_v5(Protocol, 'protocol.json', 'protocols')
-            self.files = from_json_v5(File, 'file.json', 'files', manifest=self.manifest)
-
-        elif 'project_0.json' in metadata_files:
-
-            json_by_core_cls: MutableMapping[Type[E], List[JSON]] = defaultdict(list)
-            for file_name, json in metadata_files.items():
-                assert file_name.endswith('.json')
-                schema_name, _, suffix = file_name[:-5].rpartition('_')
-                if schema_name and suffix.isdigit():
-                    entity_cls = entity_types[schema_name]
-                    core_cls = core_types[entity_cls]
-                    json_by_core_cls[core_cls].append(json)
-
-            def from_json_vx(core_cls: Type[E], **kwargs) -> MutableMapping[UUID4, E]:
-                json_entities = json_by_core_cls[core_cls]
-                return from_json(core_cls, json_entities, **kwargs)
-
-            self.projects = from_json_vx(Project)
-            self.biomaterials = from_json_vx(Biomaterial)
-            self.processes = from_json_vx(Process)
-            self.protocols = from_json_vx(Protocol)
-            self.files = from_json_vx(File, manifest=self.manifest)
+                    entities = (timed_entity(new_entity, json_entity) for json_entity in json_entities)
+                return {entity.document_id: entity for entity in entities}
+
+            def timed_entity(new_entity: Callable[[JSON], E], json_entity: JSON) -> E:
+                start = time.perf_counter()
+                entity = new_entity(json_entity)
+                instrument.record('construct.' + type(entity).__name__, time.perf_counter() - start)
+                return entity
+
+            if ('project.json' in metadata_files
+                    or allow_missing_entities and not v5_file_names.isdisjoint(metadata_files)):
+
+                def from_json_v5(core_cls: Type[E], file_name, key=None, **kwargs) -> MutableMapping[UUID4, E]:
+                    file_content = metadata_files.get(file_name)
+                    if file_content:
+                        json_entities = file_content[key] if key else [file_content]
+                        return from_json(core_cls, json_entities, **kwargs)
+                    else:
+                        return {}
+
+                self.projects = from_json_v5(Project, 'project.json')
+                self.biomaterials = from_json_v5(Biomaterial, 'biomaterial.json', 'biomaterials')
+                self.processes = from_json_v5(Process, 'process.json', 'processes')
+                self.protocols = from_json_v5(Protocol, 'protocol.json', 'protocols')
+                self.files = from_json_v5(File, 'file.json', 'files', manifest=self.manifest)
+
+            elif 'project_0.json' in metadata_files or allow_missing_entities:
+
+                json_by_core_cls: MutableMapping[Type[E], List[JSON]] = defaultdict(list)
+                for file_name, json in metadata_files.items():
+                    assert file_name.endswith('.json')
+                    schema_name, _, suffix = file_name[:-5].rpartition('_')
+                    if schema_name and suffix.isdigit():
+                        entity_cls = entity_types[schema_name]
+                        core_cls = core_types[entity_cls]
+                        json_by_core_cls[core_cls].append(json)
+
+                def from_json_vx(core_cls: Type[E], **kwargs) -> MutableMapping[UUID4, E]:
+                    json_entities = json_by_core_cls[core_cls]
+                    return from_json(core_cls, json_entities, **kwargs)
 
-        else:
+                self.projects = from_json_vx(Project)
+                self.biomaterials = from_json_vx(Biomaterial)
+                self.processes = from_json_vx(Process)
+                self.protocols = from_json_vx(Protocol)
+                self.files = from_json_vx(File, manifest=self.manifest)
+
+            else:
 
-            raise RuntimeError('Unable to detect bundle structure')
+                raise RuntimeError('Unable to detect bundle structure')
 
-        self.entities = {**self.projects, **self.biomaterials, **self.processes, **self.protocols, **self.files}
+            self.entities = {**self.projects, **self.biomaterials, **self.processes, **self.protocols, **self.files}
 
-        links = metadata_files['links.json']['links']
-        self.links = list(chain.from_iterable(map(Link.from_json, links)))
+            if manifest_referenced_only:
+                self.manifest = dict(self.manifest)
 
+            links_json = metadata_files['links.json']
+            links = links_json['links']
+            with timed(instrument, 'links', len(links)):
+                # Remembered so a later version can reuse the links, unless they depend on the omitted entities
+                self._links_json = None if allow_missing_entities else links_json
+                if previous is not None and links_json is getattr(previous, '_links_json', None):
+                    self.links = list(previous.links)
+                else:
+                    # Seeding the cache with the entity IDs lets links share the UUID objects of the entities
+                    uuids = UUIDCache((str(document_id), document_id) for document_id in self.entities.keys())
+                    self.links = [link for json in links for link in Link.from_json(json, uuids)]
+                if allow_missing_entities:
+                    entities = self.entities
+                    self.links = [link for link in self.links
+                                  if link.source_id in entities and link.destination_id in entities]
+            with timed(instrument, 'connect', len(self.links)):
+                self._connect_entities()
+
+    def _connect_entities(self) -> None:
+        entities = self.entities
         for link in self.links:
-            source_entity = self.entities[link.source_id]
-            destination_entity = self.entities[link.destination_id]
+            source_entity = entities[link.source_id]
+            destination_entity = entities[link.destination_id]
             assert isinstance(source_entity, LinkedEntity)
             assert isinstance(destination_entity, LinkedEntity)
             source_entity.connect_to(destination_entity, forward=True)
             destination_entity.connect_to(source_entity, forward=False)
 
+    def close(self) -> None:
+        """
+        Release the entities of this bundle by removing all references between them and all references to them from
+        this bundle. Entities still referenced elsewhere remain valid but are no longer connected to each other. The
+        bundle must not be used after it has been closed.
+
+        Closing a bundle is not required for its memory to be released, since the references between its entities do
+        not form cycles, but it does release the entities promptly if the bundle object itself is part of a reference
+        cycle, and it disconnects entities that the application holds on to. A bundle can be used as a context manager
+        that closes it on exit.
+        """
+        for entity in self.entities.values():
+            if isinstance(entity, LinkedEntity):
+                for field_name in link_fields:
+                    mapping = getattr(entity, field_name, None)
+                    if mapping is not None:
+                        mapping.clear()
+        for entities in (self.projects, self.biomaterials, self.processes, self.protocols, self.files, self.entities):
+            entities.clear()
+        self.links.clear()
+        self._links_json = None
+        self.__dict__.pop('_link_fingerprint', None)
+
+    def __enter__(self) -> 'Bundle':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def dump(self, fp: BinaryIO) -> None:
+        """
+        Write a compact binary snapshot of this bundle to the given binary file object. See the
+        humancellatlas.data.metadata.snapshot module for details.
+        """
+        from humancellatlas.data.metadata.snapshot import dump
+        dump(self, fp)
+
+    @classmethod
+    def load(cls, fp: BinaryIO) -> 'Bundle':
+        """
+        Read a bundle from a snapshot previously written by Bundle.dump(), starting at the current position of the
+        given binary file object. If the file object is backed by a file descriptor, the snapshot is read through a
+        memory map.
+        """
+        from humancellatlas.data.metadata.snapshot import load
+        return load(fp)
+
     def root_entities(self) -> Mapping[UUID4, LinkedEntity]:
         roots = {}
 
@@ -798,6 +1310,20 @@ class Bundle:
 
         return roots
 
+    @property
+    def link_fingerprint(self) -> str:
+        """
+        A hash of the links between the entities of this bundle, irrespective of their order. Together with the
+        `fingerprint` of each entity, it tells whether anything that was extracted from a bundle changed between two
+        versions of that bundle. The fingerprint is computed once, on first access.
+        """
+        try:
+            return self.__dict__['_link_fingerprint']
+        except KeyError:
+            from humancellatlas.data.metadata.fingerprint import link_fingerprint
+            fingerprint = self.__dict__['_link_fingerprint'] = link_fingerprint(self.links)
+            return fingerprint
+
     @property
     def specimens(self) -> List[SpecimenFromOrganism]:
         return [s for s in self.biomaterials.values() if isinstance(s, SpecimenFromOrganism)]
@@ -900,8 +1426,36 @@ def ontology_label(ontology: Optional[Mapping[str, str]],
     Traceback (most recent call last):
     ...
     TypeError: 'NoneType' object is not subscriptable
+
+    The returned label is interned.
+
+    >>> a, b = ''.join(['nor', 'mal']), ''.join(['nor', 'mal'])
+    >>> ontology_label({'text': a}) is ontology_label({'text': b})
+    True
     """
     if ontology is None and default is not LookupDefault.RAISE:
         return default
     else:
-        return lookup(ontology, 'ontology_label', 'text', 'ontology', default=default)
+        return intern(lookup(ontology, 'ontology_label', 'text', 'ontology', default=default))
+
+
+def intern(value: Optional[str]) -> Optional[str]:
+    """
+    Return the canonical instance of the given string value. Ontology labels and other values drawn from a small
+    vocabulary occur in many entities. Interning them saves memory and speeds up comparisons between them, as equal
+    interned strings are identical.
+
+    >>> a, b = ''.join(['organ', 'oid']), ''.join(['organ', 'oid'])
+    >>> a is b
+    False
+    >>> intern(a) is intern(b)
+    True
+
+    Values other than strings are returned as is.
+
+    >>> intern(None) is None
+    True
+    >>> intern(1)
+    1
+    """
+    return sys.intern(value) if type(value) is str else value
@@ -0,0 +1,111 @@
+"""
+Stable fingerprints of the content of entities and of the link structure of bundles.
+
+A fingerprint is a hash of a canonical serialization of the fields extracted from the metadata, so it only changes
+if the extracted fields change. It does not depend on the raw JSON of an entity, on the order of set elements, on the
+Python process or on the version of Python. Consumers maintaining a downstream index can store the fingerprint along
+with each document they write and skip writing the document if the fingerprint is unchanged.
+
+>>> from humancellatlas.data.metadata.api import Bundle
+>>> from humancellatlas.data.metadata.helpers.synthetic import synthetic_bundle
+>>> bundle = Bundle(*synthetic_bundle(seed=1))
+>>> same_bundle = Bundle(*synthetic_bundle(seed=1))
+>>> project = next(iter(bundle.projects.values()))
+>>> project.fingerprint
+'23db498cfa6d2c26bac1600cbe42cefe'
+>>> all(e.fingerprint == same_bundle.entities[k].fingerprint for k, e in bundle.entities.items())
+True
+>>> bundle.link_fingerprint == same_bundle.link_fingerprint
+True
+"""
+import hashlib
+import json
+from typing import (
+    Any,
+    FrozenSet,
+    Iterable,
+    Mapping,
+    Type,
+)
+from uuid import UUID
+
+from dataclasses import (
+    fields,
+    is_dataclass,
+)
+
+from humancellatlas.data.metadata.api import (
+    Entity,
+    Link,
+    ManifestEntry,
+    link_fields,
+)
+
+# Incremented whenever the canonical serialization changes, so that fingerprints of different versions never match
+#
+FINGERPRINT_VERSION = 1
+
+# The fields of an entity that are not part of its content: the raw JSON, of which only the extracted fields matter,
+# and the references to other entities, which are covered by the fingerprint of the bundle's links.
+#
+_excluded_entity_fields = link_fields | {'json'}
+
+# Fields of other values that are not part of their content. The direct or pre-signed URL of a manifest entry differs
+# between requests for the same bundle.
+#
+_excluded_fields: Mapping[Type, FrozenSet[str]] = {
+    ManifestEntry: frozenset({'url'})
+}
+
+
+def entity_fingerprint(entity: Entity) -> str:
+    """
+    Return the fingerprint of the type and the extracted fields of the given entity, excluding the references to
+    other entities.
+    """
+    return _digest([FINGERPRINT_VERSION,
+                    entity.schema_name,
+                    {f.name: _canonical(getattr(entity, f.name))
+                     for f in fields(entity)
+                     if f.name not in _excluded_entity_fields}])
+
+
+def link_fingerprint(links: Iterable[Link]) -> str:
+    """
+    Return the fingerprint of the given links, irrespective of their order.
+    """
+    return _digest([FINGERPRINT_VERSION,
+                    sorted({(str(link.source_id), link.source_type, str(link.destination_id), link.destination_type)
+                            for link in links})])
+
+
+def _digest(value: Any) -> str:
+    return hashlib.blake2b(_dumps(value).encode(), digest_size=16).hexdigest()
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False, allow_nan=True)
+
+
+def _canonical(value: Any) -> Any:
+    """
+    Convert the given field value to a JSON-serializable value, sorting the elements of sets.
+
+    >>> _canonical({3, 1, 2}), _canonical({'b': (1, None), 'a': UUID(int=1)})
+    ([1, 2, 3], {'b': [1, None], 'a': '00000000-0000-0000-0000-000000000001'})
+    """
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    elif isinstance(value, UUID):
+        return str(value)
+    elif isinstance(value, (set, frozenset)):
+        return sorted(map(_canonical, value), key=_dumps)
+    elif isinstance(value, (list, tuple)):
+        return list(map(_canonical, value))
+    elif isinstance(value, dict):
+        return {str(k): _canonical(v) for k, v in value.items()}
+    elif is_dataclass(value):
+        excluded = _excluded_fields.get(type(value), frozenset())
+        return {f.name: _canonical(getattr(value, f.name)) for f in fields(value) if f.name not in excluded}
+    else:
+        raise TypeError('Unexpected type of field value', type(value))
@@ -0,0 +1,228 @@
+"""
+Load the metadata files of a bundle from a tarball, like the example bundles in the metadata schema repository.
+
+The tarball is read in streaming mode, one member at a time, so it can be read directly from a non-seekable file
+object like an HTTP response without first buffering the whole archive. The contents of each metadata file are read
+into a buffer that is reused for all members, and checksummed as they are read. The manifest is built up member by
+member along the way.
+
+>>> import io, tarfile
+>>> buf = io.BytesIO()
+>>> with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+...     for name, data in [('repo-1234/bundles/a/links.json', b'{"links": []}'), ('repo-1234/README', b'')]:
+...         info = tarfile.TarInfo(name)
+...         info.size = len(data)
+...         tf.addfile(info, io.BytesIO(data))
+>>> _ = buf.seek(0)
+>>> manifest, metadata_files = read_bundle_archive(buf, path='bundles/a/', strip_components=1)
+>>> metadata_files
+{'links.json': {'links': []}}
+>>> entry = manifest[0]
+>>> entry['name'], entry['size'], entry['indexed'], entry['content-type']
+('links.json', 13, True, 'application/json; dcp-type="metadata/json"')
+>>> entry['crc32c'], entry['s3_etag']
+('f56e25b2', '4c1a5fb945bbe7905ba41dc015e48b9b')
+"""
+import hashlib
+import logging
+import tarfile
+from typing import (
+    BinaryIO,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import uuid
+
+from humancellatlas.data.metadata.api import JSON
+from humancellatlas.data.metadata.helpers.decoder import decode_json
+
+logger = logging.getLogger(__name__)
+
+try:
+    from crc32c import crc32c as _crc32c
+except ImportError:  # pragma: no cover
+    _crc32c = None
+
+# The part size S3 uses for multi-part uploads of metadata files, and with it, for their ETag
+#
+s3_part_size = 64 * 1024 * 1024
+
+
+def read_bundle_archive(fileobj: BinaryIO,
+                        path: str = '',
+                        strip_components: int = 0,
+                        version: str = '1') -> Tuple[List[JSON], JSON]:
+    """
+    Read the metadata files of a bundle from the given tarball, returning the bundle's manifest and metadata files
+    in the form accepted by Bundle(). See iter_bundle_archive() for details.
+    """
+    manifest, metadata_files = [], {}
+    for file_name, manifest_entries, contents in iter_bundle_archive(fileobj, path, strip_components, version):
+        manifest.extend(manifest_entries)
+        metadata_files[file_name] = contents
+    return manifest, metadata_files
+
+
+def iter_bundle_archive(fileobj: BinaryIO,
+                        path: str = '',
+                        strip_components: int = 0,
+                        version: str = '1') -> Iterator[Tuple[str, List[JSON], JSON]]:
+    """
+    Read the metadata files of a bundle from the given tarball, yielding the name, the manifest entries and the JSON
+    contents of each metadata file as soon as it has been read.
+
+    Since the archive does not contain the data files, a manifest entry is fabricated for the data file described by
+    each metadata file of a `file` schema. The data file's entry uses the name given in the metadata and reuses the
+    checksums of the metadata file. Every entry gets a random UUID.
+
+    :param fileobj: the binary file object to read the tarball from. The tarball may be compressed. The file object
+                    need not be seekable.
+
+    :param path: the path of the directory containing the bundle's metadata files, relative to the root of the
+                 tarball and after stripping leading path components. It must be empty or end in a slash. Files in
+                 subdirectories of that directory are included, with the remainder of their path as the file name.
+
+    :param strip_components: the number of leading components to remove from the path of each tarball member, like
+                             the option of the same name to tar. GitHub tarballs, for example, contain a single root
+                             directory named after the repository and commit.
+
+    :param version: the version to use for all manifest entries
+    """
+    if path.startswith('/') or path and not path.endswith('/'):
+        raise ValueError(path)
+    checksums = _Checksums()
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        for member in tf:
+            if strip_components:
+                parts = member.name.split('/', strip_components)
+                if len(parts) <= strip_components:
+                    continue  # like tar, skip members with no components left after stripping
+                member_path = parts[-1]
+            else:
+                member_path = member.name
+            if member.isfile() and member_path.startswith(path) and member_path.endswith('.json'):
+                file_name = member_path[len(path):]
+                with tf.extractfile(member) as f:
+                    contents = checksums.read(f, member.size)
+                json_contents = decode_json(contents)
+                file_checksums = checksums.hexdigests()
+                md_file_type = file_name.partition('.')[2]
+                manifest_entries = [{**file_checksums,
+                                     'content-type': f'application/json; dcp-type="metadata/{md_file_type}"',
+                                     'indexed': True,
+                                     'name': file_name,
+                                     'size': member.size,
+                                     'uuid': str(uuid.uuid4()),
+                                     'version': version}]
+                schema_name, _, _ = file_name[:-5].rpartition('_')
+                if schema_name.endswith('_file') or schema_name == 'file':
+                    # Fake the manifest entry for the data file as best as we can
+                    manifest_entries.append({**file_checksums,
+                                             'content-type': 'application/octet-stream',
+                                             'indexed': False,
+                                             'name': json_contents['file_core']['file_name'],
+                                             'size': member.size,
+                                             'uuid': str(uuid.uuid4()),
+                                             'version': version})
+                yield file_name, manifest_entries, json_contents
+
+
+class _Checksums:
+    """
+    Reads files into a reusable buffer while computing the checksums the DSS records for every file.
+    """
+
+    def __init__(self, chunk_size: int = 1024 * 1024) -> None:
+        self.chunk_size = chunk_size
+        self.buffer = bytearray(chunk_size)
+
+    def read(self, f: BinaryIO, size: int) -> memoryview:
+        """
+        Read the given number of bytes from the given file object and compute their checksums. Return a view of the
+        bytes that is only valid until the next invocation.
+        """
+        if len(self.buffer) < size:
+            self.buffer = bytearray(size)
+        view = memoryview(self.buffer)
+        self._reset()
+        offset = 0
+        while offset < size:
+            n = f.readinto(view[offset:min(offset + self.chunk_size, size)])
+            if not n:
+                raise EOFError(f'Expected {size} bytes, got {offset}')
+            self._update(view[offset:offset + n])
+            offset += n
+        return view[:size]
+
+    def _reset(self) -> None:
+        self.crc32c = 0
+        self.sha1 = hashlib.sha1()
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        self.etag_parts: List[bytes] = []
+        self.etag_part_size = 0
+
+    def _update(self, chunk: memoryview) -> None:
+        self.crc32c = crc32c(chunk, self.crc32c)
+        self.sha1.update(chunk)
+        self.sha256.update(chunk)
+        while chunk:
+            n = min(len(chunk), s3_part_size - self.etag_part_size)
+            self.md5.update(chunk[:n])
+            self.etag_part_size += n
+            chunk = chunk[n:]
+            if self.etag_part_size == s3_part_size:
+                self.etag_parts.append(self.md5.digest())
+                self.md5 = hashlib.md5()
+                self.etag_part_size = 0
+
+    def hexdigests(self) -> JSON:
+        etag_parts = self.etag_parts + [self.md5.digest()] if self.etag_part_size else self.etag_parts
+        if len(etag_parts) > 1:
+            s3_etag = hashlib.md5(b''.join(etag_parts)).hexdigest() + f'-{len(etag_parts)}'
+        else:
+            s3_etag = self.md5.hexdigest() if self.etag_part_size or not etag_parts else etag_parts[0].hex()
+        return {
+            'crc32c': f'{self.crc32c:08x}',
+            's3_etag': s3_etag,
+            'sha1': self.sha1.hexdigest(),
+            'sha256': self.sha256.hexdigest()
+        }
+
+
+def crc32c(data: bytes, value: int = 0) -> int:
+    """
+    Return the CRC-32C checksum of the given data, continuing from the given checksum of preceding data. Uses the
+    `crc32c` package if it is installed, and a slower, pure-Python implementation otherwise.
+
+    >>> hex(crc32c(b'123456789'))
+    '0xe3069283'
+    >>> hex(crc32c(b'6789', crc32c(b'12345')))
+    '0xe3069283'
+    """
+    if _crc32c is None:
+        crc = value ^ 0xFFFFFFFF
+        table = _crc32c_table()
+        for b in bytes(data):
+            crc = table[(crc ^ b) & 0xFF] ^ (crc >> 8)
+        return crc ^ 0xFFFFFFFF
+    else:
+        return _crc32c(data, value)
+
+
+_table: Optional[List[int]] = None
+
+
+def _crc32c_table() -> List[int]:
+    global _table
+    if _table is None:
+        table = []
+        for i in range(256):
+            crc = i
+            for _ in range(8):
+                crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+            table.append(crc)
+        _table = table
+    return _table
@@ -0,0 +1,165 @@
+"""
+Compression of metadata files and manifests for local storage.
+
+Metadata JSON is very repetitive, within a file and even more so across files of the same schema. A Codec compresses
+data into a small self-describing frame that records the compression algorithm and the dictionary used, so frames can
+be told apart from uncompressed JSON and decompressed without further configuration, as long as the dictionary, if
+any, is provided. The algorithm is Zstandard if the `zstandard` package is installed (`pip install
+hca-metadata-api[zstd]`), otherwise zlib from the standard library.
+
+A dictionary primes the compressor with strings common to many documents, like property names and schema URLs, which
+greatly improves the compression of small documents. Use train_dictionary() to build one from sample documents.
+
+>>> codec = Codec('zlib')
+>>> data = b'{"describedBy": "https://schema.humancellatlas.org/type/biomaterial/10.0.0/donor_organism"}'
+>>> frame = codec.compress(data)
+>>> is_compressed(frame), is_compressed(data), codec.decompress(frame) == data
+(True, False, True)
+>>> dictionary = train_dictionary([data] * 10)
+>>> len(Codec('zlib', dictionary=dictionary).compress(data)) < len(frame)
+True
+>>> try:
+...     Codec('zlib').decompress(Codec('zlib', dictionary=dictionary).compress(data))
+... except ValueError as e:
+...     print(e.args[0])
+Frame was compressed with a different dictionary
+"""
+from collections import defaultdict
+import re
+import struct
+from typing import (
+    Iterable,
+    Optional,
+    Union,
+)
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# magic, codec ID, reserved, dictionary ID (zero if none)
+#
+_frame_header = struct.Struct('<3sBHI')
+
+_MAGIC = b'HCZ'
+
+_codec_ids = {
+    'zlib': 1,
+    'zstd': 2
+}
+
+_codec_names = {v: k for k, v in _codec_ids.items()}
+
+default_codec_name = 'zstd' if zstandard is not None else 'zlib'
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def is_compressed(data: Buffer) -> bool:
+    """
+    Return True if the given data is a frame written by Codec.compress() as opposed to, say, plain JSON.
+    """
+    return bytes(data[:len(_MAGIC)]) == _MAGIC
+
+
+def dictionary_id(dictionary: Optional[bytes]) -> int:
+    return 0 if not dictionary else zlib.crc32(dictionary) or 1
+
+
+class Codec:
+    """
+    Compresses data into frames and decompresses frames. Instances are thread-safe.
+    """
+
+    def __init__(self,
+                 name: Optional[str] = None,
+                 level: Optional[int] = None,
+                 dictionary: Optional[bytes] = None) -> None:
+        """
+        :param name: `zstd` or `zlib`. The default is `zstd` if available, `zlib` otherwise.
+
+        :param level: the compression level, by default a level that favours speed
+
+        :param dictionary: an optional dictionary, see train_dictionary(). Frames compressed with a dictionary can only
+                           be decompressed by a codec with the same dictionary.
+        """
+        self.name = default_codec_name if name is None else name
+        if self.name not in _codec_ids:
+            raise ValueError('Unknown codec', self.name)
+        if self.name == 'zstd' and zstandard is None:
+            raise ValueError('The zstandard package is not installed')
+        self.level = level
+        self.dictionary = dictionary or None
+        self.dictionary_id = dictionary_id(dictionary)
+        if zstandard is not None and self.dictionary is not None:
+            self._zstd_dict = zstandard.ZstdCompressionDict(self.dictionary)
+        else:
+            self._zstd_dict = None
+
+    def __repr__(self) -> str:
+        return f'Codec({self.name!r}, level={self.level!r}, dictionary_id={self.dictionary_id})'
+
+    def compress(self, data: Buffer) -> bytes:
+        header = _frame_header.pack(_MAGIC, _codec_ids[self.name], 0, self.dictionary_id)
+        if self.name == 'zlib':
+            level = 1 if self.level is None else self.level
+            if self.dictionary is None:
+                compressor = zlib.compressobj(level)
+            else:
+                compressor = zlib.compressobj(level, zdict=self.dictionary)
+            return header + compressor.compress(data) + compressor.flush()
+        else:
+            level = 3 if self.level is None else self.level
+            # Compressor objects are not thread-safe but cheap to create
+            compressor = zstandard.ZstdCompressor(level=level, dict_data=self._zstd_dict)
+            return header + compressor.compress(data)
+
+    def decompress(self, frame: Buffer) -> bytes:
+        magic, codec_id, _, frame_dictionary_id = _frame_header.unpack_from(frame)
+        if magic != _MAGIC:
+            raise ValueError('Not a compressed frame')
+        if frame_dictionary_id != self.dictionary_id:
+            raise ValueError('Frame was compressed with a different dictionary', frame_dictionary_id)
+        name = _codec_names.get(codec_id)
+        data = memoryview(frame)[_frame_header.size:]
+        if name == 'zlib':
+            if self.dictionary is None:
+                decompressor = zlib.decompressobj()
+            else:
+                decompressor = zlib.decompressobj(zdict=self.dictionary)
+            return decompressor.decompress(data) + decompressor.flush()
+        elif name == 'zstd' and zstandard is not None:
+            return zstandard.ZstdDecompressor(dict_data=self._zstd_dict).decompress(data)
+        else:
+            raise ValueError('Unsupported codec', name or codec_id)
+
+
+_described_by_re = re.compile(rb'"describedBy"\s*:\s*"([^"]*)"')
+
+
+def train_dictionary(samples: Iterable[Buffer], size: int = 32 * 1024, sample_size: int = 4 * 1024) -> bytes:
+    """
+    Build a dictionary for Codec from the given sample documents, typically a few hundred metadata files of
+    different schemas. Documents of the same schema share most of their property names and many of their values, so
+    the dictionary is made of one typical document per schema, the one of median size, or its beginning. Documents of
+    the most common schemas go last, where the compressor finds matches most cheaply. The dictionary works with both
+    zlib and Zstandard, but zlib only uses the last 32 KiB.
+
+    :param samples: the sample documents
+
+    :param size: the maximum size of the dictionary in bytes
+
+    :param sample_size: the maximum number of bytes taken from each schema's typical document
+    """
+    by_schema = defaultdict(list)
+    for sample in samples:
+        sample = bytes(sample)
+        match = _described_by_re.search(sample)
+        by_schema[match and match.group(1)].append(sample)
+    parts = []
+    for schema_samples in sorted(by_schema.values(), key=len):
+        schema_samples.sort(key=len)
+        parts.append(schema_samples[len(schema_samples) // 2][:sample_size])
+    return b''.join(parts)[-size:]
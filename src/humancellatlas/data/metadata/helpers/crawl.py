@@ -0,0 +1,499 @@
+"""
+Coordination of a crawl of many bundles by several worker processes, possibly on several machines, through a shared
+directory and without any other service.
+
+plan_crawl() assigns every bundle to one of the nodes of the crawl by consistent hashing on the bundle UUID and
+splits each node's share into batches. A worker processing batches for a node claims one batch at a time by taking
+out a lease on it. It works through the batches of its own node first and then steals the unclaimed batches of other
+nodes, starting with the last one, which is the batch the straggling node would get to last. A lease expires unless
+it is renewed, so the batches of a worker that died are eventually taken over by another worker. crawl() drives the
+download, construction and indexing of the bundles in each claimed batch and writes the outputs of the batch, an
+inverted index and a facet summary, into the shared directory. merge_outputs() combines the outputs of all batches.
+
+Leases are fenced by a generation number. Taking out a lease creates the file for the next generation of the batch's
+lease, which fails if another worker got there first. Completing a batch creates its completion marker, naming the
+generation whose outputs are valid. Of two workers processing the same batch, only the first one to complete it wins,
+and the outputs of the other one are ignored. The shared directory must therefore support exclusive creation of
+files and atomic renames, which local file systems and NFS version 3 or later do. Leases are timed by the wall clock
+of each machine, so the clocks should be synchronized to well within the duration of a lease.
+
+>>> import tempfile
+>>> from humancellatlas.data.metadata.helpers.inverted_index import InvertedIndex
+>>> from humancellatlas.data.metadata.helpers.synthetic import LocalDSSClient, SyntheticCorpus
+>>> corpus = SyntheticCorpus(5, seed=2)
+>>> client = LocalDSSClient(corpus)
+>>> fqids = [(uuid, version) for uuid, version, _, _ in corpus]
+>>> with tempfile.TemporaryDirectory() as d:
+...     plan_crawl(d, fqids, nodes=['a', 'b'], batch_size=2)
+...     crawl(CrawlCoordinator(d, 'a'), client, 'aws')
+...     summary, errors = merge_outputs(d, os.path.join(d, 'index'))
+...     with InvertedIndex(os.path.join(d, 'index')) as index:
+...         len(index.fqids), len(summary) > 0, errors
+3
+CrawlStats(batches=3, bundles=5, errors=0, stolen=1, lost=0)
+(5, True, [])
+"""
+from bisect import bisect
+from hashlib import blake2b
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from dataclasses import (
+    asdict,
+    dataclass,
+)
+from hca.dss import DSSClient
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+from humancellatlas.data.metadata.helpers.inverted_index import (
+    InvertedIndexBuilder,
+    merge,
+)
+from humancellatlas.data.metadata.helpers.summary import FacetSummary
+
+logger = logging.getLogger(__name__)
+
+# A bundle UUID and version, or None for the latest version
+#
+FQID = Tuple[str, Optional[str]]
+
+_plan_file_name = 'plan.json'
+
+_format_version = 1
+
+
+class HashRing:
+    """
+    Maps bundle UUIDs to nodes by consistent hashing. Every node owns a number of points on a ring of 64-bit hashes,
+    and a bundle belongs to the node owning the first point at or after the hash of the bundle's UUID. Adding or
+    removing a node only moves the bundles of the ring segments it gains or loses, about 1/n of all bundles.
+
+    >>> ring = HashRing(['node-1', 'node-2', 'node-3'])
+    >>> ring.node('0d5a4d4b-4b8e-4c2d-8b4e-5c6a1f0e9d3c')
+    'node-1'
+    >>> uuids = [f'{i:08x}-0000-4000-8000-000000000000' for i in range(1000)]
+    >>> sum(ring.node(uuid) != HashRing(['node-1', 'node-2']).node(uuid) for uuid in uuids) < 400
+    True
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 64) -> None:
+        """
+        :param nodes: the names of the nodes
+
+        :param replicas: the number of points each node owns on the ring. More points spread the bundles more evenly.
+        """
+        points = sorted((_hash(f'{node}#{i}'), node) for node in set(nodes) for i in range(replicas))
+        if not points:
+            raise ValueError('A hash ring needs at least one node')
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, uuid: str) -> str:
+        """
+        Return the node the bundle with the given UUID belongs to.
+        """
+        i = bisect(self._hashes, _hash(uuid.lower()))
+        return self._nodes[i % len(self._nodes)]
+
+
+def _hash(s: str) -> int:
+    return int.from_bytes(blake2b(s.encode(), digest_size=8).digest(), 'big')
+
+
+def plan_crawl(path: str,
+               fqids: Iterable[FQID],
+               nodes: Sequence[str],
+               batch_size: int = 100,
+               replicas: int = 64) -> int:
+    """
+    Prepare the given directory for a crawl of the given bundles by the given nodes and return the number of batches.
+    The plan only depends on the arguments, so it is the same regardless of which machine makes it. The directory
+    must not contain a plan already.
+
+    :param path: the path of the shared directory to coordinate the crawl through
+
+    :param fqids: the UUID and version of each bundle to crawl. Duplicates are ignored.
+
+    :param nodes: the names of the nodes taking part in the crawl
+
+    :param batch_size: the maximum number of bundles in a batch, the unit of work that is leased to a worker
+
+    :param replicas: see HashRing
+    """
+    plan_path = os.path.join(path, _plan_file_name)
+    if os.path.exists(plan_path):
+        raise ValueError('The directory already contains a crawl plan', path)
+    ring = HashRing(nodes, replicas=replicas)
+    shards: MutableMapping[str, List[FQID]] = {node: [] for node in sorted(set(nodes))}
+    for uuid, version in sorted(set(fqids), key=lambda fqid: (fqid[0], fqid[1] or '')):
+        shards[ring.node(uuid)].append((uuid, version))
+    batches = {}
+    os.makedirs(os.path.join(path, 'batches'), exist_ok=True)
+    for node, shard in shards.items():
+        for i in range(0, len(shard), batch_size):
+            batch_id = f'{len(batches):06d}'
+            batches[batch_id] = node
+            _write_json(os.path.join(path, 'batches', batch_id + '.json'), shard[i:i + batch_size])
+    for directory in ('leases', 'done', 'outputs'):
+        os.makedirs(os.path.join(path, directory), exist_ok=True)
+    plan = {'format': _format_version, 'nodes': list(shards.keys()), 'batches': batches}
+    # Write the plan last, it marks the directory as ready for workers
+    _write_json(plan_path, plan)
+    return len(batches)
+
+
+@dataclass(frozen=True)
+class Lease:
+    """
+    A worker's claim on a batch of bundles
+    """
+    batch_id: str
+
+    #: The node the worker processes batches for
+    node: str
+
+    #: The fencing token of the lease. Every time a batch is claimed, the generation goes up by one.
+    generation: int
+
+    #: The wall clock time at which the lease expires unless renewed, in seconds since the epoch
+    expires: float
+
+    #: The node the batch was assigned to by the plan. If it differs from `node`, the batch was stolen.
+    owner: str
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when a worker's lease on a batch was taken over by another worker or the batch was completed by another
+    worker.
+    """
+
+
+class CrawlCoordinator:
+    """
+    Claims, renews and completes leases on the batches of a crawl planned by plan_crawl(), on behalf of a worker for
+    a given node. Any number of workers may process the batches of the same node concurrently, each with its own
+    coordinator.
+    """
+
+    def __init__(self,
+                 path: str,
+                 node: str,
+                 lease_seconds: float = 300.0,
+                 clock: Callable[[], float] = time.time) -> None:
+        """
+        :param path: the path of the shared directory the crawl was planned in
+
+        :param node: the name of the node the worker processes batches for. The node does not need to be one of the
+                     nodes in the plan, in which case the worker only steals batches from other nodes.
+
+        :param lease_seconds: the time after which a lease expires unless renewed
+
+        :param clock: the source of wall clock time
+        """
+        self.path = path
+        self.node = node
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        with open(os.path.join(path, _plan_file_name)) as f:
+            plan = json.load(f)
+        if plan['format'] != _format_version:
+            raise ValueError('Unsupported crawl plan format', plan['format'])
+        self.nodes: List[str] = plan['nodes']
+        self.batches: Mapping[str, str] = plan['batches']
+        self._done = set()
+
+    def claim(self) -> Optional[Lease]:
+        """
+        Take out a lease on the next batch for this worker, or return None if there is no batch left to claim. Batches
+        of this worker's node come first, in order, followed by those of other nodes, in reverse order. A batch can
+        be claimed if it is not complete and not leased, or if its lease expired.
+        """
+        own = [batch_id for batch_id, node in self.batches.items() if node == self.node]
+        others = [batch_id for batch_id, node in self.batches.items() if node != self.node]
+        for batch_id in own + others[::-1]:
+            if self.is_done(batch_id):
+                continue
+            lease = self.lease(batch_id)
+            if lease is None or lease.expires <= self.clock():
+                generation = 1 if lease is None else lease.generation + 1
+                new_lease = Lease(batch_id=batch_id,
+                                  node=self.node,
+                                  generation=generation,
+                                  expires=self.clock() + self.lease_seconds,
+                                  owner=self.batches[batch_id])
+                try:
+                    self._write_lease(new_lease, exclusive=True)
+                except FileExistsError:
+                    logger.debug('Lost the race for generation %i of batch %s', generation, batch_id)
+                    continue
+                if lease is not None:
+                    logger.info('Took over batch %s from node %s whose lease expired', batch_id, lease.node)
+                return new_lease
+        return None
+
+    def lease(self, batch_id: str) -> Optional[Lease]:
+        """
+        Return the current lease on the given batch, or None if the batch was never claimed.
+        """
+        lease_dir = os.path.join(self.path, 'leases', batch_id)
+        try:
+            generations = [int(file_name) for file_name in os.listdir(lease_dir) if file_name.isdigit()]
+        except FileNotFoundError:
+            return None
+        if not generations:
+            return None
+        generation = max(generations)
+        with open(os.path.join(lease_dir, str(generation))) as f:
+            content = f.read()
+            if not content:
+                # The worker that created the file has yet to write it, or died before doing so
+                expires = os.fstat(f.fileno()).st_mtime + self.lease_seconds
+                return Lease(batch_id, '', generation, expires, self.batches[batch_id])
+        return Lease(**json.loads(content))
+
+    def renew(self, lease: Lease) -> Lease:
+        """
+        Extend the given lease by the lease duration and return the extended lease.
+
+        :raises LeaseLostError: if another worker claimed or completed the batch in the meantime
+        """
+        self._check(lease)
+        lease = Lease(batch_id=lease.batch_id,
+                      node=lease.node,
+                      generation=lease.generation,
+                      expires=self.clock() + self.lease_seconds,
+                      owner=lease.owner)
+        self._write_lease(lease, exclusive=False)
+        return lease
+
+    def items(self, lease: Lease) -> List[FQID]:
+        """
+        Return the bundles in the leased batch.
+        """
+        with open(os.path.join(self.path, 'batches', lease.batch_id + '.json')) as f:
+            return [(uuid, version) for uuid, version in json.load(f)]
+
+    def output_path(self, lease: Lease, name: str) -> str:
+        """
+        Return the path of the file in which to write the output of the given name for the leased batch. Outputs of
+        different generations of the same batch don't clash.
+        """
+        return os.path.join(self.path, 'outputs', f'{lease.batch_id}.{lease.generation}.{name}')
+
+    def complete(self, lease: Lease) -> None:
+        """
+        Mark the leased batch as complete, making the outputs written for the lease's generation the valid outputs of
+        the batch.
+
+        :raises LeaseLostError: if another worker claimed or completed the batch in the meantime
+        """
+        self._check(lease)
+        try:
+            with open(self._done_path(lease.batch_id), 'x') as f:
+                json.dump({'node': lease.node, 'generation': lease.generation}, f)
+        except FileExistsError:
+            raise LeaseLostError('Batch was completed by another worker', lease.batch_id)
+        self._done.add(lease.batch_id)
+
+    def is_done(self, batch_id: str) -> bool:
+        if batch_id in self._done:
+            return True
+        elif os.path.exists(self._done_path(batch_id)):
+            self._done.add(batch_id)
+            return True
+        else:
+            return False
+
+    def done_generation(self, batch_id: str) -> Optional[int]:
+        """
+        Return the generation whose outputs are valid for the given batch, or None if the batch is not complete.
+        """
+        try:
+            with open(self._done_path(batch_id)) as f:
+                return json.load(f)['generation']
+        except FileNotFoundError:
+            return None
+
+    def status(self) -> Mapping[str, int]:
+        """
+        Return the number of batches that are complete, currently leased, and pending, i.e., never claimed or with
+        an expired lease.
+        """
+        status = dict(done=0, leased=0, pending=0)
+        now = self.clock()
+        for batch_id in self.batches:
+            if self.is_done(batch_id):
+                status['done'] += 1
+            else:
+                lease = self.lease(batch_id)
+                status['pending' if lease is None or lease.expires <= now else 'leased'] += 1
+        return status
+
+    def _check(self, lease: Lease) -> None:
+        if self.is_done(lease.batch_id):
+            raise LeaseLostError('Batch was completed by another worker', lease.batch_id)
+        current = self.lease(lease.batch_id)
+        if current is None or current.generation != lease.generation:
+            raise LeaseLostError('Batch was claimed by another worker', lease.batch_id)
+
+    def _write_lease(self, lease: Lease, exclusive: bool) -> None:
+        lease_dir = os.path.join(self.path, 'leases', lease.batch_id)
+        os.makedirs(lease_dir, exist_ok=True)
+        path = os.path.join(lease_dir, str(lease.generation))
+        if exclusive:
+            # Claim the generation before writing the lease so that only one worker succeeds
+            with open(path, 'x') as f:
+                f.write(json.dumps(asdict(lease)))
+        else:
+            _write_json(path, asdict(lease))
+
+    def _done_path(self, batch_id: str) -> str:
+        return os.path.join(self.path, 'done', batch_id)
+
+
+def _write_json(path: str, value: Any) -> None:
+    """
+    Atomically write the given value as JSON to the file at the given path, replacing any existing file.
+    """
+    f = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False)
+    try:
+        with f:
+            json.dump(value, f)
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+
+
+@dataclass
+class CrawlStats:
+    """
+    Statistics of the batches processed by a call to crawl()
+    """
+    #: The number of batches completed
+    batches: int = 0
+
+    #: The number of bundles processed in the completed batches
+    bundles: int = 0
+
+    #: The number of bundles that failed to download or construct in the completed batches
+    errors: int = 0
+
+    #: The number of completed batches that the plan assigned to other nodes
+    stolen: int = 0
+
+    #: The number of batches abandoned because another worker took them over or completed them
+    lost: int = 0
+
+
+def crawl(coordinator: CrawlCoordinator,
+          client: DSSClient,
+          replica: str,
+          sink: Optional[Callable[[Bundle], Any]] = None,
+          max_batches: Optional[int] = None,
+          **download_kwargs) -> CrawlStats:
+    """
+    Process batches claimed through the given coordinator until there are none left. The bundles in each batch are
+    downloaded and constructed, and added to an inverted index and a facet summary for the batch. When a batch is
+    done, its outputs are written to the shared directory and the batch is marked complete. The lease on a batch is
+    renewed whenever a third of the lease duration has passed since the last renewal.
+
+    A bundle that fails to download or construct is logged and its FQID recorded in the `errors` output of the batch.
+    It does not fail the batch.
+
+    :param coordinator: the coordinator to claim batches through
+
+    :param client: the DSS client to download the bundles with
+
+    :param replica: the DSS replica to download the bundles from
+
+    :param sink: an optional callable that receives every bundle constructed
+
+    :param max_batches: the maximum number of batches to claim, by default there is no limit
+
+    :param download_kwargs: additional keyword arguments to download_bundle_metadata()
+    """
+    stats = CrawlStats()
+    claimed = 0
+    while max_batches is None or claimed < max_batches:
+        lease = coordinator.claim()
+        if lease is None:
+            break
+        claimed += 1
+        renew_at = coordinator.clock() + coordinator.lease_seconds / 3
+        index = InvertedIndexBuilder()
+        summary = FacetSummary()
+        errors = []
+        try:
+            for uuid, version in coordinator.items(lease):
+                try:
+                    version, manifest, metadata_files = download_bundle_metadata(client, replica, uuid, version,
+                                                                                 **download_kwargs)
+                    bundle = Bundle(uuid, version, manifest, metadata_files)
+                except Exception:
+                    logger.warning('Failed to process bundle %s.%s', uuid, version, exc_info=True)
+                    errors.append([uuid, version])
+                else:
+                    index.add(bundle)
+                    summary.add(bundle)
+                    if sink is not None:
+                        sink(bundle)
+                if coordinator.clock() >= renew_at:
+                    lease = coordinator.renew(lease)
+                    renew_at = coordinator.clock() + coordinator.lease_seconds / 3
+            index.write(coordinator.output_path(lease, 'index'))
+            with open(coordinator.output_path(lease, 'summary'), 'wb') as f:
+                f.write(summary.to_bytes())
+            _write_json(coordinator.output_path(lease, 'errors'), errors)
+            coordinator.complete(lease)
+        except LeaseLostError:
+            logger.warning('Abandoned batch %s', lease.batch_id, exc_info=True)
+            stats.lost += 1
+        else:
+            stats.batches += 1
+            stats.bundles += len(index.fqids) + len(errors)
+            stats.errors += len(errors)
+            if lease.owner != lease.node:
+                stats.stolen += 1
+    return stats
+
+
+def merge_outputs(path: str, index_path: str) -> Tuple[FacetSummary, List[FQID]]:
+    """
+    Merge the outputs of all batches of the crawl in the given directory. Write the merged inverted index to the
+    given path and return the merged facet summary and the FQIDs of the bundles that failed.
+
+    :raises ValueError: if any batch of the crawl is not complete
+    """
+    coordinator = CrawlCoordinator(path, node='')
+    outputs = []
+    for batch_id in coordinator.batches:
+        generation = coordinator.done_generation(batch_id)
+        if generation is None:
+            raise ValueError('Batch is not complete', batch_id)
+        outputs.append(Lease(batch_id, '', generation, 0.0, coordinator.batches[batch_id]))
+    merge([coordinator.output_path(lease, 'index') for lease in outputs], index_path)
+    summary = FacetSummary()
+    errors = []
+    for lease in outputs:
+        with open(coordinator.output_path(lease, 'summary'), 'rb') as f:
+            summary.merge(FacetSummary.from_bytes(f.read()))
+        with open(coordinator.output_path(lease, 'errors')) as f:
+            errors.extend((uuid, version) for uuid, version in json.load(f))
+    return summary, errors
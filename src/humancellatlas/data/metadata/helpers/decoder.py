@@ -0,0 +1,144 @@
+"""
+Decoding of JSON metadata from raw bytes, with a pluggable decoder.
+
+JSON decoding is one of the most expensive steps in loading a bundle. The functions in this module accept the raw
+bytes of a document as they come from the transport, a file or a memory map, so that no intermediate `str` needs to
+be created, and pass them to the current default decoder. If the `orjson` package is installed (`pip install
+hca-metadata-api[json]`) the default decoder uses it, otherwise it uses the standard library.
+
+>>> decode_json(b'{"a": [1, 2.5, null]}')
+{'a': [1, 2.5, None]}
+>>> decode_json(memoryview(b'{"a": "\\xc3\\xa9"}'), decoder=stdlib_decoder)
+{'a': 'é'}
+>>> from humancellatlas.data.metadata.instrumentation import CallbackInstrument
+>>> i = CallbackInstrument(lambda stage, seconds, count, size: print(stage, count, size))
+>>> decode_json(b'{}', instrument=i)
+json_decode 1 2
+{}
+"""
+import json
+import mmap
+import os
+from typing import (
+    Callable,
+    Mapping,
+    Optional,
+    Union,
+)
+
+from humancellatlas.data.metadata.api import AnyJSON
+from humancellatlas.data.metadata.instrumentation import (
+    Instrument,
+    timed,
+)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The types of raw input accepted by the decoders. A memoryview must be a contiguous view of bytes.
+#
+Buffer = Union[bytes, bytearray, memoryview, str]
+
+JSONDecoder = Callable[[Buffer], AnyJSON]
+
+
+def stdlib_decoder(data: Buffer) -> AnyJSON:
+    """
+    Decode the given UTF-8 encoded JSON using the `json` module of the standard library.
+    """
+    if not isinstance(data, (str, bytes, bytearray)):
+        data = str(data, 'utf-8')
+    return json.loads(data)
+
+
+def orjson_decoder(data: Buffer) -> AnyJSON:
+    """
+    Decode the given UTF-8 encoded JSON using the `orjson` package. orjson is stricter than the standard library. It
+    rejects `NaN`, for example, and integers that don't fit into 64 bits, so documents it rejects are decoded again
+    by stdlib_decoder(), which either accepts them or raises the usual json.JSONDecodeError.
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return stdlib_decoder(data)
+
+
+# The available decoders by name
+#
+decoders: Mapping[str, JSONDecoder] = {
+    'json': stdlib_decoder,
+    **({} if orjson is None else {'orjson': orjson_decoder})
+}
+
+_default_decoder: JSONDecoder = orjson_decoder if orjson is not None else stdlib_decoder
+
+
+def default_decoder() -> JSONDecoder:
+    return _default_decoder
+
+
+def set_default_decoder(decoder: Union[str, JSONDecoder]) -> None:
+    """
+    Set the decoder used by decode_json() and read_json() when no decoder is passed to them, and therefore by
+    download_bundle_metadata() and the local bundle sources.
+
+    :param decoder: the name of a decoder in `decoders`, or a callable taking the raw JSON and returning the decoded
+                    value
+
+    >>> previous = default_decoder()
+    >>> set_default_decoder('json')
+    >>> default_decoder() is stdlib_decoder
+    True
+    >>> set_default_decoder(previous)
+    >>> set_default_decoder('simdjson')
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Unknown or unavailable JSON decoder', 'simdjson')
+    """
+    global _default_decoder
+    if isinstance(decoder, str):
+        try:
+            decoder = decoders[decoder]
+        except KeyError:
+            raise ValueError('Unknown or unavailable JSON decoder', decoder)
+    _default_decoder = decoder
+
+
+def decode_json(data: Buffer,
+                instrument: Optional[Instrument] = None,
+                decoder: Optional[JSONDecoder] = None) -> AnyJSON:
+    """
+    Decode the given UTF-8 encoded JSON.
+
+    :param data: the raw JSON
+
+    :param instrument: an optional instrument to report the time spent decoding to, as the `json_decode` stage
+
+    :param decoder: the decoder to use instead of the default decoder
+    """
+    if decoder is None:
+        decoder = _default_decoder
+    if instrument is None:
+        return decoder(data)
+    else:
+        with timed(instrument, 'json_decode', count=1, size=len(data)):
+            return decoder(data)
+
+
+def read_json(path: str,
+              instrument: Optional[Instrument] = None,
+              decoder: Optional[JSONDecoder] = None) -> AnyJSON:
+    """
+    Decode the UTF-8 encoded JSON in the file at the given path. The file is memory-mapped and passed to the decoder
+    without reading it into a `bytes` object first.
+
+    See decode_json() for the remaining parameters.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return decode_json(b'', instrument, decoder)  # an empty file can't be mapped
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            with memoryview(buf) as view:
+                return decode_json(view, instrument, decoder)
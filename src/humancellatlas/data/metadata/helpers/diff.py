@@ -0,0 +1,121 @@
+"""
+Differences between two versions of a bundle.
+
+>>> m1 = [{'name': 'a.json', 'uuid': '1', 'version': '1', 'sha256': 'x'},
+...       {'name': 'b.json', 'uuid': '2', 'version': '1', 'sha256': 'y'},
+...       {'name': 'c.json', 'uuid': '3', 'version': '1', 'sha256': 'z'}]
+>>> m2 = [{'name': 'a.json', 'uuid': '1', 'version': '1', 'sha256': 'x'},
+...       {'name': 'b.json', 'uuid': '2', 'version': '2', 'sha256': 'w'},
+...       {'name': 'd.json', 'uuid': '4', 'version': '1', 'sha256': 'v'}]
+>>> diff_manifests(m1, m2)
+ManifestDiff(added=['d.json'], removed=['c.json'], changed=['b.json'], unchanged=['a.json'])
+"""
+from typing import (
+    List,
+    Set,
+    Tuple,
+)
+
+from dataclasses import (
+    dataclass,
+    fields,
+)
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    Entity,
+    JSON,
+    Link,
+    UUID4,
+    link_fields,
+)
+
+# The source ID, source type, destination ID and destination type of a link
+#
+LinkTuple = Tuple[UUID4, str, UUID4, str]
+
+
+@dataclass
+class ManifestDiff:
+    """
+    The names of the files added, removed, changed and left unchanged between two versions of a bundle manifest
+    """
+    added: List[str]
+    removed: List[str]
+    changed: List[str]
+    unchanged: List[str]
+
+
+def diff_manifests(old: List[JSON], new: List[JSON]) -> ManifestDiff:
+    """
+    Compare two versions of a bundle manifest. Files are matched by name. A file is considered unchanged if its UUID,
+    version and SHA-256 checksum are the same in both manifests. The names are listed in the order in which they occur
+    in the new manifest, or in the old manifest for removed files.
+    """
+    old_entries = {entry['name']: entry for entry in old}
+    new_names = set()
+    diff = ManifestDiff(added=[], removed=[], changed=[], unchanged=[])
+    for entry in new:
+        name = entry['name']
+        new_names.add(name)
+        old_entry = old_entries.get(name)
+        if old_entry is None:
+            diff.added.append(name)
+        elif all(old_entry.get(k) == entry.get(k) for k in ('uuid', 'version', 'sha256')):
+            diff.unchanged.append(name)
+        else:
+            diff.changed.append(name)
+    diff.removed.extend(name for name in old_entries.keys() if name not in new_names)
+    return diff
+
+
+@dataclass
+class BundleDiff:
+    """
+    The document IDs of the entities and the links added, removed and changed between two versions of a bundle
+    """
+    added_entities: Set[UUID4]
+    removed_entities: Set[UUID4]
+    changed_entities: Set[UUID4]
+    added_links: Set[LinkTuple]
+    removed_links: Set[LinkTuple]
+
+    def __bool__(self) -> bool:
+        return any((self.added_entities, self.removed_entities, self.changed_entities,
+                    self.added_links, self.removed_links))
+
+
+def diff_bundles(old: Bundle, new: Bundle) -> BundleDiff:
+    """
+    Compare two versions of a bundle. Entities are matched by document ID. An entity is considered changed if its
+    JSON differs between the two bundles, or, for entities without JSON like those of a bundle loaded from a snapshot,
+    if any of its fields other than the references to other entities differ.
+    """
+    old_ids, new_ids = old.entities.keys(), new.entities.keys()
+    old_links, new_links = set(map(_link_tuple, old.links)), set(map(_link_tuple, new.links))
+    return BundleDiff(added_entities=new_ids - old_ids,
+                      removed_entities=old_ids - new_ids,
+                      changed_entities={document_id for document_id in old_ids & new_ids
+                                        if _changed(old.entities[document_id], new.entities[document_id])},
+                      added_links=new_links - old_links,
+                      removed_links=old_links - new_links)
+
+
+def _link_tuple(link: Link) -> LinkTuple:
+    return link.source_id, link.source_type, link.destination_id, link.destination_type
+
+
+def _changed(old: Entity, new: Entity) -> bool:
+    if type(old) is not type(new):
+        return True
+    elif old.json is not None and new.json is not None:
+        return old.json is not new.json and old.json != new.json
+    else:
+        return _fields(old) != _fields(new)
+
+
+def _fields(entity: Entity):
+    return {f.name: getattr(entity, f.name) for f in fields(entity) if f.name not in _excluded_fields}
+
+
+_excluded_fields = link_fields | {'json', 'manifest_entry'}
@@ -1,24 +1,53 @@
-from concurrent.futures import ThreadPoolExecutor
-from functools import lru_cache
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
+from collections import OrderedDict
+from functools import (
+    lru_cache,
+    partial,
+)
 import logging
 import os
+from threading import Lock
+import time
 from typing import (
+    Callable,
+    Iterable,
+    Iterator,
     List,
+    MutableMapping,
     Optional,
     Tuple,
     Mapping,
     Any,
+    TypeVar,
 )
 from unittest.mock import patch
 
 from hca.dss import DSSClient
-from requests import Session
+from hca.util.exceptions import SwaggerAPIException
+from requests import (
+    Response,
+    Session,
+)
 from urllib3 import Timeout
+from urllib3.util import make_headers
 
 from humancellatlas.data.metadata.api import JSON
+from humancellatlas.data.metadata.helpers.decoder import decode_json
+from humancellatlas.data.metadata.helpers.diff import diff_manifests
+from humancellatlas.data.metadata.helpers.pack import BundlePack
+from humancellatlas.data.metadata.helpers.retry import Retrier
+from humancellatlas.data.metadata.instrumentation import (
+    Instrument,
+    timed,
+)
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
 
 @lru_cache(maxsize=1)
 def default_num_workers():
@@ -31,7 +60,15 @@ def download_bundle_metadata(client: DSSClient,
                              version: Optional[str] = None,
                              directurls: bool = False,
                              presignedurls: bool = False,
-                             num_workers: Optional[int] = default_num_workers()) -> Tuple[str, List[JSON], JSON]:
+                             num_workers: Optional[int] = default_num_workers(),
+                             cache: Optional[BundlePack] = None,
+                             instrument: Optional[Instrument] = None,
+                             file_filter: Optional[Callable[[JSON], bool]] = None,
+                             small_file_size: Optional[int] = None,
+                             previous: Optional[Tuple[List[JSON], Mapping[str, JSON]]] = None,
+                             manifest_cache: Optional['ManifestCache'] = None,
+                             retrier: Optional[Retrier] = None
+                             ) -> Tuple[str, List[JSON], JSON]:
     """
     Download the metadata for a given bundle from the HCA data store (DSS).
 
@@ -59,30 +96,120 @@ def download_bundle_metadata(client: DSSClient,
                         executing this function. If 0, no thread pool will be used and all files will be downloaded
                         sequentially by the current thread.
 
+    :param cache: An optional pack file to use as a cache. If a version was specified and the pack contains that
+                  version of the bundle, the bundle is read from the pack instead of being downloaded. Otherwise the
+                  downloaded bundle is added to the pack. The cache is not used if either `directurls` or
+                  `presignedurls` is set.
+
+    :param instrument: An optional instrument to report the time spent in the various stages of the download to. See
+                       humancellatlas.data.metadata.instrumentation.Instrument for details.
+
+    :param file_filter: An optional predicate over the manifest entries of the bundle's metadata files. Only files for
+                        which the predicate returns True are downloaded. Use schema_filter() to select files by the
+                        name of their schema. Bundles downloaded with a filter are not added to the cache. Pass
+                        `allow_missing_entities=True` when creating a Bundle from a subset of the metadata files.
+
+    :param small_file_size: If not None, metadata files of at most this many bytes are downloaded by a dedicated
+                            thread. See download_metadata_files() for details.
+
+    :param previous: The manifest and metadata files of a previous version of the bundle, as returned by an earlier
+                     invocation of this function. Metadata files whose name, UUID, version and checksum are the same
+                     in the previous manifest are taken from the previous metadata files instead of being
+                     downloaded again. See diff_manifests(). Pass the previous Bundle object as the `previous`
+                     argument to Bundle() in order to also reuse the entities created from unchanged files.
+
+    :param manifest_cache: An optional in-memory cache of bundle manifests and of the latest version of each bundle.
+                           If no version is given, the latest version is taken from the cache unless it expired.
+                           If the manifest of the requested or latest version is in the cache, the manifest is not
+                           downloaded again. Otherwise the downloaded manifest is added to the cache. The cache is not
+                           used if either `directurls` or `presignedurls` is set. See ManifestCache for details.
+
+    :param retrier: An optional Retrier to make the requests to the DSS with, in order to retry failed requests. By
+                    default, the retrier of the client is used if the client was created by dss_client() with a
+                    retrier. Each retry is reported to the instrument. Retrying the retrieval of the manifest starts
+                    over at the first page.
+
     :return: A tuple consisting of the version of the downloaded bundle, a list of the manifest entries for all files
              in the bundle (data and metadata) and a dictionary mapping the file name of each metadata file in the
-             bundle to the JSON contents of that file.
+             bundle to the JSON contents of that file. The manifest is always complete, even if a file filter
+             limited the metadata files that were downloaded.
     """
     if directurls or presignedurls:
         logger.warning("PendingDeprecationWarning: `directurls` and `presignedurls` are temporary parameters and not"
                        " guaranteed to stay in the code base in the future!")
-
-    logger.debug("Getting bundle %s.%s from DSS.", uuid, version)
-    kwargs = dict(uuid=uuid,
-                  version=version,
-                  replica=replica,
-                  directurls=directurls,
-                  presignedurls=presignedurls)
-    manifest = []
-
-    bundle = None
-    # noinspection PyUnresolvedReferences
-    for page in client.get_bundle.paginate(**kwargs):
-        bundle = page['bundle']
-        manifest.extend(bundle['files'])
-    assert bundle is not None
-
-    metadata_files = {f['name']: f for f in manifest if f['indexed']}
+        cache = None
+        manifest_cache = None
+
+    if retrier is None:
+        retrier = _retrier(client)
+
+    if version is None and manifest_cache is not None:
+        version = manifest_cache.latest_version(uuid)
+    # Only a version resolved by the DSS may be cached as the latest version. Caching a version that was itself taken
+    # from the cache would extend its expiration indefinitely.
+    latest = version is None
+
+    if cache is not None and version is not None:
+        try:
+            with timed(instrument, 'cache'):
+                manifest, metadata_files = cache.get(uuid, version)
+        except KeyError:
+            pass
+        else:
+            logger.debug("Found bundle %s.%s in cache '%s'.", uuid, version, cache.path)
+            if file_filter is not None:
+                metadata_files = {f['name']: metadata_files[f['name']]
+                                  for f in manifest
+                                  if f['name'] in metadata_files and file_filter(f)}
+            return version, manifest, metadata_files
+
+    manifest = None
+    if manifest_cache is not None and version is not None:
+        manifest = manifest_cache.manifest(uuid, version)
+        if manifest is not None and instrument is not None:
+            instrument.record('manifest_cache', 0.0, count=len(manifest))
+
+    if manifest is None:
+        logger.debug("Getting bundle %s.%s from DSS.", uuid, version)
+        kwargs = dict(uuid=uuid,
+                      version=version,
+                      replica=replica,
+                      directurls=directurls,
+                      presignedurls=presignedurls)
+
+        def get_manifest() -> Tuple[JSON, List[JSON]]:
+            manifest = []
+            bundle = None
+            start = time.perf_counter()
+            # noinspection PyUnresolvedReferences
+            for page in client.get_bundle.paginate(**kwargs):
+                bundle = page['bundle']
+                manifest.extend(bundle['files'])
+                if instrument is not None:
+                    end = time.perf_counter()
+                    instrument.record('get_bundle', end - start, count=len(bundle['files']))
+                    start = end
+            assert bundle is not None
+            return bundle, manifest
+
+        bundle, manifest = _call(retrier, instrument, get_manifest)
+        version = bundle['version']
+        if manifest_cache is not None:
+            manifest_cache.put(uuid, version, manifest, latest=latest)
+
+    metadata_files = {f['name']: f for f in manifest if f['indexed'] and (file_filter is None or file_filter(f))}
+
+    reused_files = {}
+    if previous is not None:
+        previous_manifest, previous_metadata_files = previous
+        diff = diff_manifests(previous_manifest, manifest)
+        reused_files = {name: previous_metadata_files[name]
+                        for name in diff.unchanged
+                        if name in metadata_files and name in previous_metadata_files}
+        for name in reused_files.keys():
+            del metadata_files[name]
+        if instrument is not None:
+            instrument.record('reuse', 0.0, count=len(reused_files))
 
     for f in metadata_files.values():
         content_type, _, _ = f['content-type'].partition(';')
@@ -92,35 +219,348 @@ def download_bundle_metadata(client: DSSClient,
                                       f"to have content type '{expected_content_type}', "
                                       f"not '{content_type}'")
 
-    def download_file(item):
-        file_name, manifest_entry = item
-        file_uuid = manifest_entry['uuid']
-        file_version = manifest_entry['version']
-        logger.debug("Getting file '%s' (%s.%s) from DSS.", file_name, file_uuid, file_version)
-        # noinspection PyUnresolvedReferences
-        file_contents = client.get_file(uuid=file_uuid, version=file_version, replica=replica)
+    metadata_files = download_metadata_files(client, replica, metadata_files.values(),
+                                             num_workers=num_workers,
+                                             small_file_size=small_file_size,
+                                             instrument=instrument,
+                                             retrier=retrier)
+    # Restore the manifest order so that the result does not depend on the timing of the downloads
+    metadata_files = dict(metadata_files)
+    metadata_files.update(reused_files)
+    metadata_files = {f['name']: metadata_files[f['name']] for f in manifest if f['name'] in metadata_files}
 
-        # Work around https://github.com/HumanCellAtlas/data-store/issues/2073
-        if replica == 'gcp' and isinstance(file_contents, bytes):  # pragma: no cover
-            import json
-            file_contents = json.loads(file_contents)
+    if cache is not None and file_filter is None:
+        cache.put(uuid, version, manifest, metadata_files)
+
+    return version, manifest, metadata_files
+
+
+class ManifestCache:
+    """
+    A thread-safe, in-memory cache of bundle manifests by bundle UUID and version, and of the latest version of each
+    bundle.
+
+    A version of a bundle is immutable, so its manifest can be cached indefinitely. The least recently used manifests
+    are evicted once the total number of manifest entries in the cache exceeds a limit. The latest version of a
+    bundle, on the other hand, changes when a new version is created, so it is only cached for a limited time.
+
+    Cached manifests are shared with the callers of download_bundle_metadata(), which must therefore not modify them.
+
+    >>> now = [0.0]
+    >>> cache = ManifestCache(max_entries=3, latest_ttl=10, clock=lambda: now[0])
+    >>> cache.put('a', '1', [{'name': 'x'}, {'name': 'y'}], latest=True)
+    >>> cache.manifest('a', '1'), cache.latest_version('a')
+    ([{'name': 'x'}, {'name': 'y'}], '1')
+    >>> now[0] = 11
+    >>> cache.latest_version('a') is None
+    True
+    >>> cache.put('b', '1', [{'name': 'z'}, {'name': 'w'}])
+    >>> cache.manifest('a', '1') is None, len(cache)
+    (True, 1)
+    """
+
+    def __init__(self,
+                 max_entries: int = 1_000_000,
+                 latest_ttl: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param max_entries: the maximum total number of manifest entries in all cached manifests
+
+        :param latest_ttl: the number of seconds for which the latest version of a bundle is cached
+
+        :param clock: the function returning the current time in seconds, for testing
+        """
+        self.max_entries = max_entries
+        self.latest_ttl = latest_ttl
+        self.clock = clock
+        self._manifests: MutableMapping[Tuple[str, str], List[JSON]] = OrderedDict()
+        self._num_entries = 0
+        self._latest: MutableMapping[str, Tuple[str, float]] = {}
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        """
+        The number of cached manifests
+        """
+        return len(self._manifests)
+
+    def manifest(self, uuid: str, version: str) -> Optional[List[JSON]]:
+        """
+        Return the cached manifest of the given version of the given bundle, or None if it isn't cached.
+        """
+        key = uuid, version
+        with self._lock:
+            manifest = self._manifests.get(key)
+            if manifest is not None:
+                self._manifests.move_to_end(key)
+            return manifest
+
+    def latest_version(self, uuid: str) -> Optional[str]:
+        """
+        Return the latest version of the given bundle, or None if it isn't cached or expired.
+        """
+        with self._lock:
+            try:
+                version, expiration = self._latest[uuid]
+            except KeyError:
+                return None
+            if expiration <= self.clock():
+                del self._latest[uuid]
+                return None
+            return version
+
+    def put(self, uuid: str, version: str, manifest: Optional[List[JSON]], latest: bool = False) -> None:
+        """
+        Add the manifest of the given version of the given bundle to the cache.
+
+        :param manifest: the manifest or None to only record the latest version
+
+        :param latest: if True, the given version is cached as the latest version of the bundle
+        """
+        with self._lock:
+            if latest:
+                self._latest[uuid] = version, self.clock() + self.latest_ttl
+            if manifest is not None and len(manifest) <= self.max_entries:
+                key = uuid, version
+                old_manifest = self._manifests.pop(key, None)
+                if old_manifest is not None:
+                    self._num_entries -= len(old_manifest)
+                self._manifests[key] = manifest
+                self._num_entries += len(manifest)
+                while self._num_entries > self.max_entries:
+                    _, evicted = self._manifests.popitem(last=False)
+                    self._num_entries -= len(evicted)
+
+
+def resolve_latest_versions(client: DSSClient,
+                            replica: str,
+                            uuids: Iterable[str],
+                            manifest_cache: Optional[ManifestCache] = None,
+                            num_workers: Optional[int] = default_num_workers(),
+                            retrier: Optional[Retrier] = None) -> Mapping[str, str]:
+    """
+    Look up the latest version of each of the given bundles in the DSS. Each lookup requests the smallest possible
+    first page of the bundle's manifest. The lookups are done concurrently.
+
+    :param client: A DSS API client instance
+
+    :param replica: The name of the DSS replica to use
+
+    :param uuids: the UUIDs of the bundles
+
+    :param manifest_cache: An optional manifest cache. Bundles whose latest version is in the cache are not looked up.
+                           The versions looked up are added to the cache.
+
+    :param num_workers: The size of the thread pool to use, see download_bundle_metadata()
+
+    :param retrier: An optional Retrier to make the requests with, see download_bundle_metadata()
+
+    :return: A dictionary mapping the UUID of each of the given bundles that exists in the DSS to its latest version
+
+    >>> from humancellatlas.data.metadata.helpers.synthetic import LocalDSSClient, SyntheticCorpus
+    >>> corpus = list(SyntheticCorpus(2, seed=1))
+    >>> client = LocalDSSClient(corpus)
+    >>> uuids = [uuid for uuid, *_ in corpus] + ['00000000-0000-0000-0000-000000000000']
+    >>> versions = resolve_latest_versions(client, 'aws', uuids, num_workers=0)
+    >>> versions == {uuid: version for uuid, version, *_ in corpus}
+    True
+    """
+    if retrier is None:
+        retrier = _retrier(client)
+    versions = {}
+    pending = []
+    for uuid in uuids:
+        version = None if manifest_cache is None else manifest_cache.latest_version(uuid)
+        if version is None:
+            pending.append(uuid)
+        else:
+            versions[uuid] = version
+
+    def resolve(uuid: str) -> Tuple[str, Optional[str]]:
+        try:
+            # The DSS requires at least 10 entries per page
+            # noinspection PyUnresolvedReferences
+            bundle = _call(retrier, None, client.get_bundle, uuid=uuid, replica=replica, per_page=10)['bundle']
+        except SwaggerAPIException as e:
+            if e.code == 404:
+                return uuid, None
+            else:
+                raise
+        else:
+            return uuid, bundle['version']
 
-        if not isinstance(file_contents, dict):
-            raise TypeError(f'Expecting file {file_uuid}.{file_version} '
-                            f'to contain a JSON object ({dict}), '
-                            f'not {type(file_contents)}')
-        return file_name, file_contents
+    def collect(results: Iterable[Tuple[str, Optional[str]]]) -> None:
+        for uuid, version in results:
+            if version is not None:
+                versions[uuid] = version
+                if manifest_cache is not None:
+                    manifest_cache.put(uuid, version, None, latest=True)
 
     if num_workers == 0:
-        metadata_files = map(download_file, metadata_files.items())
+        collect(map(resolve, pending))
     else:
         with ThreadPoolExecutor(num_workers) as tpe:
-            metadata_files = tpe.map(download_file, metadata_files.items())
+            collect(tpe.map(resolve, pending))
+    return versions
+
+
+def download_metadata_files(client: DSSClient,
+                            replica: str,
+                            manifest_entries: Iterable[JSON],
+                            num_workers: Optional[int] = default_num_workers(),
+                            small_file_size: Optional[int] = None,
+                            instrument: Optional[Instrument] = None,
+                            retrier: Optional[Retrier] = None) -> Iterator[Tuple[str, JSON]]:
+    """
+    Download the given metadata files from DSS, yielding the name and JSON contents of each file as soon as its
+    download completes.
+
+    Files are submitted to the thread pool in the order of decreasing size, as given by the `size` property of each
+    manifest entry. Downloading the largest files first minimizes the time until the last file arrives, so that a
+    large file like links.json does not start downloading when most of the pool is already idle.
+
+    :param client: A DSS API client instance
+
+    :param replica: The name of the DSS replica to use
+
+    :param manifest_entries: the manifest entries of the metadata files to download
+
+    :param num_workers: The size of the thread pool, see download_bundle_metadata()
+
+    :param small_file_size: If not None and a thread pool is used, files of at most this many bytes are downloaded by
+                            an additional, dedicated thread. This way, small files do not have to wait for the large
+                            files ahead of them in the pool's queue.
 
-    return bundle['version'], manifest, dict(metadata_files)
+    :param instrument: An optional instrument to report the time spent downloading each file to
 
+    :param retrier: An optional Retrier to download each file with, see download_bundle_metadata()
+    """
+    manifest_entries = sorted(manifest_entries, key=lambda f: f.get('size', 0), reverse=True)
+
+    def download_file(manifest_entry: JSON) -> Tuple[str, JSON]:
+        return manifest_entry['name'], _download_file(client, replica, manifest_entry, instrument, retrier)
+
+    if num_workers == 0:
+        yield from map(download_file, manifest_entries)
+    else:
+        if small_file_size is None:
+            small_entries = []
+        else:
+            small_entries = [f for f in manifest_entries if f.get('size', 0) <= small_file_size]
+            manifest_entries = manifest_entries[:len(manifest_entries) - len(small_entries)]
+        with ThreadPoolExecutor(num_workers) as tpe, ThreadPoolExecutor(1) as small_tpe:
+            futures = [tpe.submit(download_file, f) for f in manifest_entries]
+            futures.extend(small_tpe.submit(download_file, f) for f in small_entries)
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+
+def _download_file(client: DSSClient,
+                   replica: str,
+                   manifest_entry: JSON,
+                   instrument: Optional[Instrument],
+                   retrier: Optional[Retrier] = None) -> JSON:
+    file_uuid = manifest_entry['uuid']
+    file_version = manifest_entry['version']
+    logger.debug("Getting file '%s' (%s.%s) from DSS.", manifest_entry['name'], file_uuid, file_version)
+    # Prefer the raw body if the client provides it, so that it can be decoded by decode_json(). The method is looked
+    # up on the type in order to ignore the arbitrary attributes of mock clients.
+    if hasattr(type(client), 'get_file_bytes'):
+        with timed(instrument, 'get_file', count=1, size=manifest_entry.get('size', 0)):
+            # noinspection PyUnresolvedReferences
+            file_contents = _call(retrier, instrument, partial(client.get_file_bytes, instrument=instrument),
+                                  uuid=file_uuid, version=file_version, replica=replica)
+        file_contents = decode_json(file_contents, instrument)
+    else:
+        with timed(instrument, 'get_file', count=1, size=manifest_entry.get('size', 0)):
+            # noinspection PyUnresolvedReferences
+            file_contents = _call(retrier, instrument, client.get_file,
+                                  uuid=file_uuid, version=file_version, replica=replica)
 
-def dss_client(deployment: str = 'prod', num_workers: int = default_num_workers()) -> DSSClient:
+        # Work around https://github.com/HumanCellAtlas/data-store/issues/2073
+        if replica == 'gcp' and isinstance(file_contents, bytes):  # pragma: no cover
+            file_contents = decode_json(file_contents, instrument)
+
+    if not isinstance(file_contents, dict):
+        raise TypeError(f'Expecting file {file_uuid}.{file_version} '
+                        f'to contain a JSON object ({dict}), '
+                        f'not {type(file_contents)}')
+    return file_contents
+
+
+def _wire_size(response: Response, content: bytes) -> int:
+    """
+    The number of bytes of the given response's body that were transferred, before any content decoding
+    """
+    try:
+        return response.raw.tell()
+    except AttributeError:  # pragma: no cover
+        return int(response.headers.get('Content-Length', len(content)))
+
+
+def _retrier(client: DSSClient) -> Optional[Retrier]:
+    return client.retrier if isinstance(client, _DSSClient) else None
+
+
+def _call(retrier: Optional[Retrier], instrument: Optional[Instrument], func: Callable[..., T], *args, **kwargs) -> T:
+    if retrier is None:
+        return func(*args, **kwargs)
+    else:
+        return retrier.call(func, *args, instrument=instrument, **kwargs)
+
+
+def schema_filter(include: Optional[Iterable[str]] = None,
+                  exclude: Iterable[str] = ()) -> Callable[[JSON], bool]:
+    """
+    Return a predicate for the `file_filter` argument to download_bundle_metadata() that selects metadata files by the
+    name of their schema, as derived from the file name. In the vx layout, the schema name is the part of the file
+    name before the trailing underscore and number, `sequence_file` for `sequence_file_0.json` for example. In the v5
+    layout, it is the core entity type, `biomaterial` for `biomaterial.json` for example. The schema name of
+    `links.json` is `links`. Bundle() requires `links.json`, so it is always selected unless explicitly excluded.
+
+    :param include: the schema names to select. If None, all schemas are selected unless excluded.
+
+    :param exclude: the schema names not to select
+
+    >>> f = schema_filter(include=['sequence_file', 'cell_suspension'])
+    >>> [f({'name': n}) for n in ['sequence_file_12.json', 'donor_organism_0.json', 'links.json', 'file.json']]
+    [True, False, True, False]
+    >>> f = schema_filter(exclude=['project', 'links'])
+    >>> [f({'name': n}) for n in ['project.json', 'project_0.json', 'links.json', 'protocol.json']]
+    [False, False, False, True]
+    """
+    include = None if include is None else {'links', *include}
+    exclude = set(exclude)
+
+    def predicate(manifest_entry: JSON) -> bool:
+        schema_name = metadata_file_schema_name(manifest_entry['name'])
+        return (include is None or schema_name in include) and schema_name not in exclude
+
+    return predicate
+
+
+def metadata_file_schema_name(file_name: str) -> str:
+    """
+    Return the name of the schema of the metadata file of the given name. See schema_filter() for details.
+
+    >>> metadata_file_schema_name('cell_suspension_3.json')
+    'cell_suspension'
+    >>> metadata_file_schema_name('process.json')
+    'process'
+    """
+    name, _, suffix = file_name.rpartition('.')
+    schema_name, _, index = name.rpartition('_')
+    return schema_name if schema_name and index.isdigit() else name
+
+
+def dss_client(deployment: str = 'prod',
+               num_workers: int = default_num_workers(),
+               retrier: Optional[Retrier] = None,
+               timeout: Timeout = Timeout(connect=10, read=40)) -> DSSClient:
     """
     Return a DSS client to DSS production or the specified DSS deployment.
 
@@ -132,12 +572,21 @@ def dss_client(deployment: str = 'prod', num_workers: int = default_num_workers(
                         pool which avoids discarding connections unnecessarily
                         as indicated by the accompanying `Connection pool is
                         full, discarding connection` warning.
+
+    :param retrier: An optional Retrier that download_bundle_metadata() and
+                    resolve_latest_versions() use to retry the requests
+                    they make with this client. If given, the retries built
+                    into the HCA client library are disabled, so that the
+                    retrier's budget and circuit breaker are in control.
+
+    :param timeout: The connect and read timeouts of each request
     """
     deployment = "" if deployment == "prod" else deployment + "."
     swagger_url = f'https://dss.{deployment}data.humancellatlas.org/v1/swagger.json'
     client = _DSSClient(swagger_url=swagger_url,
-                        adapter_args=None if num_workers is None else dict(pool_maxsize=num_workers))
-    client.timeout_policy = Timeout(connect=10, read=40)
+                        adapter_args=None if num_workers is None else dict(pool_maxsize=num_workers),
+                        retrier=retrier)
+    client.timeout_policy = timeout
     return client
 
 
@@ -146,18 +595,49 @@ class _DSSClient(DSSClient):
     A DSSClient with certain extensions and fixes.
     """
 
-    def __init__(self, *args, adapter_args: Optional[Mapping[str, Any]] = None, **kwargs):
+    def __init__(self,
+                 *args,
+                 adapter_args: Optional[Mapping[str, Any]] = None,
+                 retrier: Optional[Retrier] = None,
+                 **kwargs):
         """
         Pass `adapter_args=dict(pool_maxsize=num_threads)` in order to avoid the resource warnings.
 
         :param args: positional arguments to pass to DSSClient constructor
         :param adapter_args: optional keyword arguments to request's HTTPAdapter class
+        :param retrier: an optional Retrier replacing the retry policy of the HCA client library, see dss_client()
         :param kwargs: keyword arguments to pass to DSSClient constructor
         """
         self._adapter_args = adapter_args  # yes, this must come first
+        self.retrier = retrier
+        if retrier is not None:
+            # Retrying in both the HTTP adapter and the retrier would multiply the number of attempts
+            self.retry_policy = 0
         super().__init__(*args, **kwargs)
 
+    def get_file_bytes(self,
+                       uuid: str,
+                       replica: str,
+                       version: Optional[str] = None,
+                       instrument: Optional[Instrument] = None) -> bytes:
+        """
+        Like get_file() but return the raw body of the response instead of letting the client decode it, so that
+        the caller can decode it with decode_json().
+
+        :param instrument: an optional instrument to report the number of bytes transferred to, as the `wire` stage.
+                           If the server compressed the response, this is less than the size of the returned body.
+        """
+        # noinspection PyUnresolvedReferences,PyProtectedMember
+        response = self.get_file._request(dict(uuid=uuid, replica=replica, version=version))
+        content = response.content
+        if instrument is not None:
+            instrument.record('wire', 0.0, count=1, size=_wire_size(response, content))
+        return content
+
     def _set_retry_policy(self, session: Session):
+        # This is called once for every new session. Explicitly ask for compressed responses, in any encoding the
+        # installed packages can decode.
+        session.headers['Accept-Encoding'] = make_headers(accept_encoding=True)['accept-encoding']
         if self._adapter_args is None:
             super()._set_retry_policy(session)
         else:
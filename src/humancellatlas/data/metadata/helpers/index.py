@@ -0,0 +1,330 @@
+"""
+An embedded index of the main fields of the entities in many bundles, and of the links between them, backed by an
+SQLite database.
+
+>>> from humancellatlas.data.metadata.helpers.synthetic import BundleShape, SyntheticCorpus
+>>> index = BundleIndex()
+>>> index.update(Bundle(*bundle) for bundle in SyntheticCorpus(10, BundleShape(donors=2), seed=2))
+10
+>>> len(index)
+10
+
+All sequence files from pancreas specimens of human donors:
+
+>>> hits = index.find('sequence_file',
+...                   ancestors={'specimen_from_organism': {'organ': 'pancreas'},
+...                              'donor_organism': {'genus_species': 'Homo sapiens'}})
+>>> len(hits), len({fqid for fqid, document_id in hits})
+(8, 3)
+"""
+from operator import attrgetter
+import sqlite3
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+)
+from uuid import UUID
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    CellSuspension,
+    DonorOrganism,
+    Entity,
+    Project,
+    SequenceFile,
+    SpecimenFromOrganism,
+    UUID4,
+    schema_names,
+)
+
+# The FQID (`uuid.version`) of a bundle and the document ID of an entity in that bundle
+#
+Hit = Tuple[str, UUID4]
+
+
+class _Table:
+    """
+    The columns of the table for one type of entity. Scalar fields are stored in a column of the table, the values of
+    set-valued fields in the shared `entity_value` table.
+    """
+
+    def __init__(self, entity_type: Type[Entity], scalar_fields: Mapping[str, str], set_fields: Iterable[str]) -> None:
+        """
+        :param entity_type: the type of entity to be stored in the table
+
+        :param scalar_fields: maps the name of each column to the (possibly dotted) name of the entity attribute to
+                              be stored in that column
+
+        :param set_fields: the names of the set-valued entity attributes
+        """
+        self.name = schema_names[entity_type]
+        self.entity_type = entity_type
+        self.columns = list(scalar_fields.keys())
+        self.getters: List[Callable[[Entity], Any]] = list(map(attrgetter, scalar_fields.values()))
+        self.set_fields = list(set_fields)
+
+
+_tables = [
+    _Table(Project,
+           {'project_short_name': 'project_short_name', 'project_title': 'project_title'},
+           ['insdc_project_accessions', 'geo_series_accessions', 'array_express_accessions']),
+    _Table(DonorOrganism,
+           {'biomaterial_id': 'biomaterial_id', 'sex': 'sex', 'organism_age': 'organism_age',
+            'organism_age_unit': 'organism_age_unit'},
+           ['genus_species', 'diseases']),
+    _Table(SpecimenFromOrganism,
+           {'biomaterial_id': 'biomaterial_id', 'organ': 'organ', 'storage_method': 'storage_method',
+            'preservation_method': 'preservation_method'},
+           ['diseases', 'organ_parts']),
+    _Table(CellSuspension,
+           {'biomaterial_id': 'biomaterial_id', 'estimated_cell_count': 'estimated_cell_count'},
+           ['selected_cell_types']),
+    _Table(SequenceFile,
+           {'name': 'manifest_entry.name', 'file_uuid': 'manifest_entry.uuid', 'file_version': 'manifest_entry.version',
+            'size': 'manifest_entry.size', 'format': 'format', 'read_index': 'read_index', 'lane_index': 'lane_index'},
+           [])
+]
+
+_tables_by_name = {table.name: table for table in _tables}
+
+_tables_by_type = {table.entity_type: table for table in _tables}
+
+# Columns that are indexed in addition to the document ID
+#
+_indexed_columns = ['biomaterial_id', 'project_short_name', 'organ', 'sex', 'format', 'file_uuid']
+
+_schema_version = 1
+
+
+class BundleIndex:
+    """
+    An index of the bundles added to it, with one row for every entity and link in each bundle, and a table for each
+    of the main entity types, holding the main fields of each entity of that type. Set-valued fields and link edges
+    are stored in separate tables. The index holds at most one version of each bundle. Adding a newer version of a
+    bundle replaces the rows of the older version, adding the same or an older version is a no-op.
+
+    An index can only be used by the thread that created it.
+    """
+
+    def __init__(self, path: str = ':memory:') -> None:
+        """
+        :param path: the path of the database file, created if it does not exist. By default the index is kept in
+                     memory.
+        """
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self._create_schema()
+
+    def __enter__(self) -> 'BundleIndex':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def _create_schema(self) -> None:
+        db = self.connection
+        schema_version, = db.execute('PRAGMA user_version').fetchone()
+        if schema_version == _schema_version:
+            return
+        elif schema_version != 0:
+            raise RuntimeError(f'Unsupported schema version {schema_version} of bundle index', self.path)
+        with db:
+            db.execute('CREATE TABLE bundle (id INTEGER PRIMARY KEY, uuid TEXT NOT NULL UNIQUE, version TEXT NOT NULL)')
+            db.execute('CREATE TABLE entity ('
+                       'bundle INTEGER NOT NULL, document_id BLOB NOT NULL, schema_name TEXT NOT NULL, '
+                       'PRIMARY KEY (bundle, document_id)) WITHOUT ROWID')
+            db.execute('CREATE INDEX entity_schema_name ON entity (schema_name)')
+            db.execute('CREATE TABLE link ('
+                       'bundle INTEGER NOT NULL, source_id BLOB NOT NULL, destination_id BLOB NOT NULL, '
+                       'PRIMARY KEY (bundle, source_id, destination_id)) WITHOUT ROWID')
+            db.execute('CREATE INDEX link_destination ON link (bundle, destination_id)')
+            db.execute('CREATE TABLE entity_value ('
+                       'bundle INTEGER NOT NULL, document_id BLOB NOT NULL, field TEXT NOT NULL, value, '
+                       'PRIMARY KEY (bundle, document_id, field, value)) WITHOUT ROWID')
+            db.execute('CREATE INDEX entity_value_field_value ON entity_value (field, value)')
+            for table in _tables:
+                columns = ''.join(f', {column}' for column in table.columns)
+                db.execute(f'CREATE TABLE {table.name} ('
+                           f'bundle INTEGER NOT NULL, document_id BLOB NOT NULL{columns}, '
+                           f'PRIMARY KEY (bundle, document_id)) WITHOUT ROWID')
+                db.execute(f'CREATE INDEX {table.name}_document_id ON {table.name} (document_id)')
+                for column in table.columns:
+                    if column in _indexed_columns:
+                        db.execute(f'CREATE INDEX {table.name}_{column} ON {table.name} ({column})')
+            db.execute(f'PRAGMA user_version = {_schema_version}')
+
+    def __len__(self) -> int:
+        count, = self.connection.execute('SELECT count(*) FROM bundle').fetchone()
+        return count
+
+    def __contains__(self, fqid: str) -> bool:
+        return self.version(fqid.partition('.')[0]) == fqid.partition('.')[2]
+
+    def version(self, uuid: str) -> Optional[str]:
+        """
+        Return the indexed version of the bundle with the given UUID, or None if the bundle is not indexed.
+        """
+        row = self.connection.execute('SELECT version FROM bundle WHERE uuid = ?', (uuid,)).fetchone()
+        return None if row is None else row[0]
+
+    def bundles(self) -> Iterator[Tuple[str, str]]:
+        """
+        Yield the UUID and version of every bundle in this index.
+        """
+        yield from self.connection.execute('SELECT uuid, version FROM bundle ORDER BY uuid')
+
+    def add(self, bundle: Bundle) -> bool:
+        """
+        Add the given bundle to this index, replacing any older version of the bundle. Return True if the index was
+        modified, or False if it already contained the same or a newer version of the bundle.
+        """
+        with self.connection:
+            return self._add(bundle)
+
+    def update(self, bundles: Iterable[Bundle]) -> int:
+        """
+        Add the given bundles to this index in a single transaction and return the number of bundles that modified
+        the index. See add() for details.
+        """
+        with self.connection:
+            return sum(map(self._add, bundles))
+
+    def remove(self, uuid: str) -> bool:
+        """
+        Remove the bundle with the given UUID from this index. Return True if the bundle was indexed.
+        """
+        with self.connection:
+            row = self.connection.execute('SELECT id FROM bundle WHERE uuid = ?', (uuid,)).fetchone()
+            if row is None:
+                return False
+            else:
+                self._delete_rows(row[0])
+                self.connection.execute('DELETE FROM bundle WHERE id = ?', row)
+                return True
+
+    def _add(self, bundle: Bundle) -> bool:
+        db = self.connection
+        uuid = str(bundle.uuid)
+        row = db.execute('SELECT id, version FROM bundle WHERE uuid = ?', (uuid,)).fetchone()
+        if row is None:
+            bundle_id = db.execute('INSERT INTO bundle (uuid, version) VALUES (?, ?)', (uuid, bundle.version)).lastrowid
+        else:
+            bundle_id, version = row
+            if version >= bundle.version:
+                return False
+            self._delete_rows(bundle_id)
+            db.execute('UPDATE bundle SET version = ? WHERE id = ?', (bundle.version, bundle_id))
+        db.executemany('INSERT INTO entity VALUES (?, ?, ?)',
+                       ((bundle_id, entity.document_id.bytes, entity.schema_name)
+                        for entity in bundle.entities.values()))
+        db.executemany('INSERT OR IGNORE INTO link VALUES (?, ?, ?)',
+                       ((bundle_id, link.source_id.bytes, link.destination_id.bytes) for link in bundle.links))
+        entities_by_table = {table: [] for table in _tables}
+        for entity in bundle.entities.values():
+            for entity_type in type(entity).__mro__:
+                table = _tables_by_type.get(entity_type)
+                if table is not None:
+                    entities_by_table[table].append(entity)
+                    break
+        for table, entities in entities_by_table.items():
+            if entities:
+                placeholders = ', '.join('?' * (2 + len(table.columns)))
+                db.executemany(f'INSERT INTO {table.name} VALUES ({placeholders})',
+                               ((bundle_id, entity.document_id.bytes, *(_value(getter(entity))
+                                                                        for getter in table.getters))
+                                for entity in entities))
+                db.executemany('INSERT OR IGNORE INTO entity_value VALUES (?, ?, ?, ?)',
+                               ((bundle_id, entity.document_id.bytes, field_name, value)
+                                for entity in entities
+                                for field_name in table.set_fields
+                                for value in getattr(entity, field_name)))
+        return True
+
+    def _delete_rows(self, bundle_id: int) -> None:
+        for table_name in ('entity', 'link', 'entity_value', *_tables_by_name.keys()):
+            self.connection.execute(f'DELETE FROM {table_name} WHERE bundle = ?', (bundle_id,))
+
+    def find(self,
+             schema_name: str,
+             criteria: Optional[Mapping[str, Any]] = None,
+             ancestors: Optional[Mapping[str, Mapping[str, Any]]] = None) -> List[Hit]:
+        """
+        Return the bundle FQID and document ID of every indexed entity of the given type that matches the given
+        criteria and is linked to matching ancestors. The result is ordered by bundle UUID and document ID.
+
+        :param schema_name: the schema name of the type of entities to return, e.g. `sequence_file`. Entities of
+                            types without a table in the index can be found, but not filtered by field.
+
+        :param criteria: maps the name of an indexed field of the entity type to the value that field must have. A
+                         list, tuple or set of values matches any of the values. A set-valued field matches if the
+                         set contains the value or any of the values.
+
+        :param ancestors: maps schema names to criteria as described above. An entity matches only if, for each of
+                          the given schema names, it is the same as or descends from an entity of that type that
+                          matches the respective criteria, by following links in the same bundle from source to
+                          destination.
+        """
+        params = []
+        ctes = []
+        for i, (ancestor_schema_name, ancestor_criteria) in enumerate((ancestors or {}).items()):
+            condition = self._condition(ancestor_schema_name, 't', ancestor_criteria, params)
+            ctes.append(f'a{i} (bundle, document_id) AS ('
+                        f'SELECT t.bundle, t.document_id FROM {self._from(ancestor_schema_name)} AS t '
+                        f'WHERE {condition} '
+                        f'UNION '
+                        f'SELECT l.bundle, l.destination_id FROM link AS l JOIN a{i} '
+                        f'ON l.bundle = a{i}.bundle AND l.source_id = a{i}.document_id)')
+        conditions = [self._condition(schema_name, 't', criteria or {}, params)]
+        conditions.extend(f'(t.bundle, t.document_id) IN (SELECT bundle, document_id FROM a{i})'
+                          for i in range(len(ctes)))
+        sql = ''.join([
+            f'WITH RECURSIVE {", ".join(ctes)} ' if ctes else '',
+            f'SELECT b.uuid, b.version, t.document_id FROM {self._from(schema_name)} AS t ',
+            'JOIN bundle AS b ON b.id = t.bundle ',
+            f'WHERE {" AND ".join(conditions)} ',
+            'ORDER BY b.uuid, t.document_id'
+        ])
+        return [(f'{uuid}.{version}', UUID(bytes=document_id))
+                for uuid, version, document_id in self.connection.execute(sql, params)]
+
+    def _from(self, schema_name: str) -> str:
+        return schema_name if schema_name in _tables_by_name else 'entity'
+
+    def _condition(self, schema_name: str, alias: str, criteria: Mapping[str, Any], params: List[Any]) -> str:
+        table = _tables_by_name.get(schema_name)
+        if table is None:
+            if criteria:
+                raise ValueError('Entities of this type can only be found by type', schema_name)
+            params.append(schema_name)
+            return f'{alias}.schema_name = ?'
+        conditions = ['1']
+        for field_name, values in criteria.items():
+            values = list(values) if isinstance(values, (list, tuple, set, frozenset)) else [values]
+            values = list(map(_value, values))
+            placeholders = ', '.join('?' * len(values))
+            if field_name in table.columns:
+                conditions.append(f'{alias}.{field_name} IN ({placeholders})')
+                params.extend(values)
+            elif field_name in table.set_fields:
+                conditions.append(f'EXISTS (SELECT 1 FROM entity_value AS v '
+                                  f'WHERE v.bundle = {alias}.bundle AND v.document_id = {alias}.document_id '
+                                  f'AND v.field = ? AND v.value IN ({placeholders}))')
+                params.append(field_name)
+                params.extend(values)
+            else:
+                raise ValueError('Not an indexed field', schema_name, field_name)
+        return ' AND '.join(conditions)
+
+
+def _value(value: Any) -> Any:
+    return str(value) if isinstance(value, UUID) else value
@@ -0,0 +1,349 @@
+"""
+An inverted index from the document ID of each entity, and the UUID of each data file, to the FQIDs of the bundles
+containing that entity or file. Entities like projects and donors are shared by many bundles, so when a document
+changes, the index tells which bundles need to be indexed again.
+
+The index is built in memory by an InvertedIndexBuilder as bundles are processed, and written to a compact file that
+InvertedIndex reads through a memory map. Index files built by separate workers can be merged with merge().
+
+>>> import tempfile
+>>> from humancellatlas.data.metadata.helpers.synthetic import SyntheticCorpus
+>>> builder = InvertedIndexBuilder()
+>>> for uuid, version, manifest, metadata_files in SyntheticCorpus(3, seed=8):
+...     bundle = Bundle(uuid, version, manifest, metadata_files)
+...     builder.add(bundle)
+>>> project_id = next(iter(bundle.projects))
+>>> with tempfile.TemporaryDirectory() as d:
+...     builder.write(os.path.join(d, 'index'))
+...     with InvertedIndex(os.path.join(d, 'index')) as index:
+...         project_id in index, index.bundles(project_id) == [f'{bundle.uuid}.{bundle.version}']
+(True, True)
+"""
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from typing import (
+    BinaryIO,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Tuple,
+    Union,
+)
+from uuid import UUID
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    UUID4,
+)
+
+_MAGIC = b'HCAI'
+
+_FORMAT_VERSION = 1
+
+# magic, format version, flags, number of bundles, number of keys, then the size of the FQID table and the postings
+#
+_header = struct.Struct('<4sHHIIQQ')
+
+_offset_size = 8
+
+_key_size = 16
+
+Key = Union[UUID4, str, bytes]
+
+
+def _key(key: Key) -> bytes:
+    if isinstance(key, UUID):
+        return key.bytes
+    elif isinstance(key, str):
+        return UUID(key).bytes
+    else:
+        return key
+
+
+class InvertedIndexBuilder:
+    """
+    Accumulates an inverted index in memory.
+    """
+
+    def __init__(self) -> None:
+        self.fqids: List[str] = []
+        self._ordinals: MutableMapping[str, int] = {}
+        self._postings: MutableMapping[bytes, array] = {}
+
+    def __len__(self) -> int:
+        return len(self._postings)
+
+    def add(self, bundle: Bundle) -> None:
+        """
+        Add the document ID of every entity in the given bundle and the UUID of every data file described by a File
+        entity in that bundle.
+        """
+        keys = [document_id.bytes for document_id in bundle.entities.keys()]
+        keys.extend(file.manifest_entry.uuid.bytes for file in bundle.files.values())
+        self.add_keys(f'{bundle.uuid}.{bundle.version}', keys)
+
+    def add_keys(self, fqid: str, keys: Iterable[Key]) -> None:
+        """
+        Add the given keys for the bundle with the given FQID.
+        """
+        try:
+            ordinal = self._ordinals[fqid]
+        except KeyError:
+            ordinal = self._ordinals[fqid] = len(self.fqids)
+            self.fqids.append(fqid)
+        postings = self._postings
+        for key in map(_key, keys):
+            try:
+                ordinals = postings[key]
+            except KeyError:
+                postings[key] = array('L', [ordinal])
+            else:
+                if ordinals[-1] != ordinal:
+                    ordinals.append(ordinal)
+
+    def write(self, path: str) -> None:
+        """
+        Atomically write the index to the file at the given path, replacing any existing file.
+        """
+        ordinals = sorted(range(len(self.fqids)), key=self.fqids.__getitem__)
+        fqids = [self.fqids[ordinal] for ordinal in ordinals]
+        new_ordinals = array('L', bytes(array('L').itemsize * len(ordinals)))
+        for new_ordinal, ordinal in enumerate(ordinals):
+            new_ordinals[ordinal] = new_ordinal
+        with _IndexWriter(path, fqids) as writer:
+            for key in sorted(self._postings.keys()):
+                writer.add(key, sorted(set(new_ordinals[ordinal] for ordinal in self._postings[key])))
+
+
+class InvertedIndex:
+    """
+    A read-only inverted index file written by InvertedIndexBuilder.write() or merge().
+
+    The file starts with a fixed-size header, followed by the newline-separated FQIDs of the indexed bundles in
+    ascending order, the postings, the sorted keys (16 bytes each) and the offset of each key's postings. The postings
+    of a key are the ordinals of the bundles containing that key, in ascending order and encoded as variable-length
+    differences. A lookup is a binary search on the memory-mapped keys.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = self._mmap
+        magic, version, _, num_bundles, self._num_keys, fqids_size, postings_size = _header.unpack_from(buf)
+        if magic != _MAGIC or version != _FORMAT_VERSION:
+            raise RuntimeError(f"Not an inverted index file or unsupported format version: '{path}'")
+        start = _header.size
+        self.fqids: List[str] = buf[start:start + fqids_size].decode().split('\n') if num_bundles else []
+        assert len(self.fqids) == num_bundles
+        self._postings_start = start + fqids_size
+        self._keys_start = self._postings_start + postings_size
+        self._offsets_start = self._keys_start + _key_size * self._num_keys
+        self._keys = _Keys(buf, self._keys_start, self._num_keys)
+
+    def __enter__(self) -> 'InvertedIndex':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __len__(self) -> int:
+        return self._num_keys
+
+    def __contains__(self, key: Key) -> bool:
+        return self._find(_key(key)) is not None
+
+    def __iter__(self) -> Iterator[UUID4]:
+        """
+        Iterate over the keys in this index, in ascending order of their byte representation.
+        """
+        return (UUID(bytes=key) for key in self._keys)
+
+    def bundles(self, key: Key) -> List[str]:
+        """
+        Return the FQIDs of the bundles containing the given document ID or data file UUID, in ascending order. Return
+        an empty list if no indexed bundle contains the key.
+        """
+        fqids = self.fqids
+        return [fqids[ordinal] for ordinal in self.ordinals(key)]
+
+    def ordinals(self, key: Key) -> List[int]:
+        """
+        Return the positions in `fqids` of the bundles containing the given key.
+        """
+        i = self._find(_key(key))
+        return [] if i is None else list(self._postings(i))
+
+    def items(self) -> Iterator[Tuple[bytes, List[int]]]:
+        """
+        Yield the byte representation and the ordinals of every key in this index, in ascending order of the key.
+        """
+        for i, key in enumerate(self._keys):
+            yield key, list(self._postings(i))
+
+    def _find(self, key: bytes):
+        i = bisect_left(self._keys, key)
+        return i if i < self._num_keys and self._keys[i] == key else None
+
+    def _postings(self, i: int) -> Iterator[int]:
+        start, end = struct.unpack_from('<QQ', self._mmap, self._offsets_start + i * _offset_size)
+        return _decode(self._mmap, self._postings_start + start, self._postings_start + end)
+
+
+class _Keys(Sequence):
+    """
+    The memory-mapped array of keys in an index file, as a sequence for bisect
+    """
+
+    def __init__(self, buf: mmap.mmap, start: int, length: int) -> None:
+        self._buf = buf
+        self._start = start
+        self._length = length
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __getitem__(self, i: int) -> bytes:
+        if not 0 <= i < self._length:
+            raise IndexError(i)
+        start = self._start + i * _key_size
+        return self._buf[start:start + _key_size]
+
+
+def merge(paths: Iterable[str], path: str) -> None:
+    """
+    Merge the index files at the given paths, typically shards built by separate workers, into a single index file
+    at the given path. The input files are read sequentially and only the keys and offsets of the output are held in
+    memory.
+    """
+    indices = [InvertedIndex(p) for p in paths]
+    try:
+        fqids = sorted(set(fqid for index in indices for fqid in index.fqids))
+        ordinals = {fqid: i for i, fqid in enumerate(fqids)}
+        mappings = [[ordinals[fqid] for fqid in index.fqids] for index in indices]
+        with _IndexWriter(path, fqids) as writer:
+
+            def index_entries(i: int, index: InvertedIndex):
+                for key, postings in index.items():
+                    yield key, i, postings
+
+            entries = heapq.merge(*(index_entries(i, index) for i, index in enumerate(indices)))
+            current_key, current_postings = None, set()
+            for key, i, postings in entries:
+                if key != current_key:
+                    if current_key is not None:
+                        writer.add(current_key, sorted(current_postings))
+                    current_key, current_postings = key, set()
+                mapping = mappings[i]
+                current_postings.update(mapping[ordinal] for ordinal in postings)
+            if current_key is not None:
+                writer.add(current_key, sorted(current_postings))
+    finally:
+        for index in indices:
+            index.close()
+
+
+class _IndexWriter:
+    """
+    Writes an index file from keys added in ascending order.
+    """
+
+    def __init__(self, path: str, fqids: List[str]) -> None:
+        assert all('\n' not in fqid for fqid in fqids)
+        self.path = path
+        self.num_bundles = len(fqids)
+        self.keys = bytearray()
+        self.offsets = array('Q', [0])
+        dir_path = os.path.dirname(os.path.abspath(path))
+        self.file: BinaryIO = tempfile.NamedTemporaryFile('wb', dir=dir_path, delete=False)
+        self.file.write(bytes(_header.size))
+        fqids = '\n'.join(fqids).encode()
+        self.fqids_size = len(fqids)
+        self.file.write(fqids)
+        self.postings = bytearray()
+        self.flushed = 0
+        self.last_key = None
+
+    def __enter__(self) -> '_IndexWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is None:
+            self._finish()
+        else:
+            self.file.close()
+            os.unlink(self.file.name)
+
+    def add(self, key: bytes, ordinals: List[int]) -> None:
+        assert len(key) == _key_size and (self.last_key is None or key > self.last_key)
+        self.last_key = key
+        self.keys += key
+        _encode(ordinals, self.postings)
+        self.offsets.append(self.flushed + len(self.postings))
+        if len(self.postings) > 1024 * 1024:
+            self._flush()
+
+    def _flush(self) -> None:
+        self.file.write(self.postings)
+        self.flushed += len(self.postings)
+        self.postings = bytearray()
+
+    def _finish(self) -> None:
+        self._flush()
+        num_keys = len(self.keys) // _key_size
+        self.file.write(self.keys)
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        self.file.write(self.offsets.tobytes())
+        self.file.seek(0)
+        self.file.write(_header.pack(_MAGIC, _FORMAT_VERSION, 0, self.num_bundles, num_keys,
+                                     self.fqids_size, self.flushed))
+        self.file.close()
+        os.replace(self.file.name, self.path)
+
+
+def _encode(ordinals: List[int], buf: bytearray) -> None:
+    """
+    Append the given ascending integers to the given buffer as variable-length encoded differences.
+
+    >>> buf = bytearray()
+    >>> _encode([3, 130, 20000], buf)
+    >>> bytes(buf)
+    b'\\x03\\x7f\\x9e\\x9b\\x01'
+    >>> list(_decode(buf, 0, len(buf)))
+    [3, 130, 20000]
+    """
+    previous = 0
+    for ordinal in ordinals:
+        delta = ordinal - previous
+        previous = ordinal
+        while delta >= 0x80:
+            buf.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        buf.append(delta)
+
+
+def _decode(buf, start: int, end: int) -> Iterator[int]:
+    value = 0
+    shift = 0
+    previous = 0
+    for byte in buf[start:end]:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += value
+            yield previous
+            value = 0
+            shift = 0
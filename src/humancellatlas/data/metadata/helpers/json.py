@@ -1,4 +1,5 @@
 import copy
+from typing import Optional
 from uuid import UUID
 
 from dataclasses import (
@@ -8,10 +9,17 @@ from dataclasses import (
 )
 
 from humancellatlas.data.metadata.api import Entity
+from humancellatlas.data.metadata.instrumentation import (
+    Instrument,
+    timed,
+)
 
 
-def as_json(obj, fld: field = None):
-    if is_dataclass(obj):
+def as_json(obj, fld: field = None, instrument: Optional[Instrument] = None):
+    if instrument is not None:
+        with timed(instrument, 'as_json'):
+            return as_json(obj, fld)
+    elif is_dataclass(obj):
         d = {f.name: as_json(getattr(obj, f.name), f) for f in fields(obj) if f.repr}
         if isinstance(obj, Entity):
             d['schema_name'] = obj.schema_name
@@ -0,0 +1,238 @@
+import json
+import logging
+import mmap
+import os
+import struct
+from threading import RLock
+from typing import (
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    JSON,
+)
+from humancellatlas.data.metadata.helpers.compression import (
+    Codec,
+    is_compressed,
+)
+from humancellatlas.data.metadata.helpers.decoder import decode_json
+from humancellatlas.data.metadata.instrumentation import (
+    Instrument,
+    timed,
+)
+
+logger = logging.getLogger(__name__)
+
+# Each record in a pack file starts with this magic and the length of the record's payload
+#
+_record_header = struct.Struct('<4sI')
+
+_MAGIC = b'HCAP'
+
+
+class BundlePack:
+    """
+    An append-only file containing the manifest and metadata files of many bundles, with an index from bundle FQID
+    (`uuid.version`) to the position of the bundle's record in the pack file. Records are read through a memory map
+    so looking up a bundle costs one dictionary lookup and no system calls.
+
+    The index is kept in a second file next to the pack file. It is appended to with every record written and
+    rebuilt from the pack file if it is missing or incomplete. A pack must only be written to by one process at a
+    time but any number of threads in that process may read from and write to it concurrently.
+
+    If a codec is given, records are compressed when they are written. A pack may contain both compressed and
+    uncompressed records. Reading compressed records requires a codec with the same dictionary, if any, as the one
+    they were written with.
+
+    >>> import tempfile
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     with BundlePack(os.path.join(d, 'bundles.pack')) as pack:
+    ...         pack.put('b2216048-7eaa-45f4-8077-5a3fb4204953', '1', [], {'links.json': {'links': []}})
+    ...         pack.get('b2216048-7eaa-45f4-8077-5a3fb4204953', '1')
+    ...     with BundlePack(os.path.join(d, 'bundles.pack')) as pack:
+    ...         list(pack)
+    ([], {'links.json': {'links': []}})
+    ['b2216048-7eaa-45f4-8077-5a3fb4204953.1']
+
+    >>> with tempfile.TemporaryDirectory() as d:
+    ...     with BundlePack(os.path.join(d, 'bundles.pack')) as pack:
+    ...         pack.get('b2216048-7eaa-45f4-8077-5a3fb4204953', '1')
+    Traceback (most recent call last):
+    ...
+    KeyError: 'b2216048-7eaa-45f4-8077-5a3fb4204953.1'
+    """
+
+    def __init__(self, path: str, codec: Optional[Codec] = None, instrument: Optional[Instrument] = None) -> None:
+        """
+        :param path: the path of the pack file
+
+        :param codec: an optional codec to compress the records written to the pack with, and to decompress
+                      compressed records with. See humancellatlas.data.metadata.helpers.compression.
+
+        :param instrument: an optional instrument to report the time spent compressing records to, as the `compress`
+                           stage with the uncompressed size, and the size of each record written, as the `disk`
+                           stage
+        """
+        self.path = path
+        self.codec = codec
+        self.instrument = instrument
+        self.index_path = path + '.idx'
+        self._lock = RLock()
+        self._index: MutableMapping[str, Tuple[int, int]] = {}
+        self._file = open(path, 'a+b')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._mmap: Optional[mmap.mmap] = None
+        indexed_size = self._read_index()
+        if indexed_size < self._size:
+            self._scan(indexed_size)
+        self._index_file = open(self.index_path, 'a')
+
+    def __enter__(self) -> 'BundlePack':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            self._file.close()
+            self._index_file.close()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self) -> Iterator[str]:
+        """
+        Iterate over the FQIDs of the bundles in this pack, in the order in which they were added.
+        """
+        return iter(list(self._index.keys()))
+
+    def __contains__(self, fqid: str) -> bool:
+        return fqid in self._index
+
+    @property
+    def size(self) -> int:
+        """
+        The size of the pack file in bytes
+        """
+        return self._size
+
+    def versions(self, uuid: str) -> List[str]:
+        """
+        Return the versions of the bundle with the given UUID in this pack, in ascending order.
+        """
+        prefix = uuid + '.'
+        return sorted(fqid[len(prefix):] for fqid in self._index.keys() if fqid.startswith(prefix))
+
+    def put(self, uuid: str, version: str, manifest: List[JSON], metadata_files: JSON) -> None:
+        """
+        Append the given bundle to this pack unless the pack already contains that bundle. Bundle versions are
+        immutable so an existing record is never replaced.
+        """
+        fqid = f'{uuid}.{version}'
+        payload = json.dumps(dict(uuid=uuid,
+                                  version=version,
+                                  manifest=manifest,
+                                  metadata_files=metadata_files),
+                             separators=(',', ':')).encode()
+        if self.codec is not None:
+            with timed(self.instrument, 'compress', count=1, size=len(payload)):
+                payload = self.codec.compress(payload)
+        with self._lock:
+            if fqid not in self._index:
+                offset = self._size + _record_header.size
+                self._file.write(_record_header.pack(_MAGIC, len(payload)))
+                self._file.write(payload)
+                self._file.flush()
+                self._size = offset + len(payload)
+                self._index[fqid] = offset, len(payload)
+                self._index_file.write(f'{fqid} {offset} {len(payload)}\n')
+                self._index_file.flush()
+                if self.instrument is not None:
+                    self.instrument.record('disk', 0.0, count=1, size=_record_header.size + len(payload))
+
+    def get(self, uuid: str, version: str) -> Tuple[List[JSON], JSON]:
+        """
+        Return the manifest and the metadata files of the given bundle, or raise KeyError if this pack does not
+        contain that bundle.
+        """
+        record = self._record(f'{uuid}.{version}')
+        return record['manifest'], record['metadata_files']
+
+    def bundle(self, uuid: str, version: str) -> Bundle:
+        """
+        Construct a Bundle object from the manifest and metadata files of the given bundle in this pack.
+        """
+        manifest, metadata_files = self.get(uuid, version)
+        return Bundle(uuid, version, manifest, metadata_files)
+
+    def _record(self, fqid: str) -> JSON:
+        offset, length = self._index[fqid]
+        with self._lock:
+            if self._mmap is None or len(self._mmap) < offset + length:
+                if self._mmap is not None:
+                    self._mmap.close()
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            payload = self._mmap[offset:offset + length]
+        return self._decode(payload)
+
+    def _decode(self, payload: bytes) -> JSON:
+        if is_compressed(payload):
+            payload = (self.codec or Codec()).decompress(payload)
+        return decode_json(payload)
+
+    def _read_index(self) -> int:
+        """
+        Load the index file and return the size of the prefix of the pack file covered by the index.
+        """
+        end = 0
+        try:
+            f = open(self.index_path)
+        except FileNotFoundError:
+            return end
+        with f:
+            for line in f:
+                try:
+                    fqid, offset, length = line.split()
+                    offset, length = int(offset), int(length)
+                except ValueError:
+                    logger.warning("Ignoring truncated entry in index '%s'", self.index_path)
+                    break
+                if offset + length > self._size:
+                    break
+                self._index[fqid] = offset, length
+                end = max(end, offset + length)
+        return end
+
+    def _scan(self, start: int) -> None:
+        """
+        Add the records following the given position in the pack file to the index.
+        """
+        logger.info("Indexing pack file '%s' from position %i", self.path, start)
+        offset = start
+        with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            while offset + _record_header.size <= self._size:
+                magic, length = _record_header.unpack_from(buf, offset)
+                if magic != _MAGIC:
+                    raise RuntimeError(f"Corrupt pack file '{self.path}' at position {offset}")
+                start = offset + _record_header.size
+                if start + length > self._size:
+                    break
+                record = self._decode(buf[start:start + length])
+                self._index[f"{record['uuid']}.{record['version']}"] = start, length
+                offset = start + length
+        if offset < self._size:
+            logger.warning("Truncating incomplete record at end of pack file '%s'", self.path)
+            self._file.truncate(offset)
+            self._size = offset
+        with open(self.index_path, 'w') as f:
+            for fqid, (offset, length) in self._index.items():
+                f.write(f'{fqid} {offset} {length}\n')
@@ -0,0 +1,388 @@
+"""
+A pipeline runner that overlaps the downloading, construction, serialization and storage of many bundles.
+
+Each stage of a pipeline has its own pool of workers and a bounded input queue. A worker takes an item from its
+stage's queue, applies the stage's function to it and puts the result into the queue of the next stage. When a queue
+is full, the workers of the preceding stage block until there is room again. This backpressure bounds the number of
+items in flight, and with it the memory used by the pipeline, regardless of the relative speed of the stages.
+
+>>> pipeline = Pipeline([Stage('square', lambda x: x * x, workers=2), Stage('negate', lambda x: -x)])
+>>> sorted(pipeline.run(range(5)))
+[-16, -9, -4, -1, 0]
+>>> [(m.name, m.items_in, m.items_out, m.errors) for m in pipeline.metrics]
+[('square', 5, 5, 0), ('negate', 5, 5, 0)]
+"""
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import logging
+from queue import (
+    Empty,
+    Full,
+    Queue,
+)
+from threading import (
+    Event,
+    Lock,
+    Thread,
+)
+import time
+from typing import (
+    Any,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from dataclasses import (
+    dataclass,
+    field,
+)
+from hca.dss import DSSClient
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    JSON,
+)
+from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+from humancellatlas.data.metadata.helpers.json import as_json
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Stage:
+    """
+    A stage of a pipeline
+    """
+    #: The name of the stage, used in metrics and log messages
+    name: str
+
+    #: The function to apply to every item passing through the stage
+    function: Callable[[Any], Any]
+
+    #: The number of items the stage processes concurrently
+    workers: int = 1
+
+    #: If True, the function is run in a pool of `workers` processes instead of in the threads of the pipeline. Use
+    #: processes for CPU-bound stages. The function, its argument and its result must be picklable.
+    processes: bool = False
+
+    #: The maximum number of items waiting in the stage's input queue. If None, it is twice the number of workers.
+    queue_size: Optional[int] = None
+
+
+@dataclass
+class StageMetrics:
+    """
+    Metrics for a stage of a pipeline. Read them while or after the pipeline is running.
+    """
+    name: str
+    workers: int
+    queue_size: int
+
+    #: The number of items taken from the input queue
+    items_in: int = 0
+
+    #: The number of items passed on to the next stage
+    items_out: int = 0
+
+    #: The number of items for which the stage's function raised an exception
+    errors: int = 0
+
+    #: The total time, across all workers, spent in the stage's function
+    busy_seconds: float = 0.0
+
+    #: The largest number of items observed in the input queue
+    max_queue_depth: int = 0
+
+    start: Optional[float] = field(default=None, repr=False)
+    end: Optional[float] = field(default=None, repr=False)
+    queue: Optional[Queue] = field(default=None, repr=False)
+    lock: Lock = field(default_factory=Lock, repr=False)
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        The current number of items in the input queue
+        """
+        return 0 if self.queue is None else self.queue.qsize()
+
+    @property
+    def elapsed_seconds(self) -> float:
+        """
+        The wall clock time since the stage's first worker started, up to when its last worker finished
+        """
+        if self.start is None:
+            return 0.0
+        else:
+            return (time.perf_counter() if self.end is None else self.end) - self.start
+
+    @property
+    def throughput(self) -> float:
+        """
+        The number of items passed on to the next stage per second of elapsed time
+        """
+        elapsed = self.elapsed_seconds
+        return self.items_out / elapsed if elapsed else 0.0
+
+    @property
+    def utilization(self) -> float:
+        """
+        The fraction of the elapsed time that the workers spent in the stage's function
+        """
+        elapsed = self.elapsed_seconds
+        return self.busy_seconds / (elapsed * self.workers) if elapsed else 0.0
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages. See the module documentation for details.
+
+    An item for which a stage's function raises an exception is dropped from the pipeline. The exception is logged
+    and recorded in `errors` together with the name of the stage and the item.
+
+    A pipeline can be run more than once, but not concurrently. Every run starts with fresh `metrics` and `errors`.
+    """
+
+    def __init__(self, stages: Sequence[Stage]) -> None:
+        if not stages:
+            raise ValueError('A pipeline needs at least one stage')
+        self.stages = list(stages)
+        self.metrics = self._new_metrics()
+        self.errors: List[Tuple[str, Any, BaseException]] = []
+        self._errors_lock = Lock()
+        self._stopped = Event()
+
+    def run(self, items: Iterable[Any]) -> Iterator[Any]:
+        """
+        Run the given items through the pipeline, yielding the result of the last stage for each item in the order of
+        completion. Closing the returned iterator before it is exhausted stops the pipeline.
+        """
+        self._stopped.clear()
+        self.metrics = self._new_metrics()
+        self.errors = []
+        queues = [Queue(metrics.queue_size) for metrics in self.metrics]
+        output = Queue(self.metrics[-1].queue_size)
+        for metrics, queue in zip(self.metrics, queues):
+            metrics.queue = queue
+        executors = [ProcessPoolExecutor(stage.workers) if stage.processes else None for stage in self.stages]
+        threads = [Thread(target=self._feed, args=(items, queues[0]), name='pipeline-feed', daemon=True)]
+        for i, (stage, metrics, executor) in enumerate(zip(self.stages, self.metrics, executors)):
+            next_queue = output if i + 1 == len(self.stages) else queues[i + 1]
+            num_next_workers = 1 if i + 1 == len(self.stages) else self.stages[i + 1].workers
+            remaining = [stage.workers]
+            for j in range(stage.workers):
+                threads.append(Thread(target=self._work,
+                                      args=(stage, metrics, executor, queues[i], next_queue, remaining,
+                                            num_next_workers),
+                                      name=f'pipeline-{stage.name}-{j}',
+                                      daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                result = self._get(output)
+                if result is _end:
+                    break
+                yield result
+        finally:
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+            for executor in executors:
+                if executor is not None:
+                    executor.shutdown()
+            for metrics in self.metrics:
+                metrics.queue = None
+
+    def _new_metrics(self) -> List[StageMetrics]:
+        return [StageMetrics(name=stage.name,
+                             workers=stage.workers,
+                             queue_size=stage.queue_size or 2 * stage.workers)
+                for stage in self.stages]
+
+    def _feed(self, items: Iterable[Any], queue: Queue) -> None:
+        try:
+            for item in items:
+                self._put(queue, item)
+        except _Stopped:
+            return
+        except BaseException as e:
+            logger.exception('Failed to read the items to feed into the pipeline')
+            self._record_error('feed', None, e)
+        try:
+            for _ in range(self.stages[0].workers):
+                self._put(queue, _end)
+        except _Stopped:
+            pass
+
+    def _work(self, stage: Stage, metrics: StageMetrics, executor: Optional[ProcessPoolExecutor],
+              queue: Queue, next_queue: Queue, remaining: List[int], num_next_workers: int) -> None:
+        with metrics.lock:
+            if metrics.start is None:
+                metrics.start = time.perf_counter()
+        try:
+            try:
+                while True:
+                    with metrics.lock:
+                        metrics.max_queue_depth = max(metrics.max_queue_depth, queue.qsize())
+                    item = self._get(queue)
+                    if item is _end:
+                        break
+                    with metrics.lock:
+                        metrics.items_in += 1
+                    start = time.perf_counter()
+                    try:
+                        if executor is None:
+                            result = stage.function(item)
+                        else:
+                            result = executor.submit(stage.function, item).result()
+                    except Exception as e:
+                        logger.warning('Stage %s failed on item %r', stage.name, item, exc_info=True)
+                        self._record_error(stage.name, item, e)
+                        with metrics.lock:
+                            metrics.errors += 1
+                            metrics.busy_seconds += time.perf_counter() - start
+                    else:
+                        with metrics.lock:
+                            metrics.busy_seconds += time.perf_counter() - start
+                        self._put(next_queue, result)
+                        with metrics.lock:
+                            metrics.items_out += 1
+            finally:
+                # Even if the worker dies, the next stage must learn when the last worker of this one is done
+                with metrics.lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                    if last:
+                        metrics.end = time.perf_counter()
+                if last:
+                    for _ in range(num_next_workers):
+                        self._put(next_queue, _end)
+        except _Stopped:
+            pass
+
+    def _record_error(self, stage_name: str, item: Any, e: BaseException) -> None:
+        with self._errors_lock:
+            self.errors.append((stage_name, item, e))
+
+    def _put(self, queue: Queue, item: Any) -> None:
+        while True:
+            try:
+                queue.put(item, timeout=_poll_interval)
+            except Full:
+                if self._stopped.is_set():
+                    raise _Stopped()
+            else:
+                return
+
+    def _get(self, queue: Queue) -> Any:
+        while True:
+            try:
+                return queue.get(timeout=_poll_interval)
+            except Empty:
+                if self._stopped.is_set():
+                    raise _Stopped()
+
+    def __str__(self) -> str:
+        lines = [f"{'stage':<16} {'workers':>7} {'in':>8} {'out':>8} {'errors':>6} {'items/s':>9} {'util':>5} "
+                 f"{'queue':>5} {'max':>5}"]
+        for m in self.metrics:
+            lines.append(f'{m.name:<16} {m.workers:>7} {m.items_in:>8} {m.items_out:>8} {m.errors:>6} '
+                         f'{m.throughput:>9.2f} {m.utilization:>5.0%} {m.queue_depth:>5} {m.max_queue_depth:>5}')
+        return '\n'.join(lines)
+
+
+_poll_interval = 0.1
+
+# Marks the end of the items in a queue
+#
+_end = object()
+
+
+class _Stopped(Exception):
+    pass
+
+
+def bundle_pipeline(client: DSSClient,
+                    replica: str,
+                    sink: Callable[[str, str, JSON], Any],
+                    download_workers: int = 8,
+                    construct_workers: int = 1,
+                    serialize_workers: int = 1,
+                    sink_workers: int = 1,
+                    processes: bool = False,
+                    queue_size: Optional[int] = None,
+                    **download_kwargs) -> Pipeline:
+    """
+    Return a pipeline that downloads, constructs, serializes and stores bundles. Pass an iterable of (uuid, version)
+    tuples to the pipeline's run() method. The version may be None to process the latest version of a bundle.
+
+    :param client: the DSS client to download the bundles with
+
+    :param replica: the DSS replica to download the bundles from
+
+    :param sink: a callable that receives the UUID, version and the result of as_json() for every bundle. Its return
+                 value is yielded by the pipeline's run() method.
+
+    :param download_workers: the number of bundles to download concurrently. Each download uses the thread pool
+                             configured by the `num_workers` argument to download_bundle_metadata(), which defaults to 0
+                             here, in order to download the files of a bundle sequentially.
+
+    :param construct_workers: the number of bundles to construct concurrently
+
+    :param serialize_workers: the number of bundles to serialize concurrently
+
+    :param sink_workers: the number of threads invoking the sink concurrently
+
+    :param processes: if True, construction and serialization are run in a pool of `construct_workers` processes.
+                      This sidesteps the global interpreter lock but requires passing bundles between processes. To
+                      avoid pickling Bundle objects, the two steps are fused into a single `construct` stage whose
+                      workers return the serialized bundle, and `serialize_workers` is ignored.
+
+    :param queue_size: the size of the input queue of every stage, defaulting to twice the number of workers
+
+    :param download_kwargs: additional keyword arguments to download_bundle_metadata()
+    """
+    download_kwargs.setdefault('num_workers', 0)
+    stages = [Stage('download',
+                    partial(_download, client, replica, download_kwargs),
+                    workers=download_workers,
+                    queue_size=queue_size)]
+    if processes:
+        stages.append(Stage('construct', _construct_and_serialize, workers=construct_workers, processes=True,
+                            queue_size=queue_size))
+    else:
+        stages.append(Stage('construct', _construct, workers=construct_workers, queue_size=queue_size))
+        stages.append(Stage('serialize', _serialize, workers=serialize_workers, queue_size=queue_size))
+    stages.append(Stage('sink', partial(_sink, sink), workers=sink_workers, queue_size=queue_size))
+    return Pipeline(stages)
+
+
+def _download(client: DSSClient,
+              replica: str,
+              kwargs,
+              fqid: Tuple[str, Optional[str]]) -> Tuple[str, str, List[JSON], JSON]:
+    uuid, version = fqid
+    version, manifest, metadata_files = download_bundle_metadata(client, replica, uuid, version, **kwargs)
+    return uuid, version, manifest, metadata_files
+
+
+def _construct(args: Tuple[str, str, List[JSON], JSON]) -> Bundle:
+    return Bundle(*args)
+
+
+def _serialize(bundle: Bundle) -> Tuple[str, str, JSON]:
+    return str(bundle.uuid), bundle.version, as_json(bundle)
+
+
+def _construct_and_serialize(args: Tuple[str, str, List[JSON], JSON]) -> Tuple[str, str, JSON]:
+    return _serialize(_construct(args))
+
+
+def _sink(sink: Callable[[str, str, JSON], Any], args: Tuple[str, str, JSON]) -> Any:
+    return sink(*args)
@@ -0,0 +1,376 @@
+"""
+Retries with jittered exponential backoff, a retry budget and a circuit breaker, for requests to the DSS.
+
+Failures are classified by type. Each class has its own limit on the number of retries of a single call. Retries are
+additionally limited by a budget shared by all calls, so that a degraded DSS does not see its load multiplied by the
+retries of every worker. If too many consecutive calls fail, the circuit breaker opens and subsequent calls fail
+immediately with CircuitOpenError, without contacting the DSS, until a trial call succeeds.
+
+>>> attempts = []
+>>> def flaky():
+...     attempts.append(None)
+...     if len(attempts) < 3:
+...         raise ConnectionError('Connection reset')
+...     return 'ok'
+>>> delays = []
+>>> retrier = Retrier(sleep=delays.append, random=lambda: 0.5)
+>>> retrier.call(flaky), len(attempts), delays
+('ok', 3, [0.25, 0.5])
+>>> retrier.metrics()
+RetryMetrics(calls=1, attempts=3, retries={'connection': 2}, failures=0, budget_exhausted=0, circuit_opened=0, \
+circuit_rejected=0, circuit_open_seconds=0.0)
+"""
+from collections import Counter
+import logging
+import random as _random
+from threading import Lock
+import time
+from typing import (
+    Callable,
+    Mapping,
+    Optional,
+    TypeVar,
+)
+
+from dataclasses import (
+    dataclass,
+    field,
+)
+
+from humancellatlas.data.metadata.instrumentation import Instrument
+
+try:
+    from requests import exceptions as requests_exceptions
+except ImportError:  # pragma: no cover
+    requests_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# The default maximum number of retries of a single call, by failure class
+#
+default_max_retries = {
+    'connection': 5,  # the connection failed or was reset
+    'timeout': 3,  # no response within the timeout
+    'throttled': 8,  # the DSS asked us to back off (HTTP 429 or 503)
+    'server': 3  # any other server-side error (HTTP 500, 502 or 504)
+}
+
+
+def classify(e: BaseException) -> Optional[str]:
+    """
+    Return the failure class of the given exception, or None if a call failing with the exception should not be
+    retried, either because the failure is permanent, like a 404, or because it is not an I/O error.
+
+    >>> classify(TimeoutError()), classify(ConnectionResetError()), classify(KeyError())
+    ('timeout', 'connection', None)
+    """
+    if requests_exceptions is not None:
+        if isinstance(e, requests_exceptions.Timeout):
+            return 'timeout'
+        elif isinstance(e, (requests_exceptions.ConnectionError, requests_exceptions.ChunkedEncodingError)):
+            return 'connection'
+        elif isinstance(e, requests_exceptions.HTTPError):
+            status = None if e.response is None else e.response.status_code
+            if status in (429, 503):
+                return 'throttled'
+            elif status in (500, 502, 504):
+                return 'server'
+            else:
+                return None
+    if isinstance(e, TimeoutError):
+        return 'timeout'
+    elif isinstance(e, ConnectionError):
+        return 'connection'
+    else:
+        return None
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    """
+    The number of seconds the server asked us to wait in the Retry-After header of an error response, if any
+    """
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None)
+    try:
+        return float(headers['Retry-After'])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    How often and after what delay a failed call is retried. The delay before the n-th retry of a call is drawn
+    uniformly from the interval between zero and `base_delay * 2 ** (n - 1)`, but is at most `max_delay` (a.k.a. full
+    jitter). A delay requested by the server in a Retry-After header takes precedence, within the same limit.
+    """
+    max_retries: Mapping[str, int] = field(default_factory=lambda: dict(default_max_retries))
+    base_delay: float = 0.5
+    max_delay: float = 30.0
+    classify: Callable[[BaseException], Optional[str]] = classify
+
+    def delay(self, retry: int, random: float, retry_after: Optional[float] = None) -> float:
+        """
+        :param retry: the number of the retry, starting at 1
+
+        :param random: a random number between 0 and 1
+
+        :param retry_after: the delay requested by the server, if any
+
+        >>> policy = RetryPolicy(base_delay=1, max_delay=10)
+        >>> [policy.delay(n, 1.0) for n in range(1, 6)], policy.delay(1, 0.5, retry_after=3)
+        ([1.0, 2.0, 4.0, 8.0, 10.0], 3.0)
+        """
+        if retry_after is not None:
+            return float(min(retry_after, self.max_delay))
+        else:
+            return random * min(self.base_delay * 2 ** (retry - 1), self.max_delay)
+
+
+class RetryBudget:
+    """
+    A token bucket limiting the rate of retries relative to the rate of calls. Every call deposits `ratio` tokens and
+    every retry withdraws one, so in the long run at most `ratio` retries are made per call. The bucket holds at most
+    `capacity` tokens, which is also its initial content, allowing for bursts of retries after a quiet period.
+
+    >>> budget = RetryBudget(ratio=0.5, capacity=1)
+    >>> budget.withdraw(), budget.withdraw()
+    (True, False)
+    >>> budget.deposit(); budget.deposit()
+    >>> budget.withdraw()
+    True
+    """
+
+    def __init__(self, ratio: float = 0.2, capacity: float = 20.0) -> None:
+        self.ratio = ratio
+        self.capacity = capacity
+        self._tokens = capacity
+        self._lock = Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.capacity)
+
+    def withdraw(self) -> bool:
+        """
+        Take one token from the bucket and return True, or return False if the budget is exhausted.
+        """
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            else:
+                return False
+
+
+class CircuitOpenError(RuntimeError):
+
+    def __init__(self, seconds: float) -> None:
+        super().__init__(f'The DSS appears to be unhealthy. Not retrying for another {seconds:.1f}s.')
+        self.seconds = seconds
+
+
+class CircuitBreaker:
+    """
+    Fails calls fast while the remote service is unhealthy. The breaker opens after `failure_threshold` consecutive
+    failed calls. While it is open, calls are rejected. After `reset_timeout` seconds, the breaker lets a single trial
+    call through. If that call succeeds, the breaker closes again, otherwise it stays open for another period.
+
+    >>> now = [0.0]
+    >>> breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    >>> breaker.failure(); breaker.failure()
+    >>> breaker.allow()
+    False
+    >>> now[0] = 10
+    >>> breaker.allow(), breaker.allow()
+    (True, False)
+    >>> breaker.success()
+    >>> breaker.allow(), breaker.open_seconds
+    (True, 10.0)
+    """
+
+    def __init__(self,
+                 failure_threshold: int = 10,
+                 reset_timeout: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.times_opened = 0
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_at: Optional[float] = None
+        self._trial_pending = False
+        self._closed_seconds = 0.0
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    @property
+    def open_seconds(self) -> float:
+        """
+        The total time the breaker has been open so far
+        """
+        with self._lock:
+            opened_at = self._opened_at
+            return self._closed_seconds + (0.0 if opened_at is None else self.clock() - opened_at)
+
+    def remaining_seconds(self) -> float:
+        """
+        The time until the next trial call will be let through, or zero if the breaker is closed
+        """
+        with self._lock:
+            return 0.0 if self._trial_at is None else max(0.0, self._trial_at - self.clock())
+
+    def allow(self) -> bool:
+        """
+        Return True if a call should be attempted.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            elif not self._trial_pending and self.clock() >= self._trial_at:
+                self._trial_pending = True
+                return True
+            else:
+                return False
+
+    def success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            if self._opened_at is not None:
+                self._closed_seconds += self.clock() - self._opened_at
+                logger.info('Closing circuit breaker after %.1fs.', self.clock() - self._opened_at)
+                self._opened_at = self._trial_at = None
+                self._trial_pending = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            now = self.clock()
+            if self._opened_at is not None:
+                if self._trial_pending:
+                    self._trial_pending = False
+                    self._trial_at = now + self.reset_timeout
+            elif self._failures >= self.failure_threshold:
+                logger.warning('Opening circuit breaker after %i consecutive failures.', self._failures)
+                self.times_opened += 1
+                self._opened_at = now
+                self._trial_at = now + self.reset_timeout
+
+
+@dataclass
+class RetryMetrics:
+    """
+    Counters describing the retries made by a Retrier
+    """
+    calls: int = 0
+    attempts: int = 0
+    retries: Mapping[str, int] = field(default_factory=dict)  # by failure class
+    failures: int = 0  # calls that failed after all retries
+    budget_exhausted: int = 0  # retries not made because the retry budget was exhausted
+    circuit_opened: int = 0
+    circuit_rejected: int = 0  # attempts rejected by the open circuit breaker
+    circuit_open_seconds: float = 0.0
+
+
+class Retrier:
+    """
+    Makes calls according to a RetryPolicy, with a RetryBudget and a CircuitBreaker shared by all calls made through
+    the same instance. Thread-safe.
+    """
+
+    def __init__(self,
+                 policy: Optional[RetryPolicy] = None,
+                 budget: Optional[RetryBudget] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 sleep: Callable[[float], None] = time.sleep,
+                 random: Callable[[], float] = _random.random) -> None:
+        """
+        :param policy: the retry policy, see RetryPolicy for the defaults
+
+        :param budget: the retry budget, see RetryBudget for the defaults
+
+        :param breaker: the circuit breaker, see CircuitBreaker for the defaults
+
+        :param sleep: the function to sleep with, for testing
+
+        :param random: the function returning random numbers between 0 and 1, for testing
+        """
+        self.policy = RetryPolicy() if policy is None else policy
+        self.budget = RetryBudget() if budget is None else budget
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.sleep = sleep
+        self.random = random
+        self._counters = Counter()
+        self._retries = Counter()
+        self._lock = Lock()
+
+    def call(self, func: Callable[..., T], *args, instrument: Optional[Instrument] = None, **kwargs) -> T:
+        """
+        Call the given function with the given arguments, retrying it if it fails with a retryable exception. Raise
+        CircuitOpenError if the circuit breaker is open, or the exception of the last attempt if all retries failed,
+        the retry budget is exhausted or the failure opened the circuit breaker.
+
+        :param instrument: an optional instrument to report each retry to, as a `retry.<failure class>` stage with the
+                           time spent backing off
+        """
+        self._count('calls')
+        self.budget.deposit()
+        retries = Counter()
+        while True:
+            if not self.breaker.allow():
+                self._count('circuit_rejected')
+                raise CircuitOpenError(self.breaker.remaining_seconds())
+            self._count('attempts')
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                failure_class = self.policy.classify(e)
+                if failure_class is None:
+                    # The DSS responded, so it is healthy enough
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                retries[failure_class] += 1
+                retry = retries[failure_class]
+                if retry > self.policy.max_retries.get(failure_class, 0) or self.breaker.is_open:
+                    self._count('failures')
+                    raise
+                if not self.budget.withdraw():
+                    self._count('budget_exhausted')
+                    self._count('failures')
+                    raise
+                delay = self.policy.delay(sum(retries.values()), self.random(), _retry_after(e))
+                logger.info('Retrying in %.2fs after %s failure (%i/%i): %r',
+                            delay, failure_class, retry, self.policy.max_retries[failure_class], e)
+                with self._lock:
+                    self._retries[failure_class] += 1
+                if instrument is not None:
+                    instrument.record('retry.' + failure_class, delay, count=1)
+                self.sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+
+    def metrics(self) -> RetryMetrics:
+        """
+        Return a snapshot of the counters of this retrier.
+        """
+        with self._lock:
+            return RetryMetrics(calls=self._counters['calls'],
+                                attempts=self._counters['attempts'],
+                                retries=dict(self._retries),
+                                failures=self._counters['failures'],
+                                budget_exhausted=self._counters['budget_exhausted'],
+                                circuit_opened=self.breaker.times_opened,
+                                circuit_rejected=self._counters['circuit_rejected'],
+                                circuit_open_seconds=self.breaker.open_seconds)
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] += 1
@@ -0,0 +1,416 @@
+"""
+Sources of bundles behind a common interface, so that the same code can index bundles from the DSS, from a local
+mirror or from an archive.
+
+>>> import tempfile
+>>> from humancellatlas.data.metadata.helpers.synthetic import SyntheticCorpus
+>>> corpus = sorted(SyntheticCorpus(3, seed=5))
+>>> with tempfile.TemporaryDirectory() as d:
+...     mirror = DirectoryBundleSource(d)
+...     for uuid, version, manifest, metadata_files in corpus:
+...         mirror.put(uuid, version, manifest, metadata_files)
+...     list(mirror.bundles()) == corpus
+True
+"""
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import tarfile
+import tempfile
+from typing import (
+    BinaryIO,
+    Iterable,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    JSON,
+)
+from humancellatlas.data.metadata.helpers.compression import Codec
+from humancellatlas.data.metadata.helpers.decoder import (
+    decode_json,
+    read_json,
+)
+from humancellatlas.data.metadata.helpers.pack import BundlePack
+from humancellatlas.data.metadata.instrumentation import (
+    Instrument,
+    timed,
+)
+
+logger = logging.getLogger(__name__)
+
+# The UUID and version of a bundle. The version may be None to denote the latest version of the bundle.
+#
+FQID = Tuple[str, Optional[str]]
+
+# The UUID, version, manifest and metadata files of a bundle
+#
+BundleTuple = Tuple[str, str, List[JSON], JSON]
+
+# The suffix of the name of a compressed file in a local mirror
+#
+compressed_suffix = '.hcz'
+
+_bundle_file_names = ('manifest.json', 'metadata.json')
+
+
+class BundleSource(ABC):
+    """
+    A source of bundles. Subclasses must implement list_bundles() and get(). The remaining methods are implemented
+    in terms of those two, but subclasses may override them with more efficient implementations.
+    """
+
+    @abstractmethod
+    def list_bundles(self) -> Iterator[Tuple[str, str]]:
+        """
+        Yield the UUID and version of every bundle in this source.
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get(self, uuid: str, version: Optional[str] = None) -> Tuple[str, List[JSON], JSON]:
+        """
+        Return the version, manifest and metadata files of the given bundle, in the form returned by
+        download_bundle_metadata(). Raise KeyError if the source does not contain the bundle.
+
+        :param uuid: the UUID of the bundle
+
+        :param version: the version of the bundle, or None for the latest version of the bundle in this source
+        """
+        raise NotImplementedError()
+
+    def bundles(self, fqids: Optional[Iterable[FQID]] = None) -> Iterator[BundleTuple]:
+        """
+        Yield the UUID, version, manifest and metadata files of each of the given bundles, or of every bundle in this
+        source if no bundles are given. The tuples can be passed to Bundle() as positional arguments.
+        """
+        for uuid, version in self.list_bundles() if fqids is None else fqids:
+            yield (uuid, *self.get(uuid, version))
+
+    def bundle(self, uuid: str, version: Optional[str] = None, **kwargs) -> Bundle:
+        """
+        Return a Bundle object for the given bundle. Keyword arguments are passed on to Bundle().
+        """
+        version, manifest, metadata_files = self.get(uuid, version)
+        return Bundle(uuid, version, manifest, metadata_files, **kwargs)
+
+    def __iter__(self) -> Iterator[BundleTuple]:
+        return self.bundles()
+
+
+class DSSBundleSource(BundleSource):
+    """
+    The bundles in the HCA data store (DSS), or the subset of them matching a search query.
+    """
+
+    def __init__(self, client, replica: str, es_query: Optional[JSON] = None, num_workers: int = 0,
+                 **download_kwargs) -> None:
+        """
+        :param client: the DSS client to use, see dss_client()
+
+        :param replica: the name of the DSS replica to use
+
+        :param es_query: the Elasticsearch query selecting the bundles to list. By default all bundles are listed.
+
+        :param num_workers: the number of bundles bundles() downloads concurrently. If 0, bundles are downloaded
+                            one at a time by the current thread.
+
+        :param download_kwargs: additional keyword arguments to download_bundle_metadata()
+        """
+        self.client = client
+        self.replica = replica
+        self.es_query = {'query': {'match_all': {}}} if es_query is None else es_query
+        self.num_workers = num_workers
+        self.download_kwargs = download_kwargs
+
+    def list_bundles(self) -> Iterator[Tuple[str, str]]:
+        # noinspection PyUnresolvedReferences
+        for hit in self.client.post_search.iterate(es_query=self.es_query, replica=self.replica):
+            uuid, _, version = hit['bundle_fqid'].partition('.')
+            yield uuid, version
+
+    def get(self, uuid: str, version: Optional[str] = None) -> Tuple[str, List[JSON], JSON]:
+        from hca.util.exceptions import SwaggerAPIException
+        from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+        try:
+            return download_bundle_metadata(self.client, self.replica, uuid, version, **self.download_kwargs)
+        except SwaggerAPIException as e:
+            if e.code == 404:
+                raise KeyError(_fqid(uuid, version)) from e
+            else:
+                raise
+
+    def bundles(self, fqids: Optional[Iterable[FQID]] = None) -> Iterator[BundleTuple]:
+        if self.num_workers == 0:
+            yield from super().bundles(fqids)
+        else:
+            def get(fqid: FQID) -> BundleTuple:
+                uuid, version = fqid
+                return (uuid, *self.get(uuid, version))
+
+            with ThreadPoolExecutor(self.num_workers) as tpe:
+                yield from tpe.map(get, self.list_bundles() if fqids is None else fqids)
+
+
+class DirectoryBundleSource(BundleSource):
+    """
+    A local mirror of bundles in a directory tree. Each bundle is stored in a directory named after the bundle's
+    version, inside a directory named after the bundle's UUID. The bundle directory contains the manifest in
+    `manifest.json` and a dictionary mapping the name of each metadata file to its contents in `metadata.json`. The
+    UUID directories may be nested in any number of other directories, `prod/` for example.
+
+    Either file may be compressed, in which case its name has the suffix `.hcz` and it contains a frame written by a
+    humancellatlas.data.metadata.helpers.compression.Codec.
+    """
+
+    def __init__(self, path: str, instrument: Optional[Instrument] = None, codec: Optional[Codec] = None) -> None:
+        """
+        :param path: the path of the root directory of the mirror
+
+        :param instrument: an optional instrument to report the time spent decoding the JSON files to, as well as the
+                           time spent compressing files, as the `compress` stage with the uncompressed size, and the
+                           size of each file written, as the `disk` stage
+
+        :param codec: an optional codec to compress the files written by put() with, and to decompress compressed
+                      files with. Reading compressed files written with a dictionary requires a codec with the same
+                      dictionary.
+        """
+        self.path = path
+        self.instrument = instrument
+        self.codec = codec
+        # The paths of the directories named after each bundle UUID, populated on demand
+        self._uuid_dir_paths: Optional[MutableMapping[str, MutableMapping[str, None]]] = None
+
+    def list_bundles(self) -> Iterator[Tuple[str, str]]:
+        for uuid, version, _ in self._bundle_dirs():
+            yield uuid, version
+
+    def get(self, uuid: str, version: Optional[str] = None) -> Tuple[str, List[JSON], JSON]:
+        bundle_dirs = []
+        for uuid_dir in self._uuid_dirs(uuid):
+            try:
+                versions = os.listdir(uuid_dir) if version is None else [version]
+            except FileNotFoundError:
+                continue
+            for v in versions:
+                dir_path = os.path.join(uuid_dir, v)
+                if _is_bundle_dir(dir_path):
+                    bundle_dirs.append((v, dir_path))
+        if not bundle_dirs:
+            raise KeyError(_fqid(uuid, version))
+        version, dir_path = max(bundle_dirs)
+        return (version, *self._read(dir_path))
+
+    def bundles(self, fqids: Optional[Iterable[FQID]] = None) -> Iterator[BundleTuple]:
+        if fqids is None:
+            # Read each directory instead of looking up each bundle, in case the same bundle occurs more than once
+            for uuid, version, dir_path in self._bundle_dirs():
+                yield (uuid, version, *self._read(dir_path))
+        else:
+            yield from super().bundles(fqids)
+
+    def put(self, uuid: str, version: str, manifest: List[JSON], metadata_files: JSON,
+            directory: Optional[str] = None) -> None:
+        """
+        Write the given bundle to this mirror, replacing any previous copy.
+
+        :param directory: the path of the directory to place the bundle's UUID directory in, relative to the root of
+                          this mirror. By default the UUID directory is placed directly in the root.
+        """
+        uuid_dir = os.path.join(self.path, directory or '', uuid)
+        dir_path = os.path.join(uuid_dir, version)
+        os.makedirs(dir_path, exist_ok=True)
+        for file_name, contents in zip(_bundle_file_names, (manifest, metadata_files)):
+            data = json.dumps(contents).encode()
+            if self.codec is None:
+                stale_file_name = file_name + compressed_suffix
+            else:
+                with timed(self.instrument, 'compress', count=1, size=len(data)):
+                    data = self.codec.compress(data)
+                file_name, stale_file_name = file_name + compressed_suffix, file_name
+            f = tempfile.NamedTemporaryFile('wb', dir=dir_path, delete=False)
+            try:
+                with f:
+                    f.write(data)
+                os.replace(f.name, os.path.join(dir_path, file_name))
+            except BaseException:
+                os.unlink(f.name)
+                raise
+            if self.instrument is not None:
+                self.instrument.record('disk', 0.0, count=1, size=len(data))
+            try:
+                os.unlink(os.path.join(dir_path, stale_file_name))
+            except FileNotFoundError:
+                pass
+        if self._uuid_dir_paths is not None:
+            self._uuid_dir_paths.setdefault(uuid, {})[uuid_dir] = None
+
+    def _read(self, dir_path: str) -> Tuple[List[JSON], JSON]:
+        manifest, metadata_files = (self._read_file(os.path.join(dir_path, file_name))
+                                    for file_name in _bundle_file_names)
+        return manifest, metadata_files
+
+    def _read_file(self, path: str) -> JSON:
+        try:
+            return read_json(path, self.instrument)
+        except FileNotFoundError:
+            with open(path + compressed_suffix, 'rb') as f:
+                return decode_json((self.codec or Codec()).decompress(f.read()), self.instrument)
+
+    def _uuid_dirs(self, uuid: str) -> Iterable[str]:
+        """
+        Return the paths of the directories named after the given bundle UUID. The directory tree is walked once, when
+        a UUID is first looked up, and again whenever a UUID is not found, in case the bundle was added to the mirror
+        by another process since the last walk.
+        """
+        if self._uuid_dir_paths is None or uuid not in self._uuid_dir_paths:
+            uuid_dir_paths = {}
+            for _uuid, _, dir_path in self._bundle_dirs():
+                uuid_dir_paths.setdefault(_uuid, {})[os.path.dirname(dir_path)] = None
+            self._uuid_dir_paths = uuid_dir_paths
+        return list(self._uuid_dir_paths.get(uuid, ()))
+
+    def _bundle_dirs(self) -> Iterator[Tuple[str, str, str]]:
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            dir_names.sort()
+            if 'manifest.json' in file_names or 'manifest.json' + compressed_suffix in file_names:
+                dir_names.clear()
+                uuid, version = dir_path.split(os.path.sep)[-2:]
+                yield uuid, version, dir_path
+
+
+def _is_bundle_dir(dir_path: str) -> bool:
+    return any(os.path.exists(os.path.join(dir_path, 'manifest.json' + suffix)) for suffix in ('', compressed_suffix))
+
+
+class TarballBundleSource(BundleSource):
+    """
+    A tarball of a local mirror in the layout described in DirectoryBundleSource. The tarball may be compressed.
+
+    bundles() reads the tarball sequentially in streaming mode, holding at most one bundle in memory, and yields the
+    bundles in the order in which they occur in the tarball. It can therefore read from a non-seekable file object,
+    such as an HTTP response. list_bundles() and get() require a path to the tarball, or a seekable file object. Each
+    call to get() reads the tarball up to the requested bundle.
+    """
+
+    def __init__(self,
+                 tarball: Union[str, BinaryIO],
+                 instrument: Optional[Instrument] = None,
+                 codec: Optional[Codec] = None) -> None:
+        """
+        :param tarball: the path to the tarball or a binary file object to read the tarball from
+
+        :param instrument: an optional instrument to report the time spent decoding the JSON files to
+
+        :param codec: an optional codec to decompress compressed files with, see DirectoryBundleSource
+        """
+        self.tarball = tarball
+        self.instrument = instrument
+        self.codec = codec
+        self._start = None if isinstance(tarball, str) or not tarball.seekable() else tarball.tell()
+
+    def list_bundles(self) -> Iterator[Tuple[str, str]]:
+        with self._open() as tf:
+            for member in tf:
+                dir_path, _, file_name = member.name.rpartition('/')
+                if member.isfile() and file_name in ('manifest.json', 'manifest.json' + compressed_suffix):
+                    fqid = self._fqid(dir_path)
+                    if fqid is not None:
+                        yield fqid
+
+    def get(self, uuid: str, version: Optional[str] = None) -> Tuple[str, List[JSON], JSON]:
+        if version is None:
+            versions = [v for u, v in self.list_bundles() if u == uuid]
+            if not versions:
+                raise KeyError(_fqid(uuid, version))
+            version = max(versions)
+        for _uuid, _version, manifest, metadata_files in self._read(lambda fqid: fqid == (uuid, version)):
+            return version, manifest, metadata_files
+        raise KeyError(_fqid(uuid, version))
+
+    def bundles(self, fqids: Optional[Iterable[FQID]] = None) -> Iterator[BundleTuple]:
+        if fqids is None:
+            yield from self._read(lambda fqid: True)
+        else:
+            yield from super().bundles(fqids)
+
+    def _read(self, predicate) -> Iterator[BundleTuple]:
+        pending: MutableMapping[Tuple[str, str], MutableMapping[str, JSON]] = {}
+        with self._open() as tf:
+            for member in tf:
+                dir_path, _, file_name = member.name.rpartition('/')
+                compressed = file_name.endswith(compressed_suffix)
+                if compressed:
+                    file_name = file_name[:-len(compressed_suffix)]
+                if member.isfile() and file_name in _bundle_file_names:
+                    fqid = self._fqid(dir_path)
+                    if fqid is not None and predicate(fqid):
+                        with tf.extractfile(member) as f:
+                            contents = f.read()
+                        if compressed:
+                            contents = (self.codec or Codec()).decompress(contents)
+                        contents = decode_json(contents, self.instrument)
+                        files = pending.setdefault(fqid, {})
+                        files[file_name] = contents
+                        if len(files) == 2:
+                            del pending[fqid]
+                            yield (*fqid, files['manifest.json'], files['metadata.json'])
+        if pending:
+            logger.warning('Incomplete bundles in tarball: %r', list(pending.keys()))
+
+    def _open(self) -> tarfile.TarFile:
+        if isinstance(self.tarball, str):
+            return tarfile.open(self.tarball, mode='r|*')
+        else:
+            if self._start is not None:
+                self.tarball.seek(self._start)
+            return tarfile.open(fileobj=self.tarball, mode='r|*')
+
+    def _fqid(self, dir_path: str) -> Optional[Tuple[str, str]]:
+        """
+        Return the UUID and version of the bundle in the given directory of the tarball, or None if the directory
+        isn't nested deeply enough to be a bundle directory.
+        """
+        components = [component for component in dir_path.split('/') if component not in ('', '.')]
+        if len(components) < 2:
+            return None
+        uuid, version = components[-2:]
+        return uuid, version
+
+
+class PackBundleSource(BundleSource):
+    """
+    The bundles in a pack file, see BundlePack
+    """
+
+    def __init__(self, pack: BundlePack) -> None:
+        self.pack = pack
+
+    def list_bundles(self) -> Iterator[Tuple[str, str]]:
+        for fqid in self.pack:
+            uuid, _, version = fqid.partition('.')
+            yield uuid, version
+
+    def get(self, uuid: str, version: Optional[str] = None) -> Tuple[str, List[JSON], JSON]:
+        if version is None:
+            versions = self.pack.versions(uuid)
+            if not versions:
+                raise KeyError(_fqid(uuid, version))
+            version = versions[-1]
+        manifest, metadata_files = self.pack.get(uuid, version)
+        return version, manifest, metadata_files
+
+
+def _fqid(uuid: str, version: Optional[str]) -> str:
+    return uuid if version is None else f'{uuid}.{version}'
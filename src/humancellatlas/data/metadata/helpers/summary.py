@@ -0,0 +1,210 @@
+"""
+Facet counts and cell counts across many bundles, maintained incrementally.
+
+>>> from humancellatlas.data.metadata.helpers.synthetic import BundleShape, SyntheticCorpus
+>>> corpus = [Bundle(*bundle) for bundle in SyntheticCorpus(4, BundleShape(donors=2), seed=1)]
+>>> left, right = FacetSummary(), FacetSummary()
+>>> left.update(corpus[:3])
+>>> right.update(corpus[2:])
+>>> left.merge(FacetSummary.from_bytes(right.to_bytes()))
+>>> whole = FacetSummary()
+>>> whole.update(corpus)
+>>> left == whole, sum(left.counts('genus_species').values())
+(True, 8)
+"""
+import base64
+from collections import Counter
+import json
+from operator import attrgetter
+from typing import (
+    Callable,
+    FrozenSet,
+    Iterable,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Tuple,
+    Type,
+)
+from uuid import UUID
+import zlib
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    CellSuspension,
+    DonorOrganism,
+    Entity,
+    File,
+    LibraryPreparationProtocol,
+    Project,
+    SpecimenFromOrganism,
+    UUID4,
+)
+from humancellatlas.data.metadata.lookup import lookup
+
+# The facets each type of entity contributes to, and a function returning the entity's values for each facet
+#
+facets: Mapping[Type[Entity], List[Tuple[str, Callable[[Entity], Iterable[Optional[str]]]]]] = {
+    Project: [('project', lambda project: [project.project_short_name])],
+    DonorOrganism: [('genus_species', attrgetter('genus_species')),
+                    ('disease', attrgetter('diseases')),
+                    ('sex', lambda donor: [donor.sex])],
+    SpecimenFromOrganism: [('organ', lambda specimen: [specimen.organ]),
+                           ('organ_part', attrgetter('organ_parts')),
+                           ('disease', attrgetter('diseases'))],
+    CellSuspension: [('selected_cell_type', attrgetter('selected_cell_types'))],
+    LibraryPreparationProtocol: [('library_construction_method',
+                                  lambda protocol: [protocol.library_construction_method])],
+    File: [('file_format', lambda file: [file.format])],
+}
+
+# The update date, the facet values and the estimated cell count contributed by a single entity
+#
+Contribution = Tuple[str, FrozenSet[Tuple[str, str]], Optional[int]]
+
+_format_version = 1
+
+
+class FacetSummary:
+    """
+    The number of distinct entities with each value of each facet, e.g. the number of specimens from each organ,
+    and the total estimated cell count, across all bundles added to the summary.
+
+    An entity occurring in several bundles is counted once. The summary remembers the contribution of each entity by
+    document ID, so that adding another bundle only requires looking at the entities in that bundle. If a newer
+    version of a document is encountered, as determined by the update date in the document's provenance, the
+    contribution of the older version is replaced.
+
+    Since entities are identified by document ID, summaries built from disjoint or overlapping sets of bundles, by
+    separate workers for example, can be merged without counting any entity twice.
+    """
+
+    def __init__(self) -> None:
+        self._contributions: MutableMapping[UUID4, Contribution] = {}
+        self._counts: MutableMapping[str, Counter] = {}
+        self.estimated_cell_count = 0
+
+    def __len__(self) -> int:
+        """
+        The number of distinct entities that contributed to this summary
+        """
+        return len(self._contributions)
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, FacetSummary) and self._contributions == other._contributions
+
+    def counts(self, facet: str) -> Mapping[str, int]:
+        """
+        Return the number of distinct entities with each value of the given facet.
+        """
+        return self._counts.get(facet, Counter())
+
+    def to_json(self) -> Mapping[str, Mapping[str, int]]:
+        """
+        Return the counts of all facets, and the total estimated cell count under the key `estimated_cell_count`.
+        """
+        return {
+            **{facet: dict(counts) for facet, counts in sorted(self._counts.items())},
+            'estimated_cell_count': self.estimated_cell_count
+        }
+
+    def add(self, bundle: Bundle) -> None:
+        """
+        Add the entities in the given bundle to this summary.
+        """
+        for entity in bundle.entities.values():
+            contribution = _contribution(entity)
+            if contribution is not None:
+                self._put(entity.document_id, contribution)
+
+    def update(self, bundles: Iterable[Bundle]) -> None:
+        for bundle in bundles:
+            self.add(bundle)
+
+    def merge(self, other: 'FacetSummary') -> None:
+        """
+        Add the entities summarized by the given summary to this summary.
+        """
+        for document_id, contribution in other._contributions.items():
+            self._put(document_id, contribution)
+
+    def _put(self, document_id: UUID4, contribution: Contribution) -> None:
+        old_contribution = self._contributions.get(document_id)
+        if old_contribution is None or old_contribution[0] < contribution[0]:
+            if old_contribution is not None:
+                self._count(old_contribution, -1)
+            self._contributions[document_id] = contribution
+            self._count(contribution, 1)
+
+    def _count(self, contribution: Contribution, sign: int) -> None:
+        _, values, cell_count = contribution
+        for facet, value in values:
+            try:
+                counts = self._counts[facet]
+            except KeyError:
+                counts = self._counts[facet] = Counter()
+            counts[value] += sign
+            if not counts[value]:
+                del counts[value]
+        if cell_count:
+            self.estimated_cell_count += sign * cell_count
+
+    def to_bytes(self) -> bytes:
+        """
+        Serialize this summary. The counts are not serialized but derived from the contributions when deserializing.
+        Strings are stored once and referred to by index. The result is compressed.
+        """
+        strings: MutableMapping[str, int] = {}
+
+        def ref(s: str) -> int:
+            return strings.setdefault(s, len(strings))
+
+        document_ids = []
+        contributions = []
+        for document_id, (update_date, values, cell_count) in self._contributions.items():
+            document_ids.append(document_id.bytes)
+            contributions.append([ref(update_date), cell_count, *(ref(s) for value in sorted(values) for s in value)])
+        payload = {
+            'format': _format_version,
+            'strings': list(strings.keys()),
+            'document_ids': base64.b64encode(b''.join(document_ids)).decode(),
+            'contributions': contributions
+        }
+        return zlib.compress(json.dumps(payload, separators=(',', ':')).encode())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'FacetSummary':
+        payload = json.loads(zlib.decompress(data))
+        if payload['format'] != _format_version:
+            raise ValueError('Unsupported summary format', payload['format'])
+        strings = payload['strings']
+        document_ids = base64.b64decode(payload['document_ids'])
+        self = cls()
+        for i, (update_date, cell_count, *values) in enumerate(payload['contributions']):
+            document_id = UUID(bytes=document_ids[16 * i:16 * (i + 1)])
+            values = frozenset((strings[values[j]], strings[values[j + 1]]) for j in range(0, len(values), 2))
+            self._put(document_id, (strings[update_date], values, cell_count))
+        return self
+
+
+def _contribution(entity: Entity) -> Optional[Contribution]:
+    for entity_type in type(entity).__mro__:
+        entity_facets = facets.get(entity_type)
+        if entity_facets is not None:
+            break
+    else:
+        return None
+    values = frozenset((facet, value)
+                       for facet, get_values in entity_facets
+                       for value in get_values(entity)
+                       if value is not None)
+    cell_count = entity.estimated_cell_count if isinstance(entity, CellSuspension) else None
+    return _update_date(entity), values, cell_count
+
+
+def _update_date(entity: Entity) -> str:
+    if entity.json is None:
+        return ''
+    provenance = entity.json.get('hca_ingest') or entity.json['provenance']
+    return lookup(provenance, 'update_date', 'updateDate', default=None) or ''
@@ -0,0 +1,459 @@
+"""
+Generate synthetic bundles for load testing and serve them through a local stand-in for the DSS client.
+
+>>> corpus = SyntheticCorpus(2, BundleShape(donors=2, specimens=2, fan_out=2), layout='v5', seed=42)
+>>> [uuid for uuid, version, manifest, metadata_files in corpus] == [corpus.bundle(i)[0] for i in range(2)]
+True
+>>> sorted(corpus.bundle(0)[3].keys())
+['biomaterial.json', 'file.json', 'links.json', 'process.json', 'project.json', 'protocol.json']
+>>> client = LocalDSSClient(corpus)
+>>> uuid, version, manifest, metadata_files = corpus.bundle(1)
+>>> from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+>>> download_bundle_metadata(client, 'aws', uuid, num_workers=0) == (version, manifest, metadata_files)
+True
+"""
+from collections import defaultdict
+from itertools import (
+    chain,
+    count,
+)
+import math
+import random
+import time
+from typing import (
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
+from uuid import UUID
+
+from dataclasses import dataclass
+
+from humancellatlas.data.metadata.api import JSON
+
+# The UUID, version, manifest and metadata files of a bundle
+#
+BundleTuple = Tuple[str, str, List[JSON], JSON]
+
+# Small vocabularies to draw field values from
+#
+_species = ['Homo sapiens', 'Mus musculus']
+_organs = ['pancreas', 'brain', 'lymph node', 'blood', 'kidney', 'liver', 'heart', 'lung']
+_diseases = ['normal', 'type 2 diabetes mellitus', 'glioblastoma']
+_sexes = ['female', 'male', 'unknown']
+_cell_types = ['neuron', 'T cell', 'B cell', 'hepatocyte', 'alpha cell']
+_library_construction_methods = ["10X 3' v2 sequencing", 'Smart-seq2', 'Drop-seq']
+_instruments = ['Illumina HiSeq 2500', 'Illumina NextSeq 500', 'Illumina NovaSeq 6000']
+_read_indexes = ['read1', 'read2', 'index1', 'index2']
+
+
+@dataclass(frozen=True)
+class BundleShape:
+    """
+    The shape of a synthetic bundle. Each donor yields specimens through collection processes, each specimen yields
+    cell suspensions through dissociation processes, and each suspension is sequenced into files by sequencing
+    processes. A process has at most `fan_out` outputs, so the number of processes follows from the other counts.
+
+    >>> BundleShape(donors=2, specimens=3, suspensions=2, files=2, fan_out=2).num_entities
+    71
+    """
+    #: The number of donors in the bundle
+    donors: int = 1
+
+    #: The number of specimens collected from each donor
+    specimens: int = 1
+
+    #: The number of sequenced cell suspensions dissociated from each specimen
+    suspensions: int = 1
+
+    #: The number of sequence files produced from each sequenced cell suspension
+    files: int = 2
+
+    #: The number of distinct protocols of each protocol type. Processes use them in turn.
+    protocols: int = 1
+
+    #: The maximum number of outputs of each process
+    fan_out: int = 1
+
+    #: The number of processes between a specimen and a sequenced cell suspension. A depth greater than one inserts
+    #: intermediate suspensions connected by enrichment processes.
+    chain_depth: int = 1
+
+    def __post_init__(self):
+        for name in ('donors', 'specimens', 'suspensions', 'files', 'protocols', 'fan_out', 'chain_depth'):
+            if getattr(self, name) < 1:
+                raise ValueError(f'{name} must be positive', getattr(self, name))
+
+    @property
+    def num_entities(self) -> int:
+        """
+        The total number of entities in a bundle of this shape
+        """
+
+        def processes(num_outputs):
+            return math.ceil(num_outputs / self.fan_out)
+
+        per_suspension = 2 * self.chain_depth - 1 + self.files + processes(self.files)
+        per_specimen = 1 + processes(self.suspensions) + self.suspensions * per_suspension
+        per_donor = 1 + processes(self.specimens) + self.specimens * per_specimen
+        num_protocol_types = 4 if self.chain_depth == 1 else 5
+        return 1 + num_protocol_types * self.protocols + self.donors * per_donor
+
+
+def synthetic_bundle(shape: BundleShape = BundleShape(), layout: str = 'vx', seed=0) -> BundleTuple:
+    """
+    Generate a synthetic bundle of the given shape. The same arguments always yield the same bundle.
+
+    :param shape: the shape of the bundle
+
+    :param layout: 'v5' for a bundle with one metadata file per core entity type, in the style of metadata schema
+                   version 5, or 'vx' for a bundle with one metadata file per entity, in the style of later versions
+
+    :param seed: the seed for all random choices, including UUIDs. Must be an int, str or bytes.
+
+    :return: a tuple of the UUID, version, manifest and metadata files of the bundle, in the form returned by
+             download_bundle_metadata() and accepted by Bundle()
+    """
+    return _Generator(shape, random.Random(seed)).bundle(layout)
+
+
+class SyntheticCorpus:
+    """
+    A reproducible sequence of synthetic bundles of the same shape. Bundles are generated on demand, so a corpus of
+    any size can be iterated over in constant memory.
+    """
+
+    def __init__(self, num_bundles: int, shape: BundleShape = BundleShape(), layout: str = 'vx', seed=0) -> None:
+        """
+        :param num_bundles: the number of bundles in the corpus
+
+        :param shape: the shape of every bundle in the corpus
+
+        :param layout: the layout of every bundle, see synthetic_bundle()
+
+        :param seed: the seed from which the seeds of the individual bundles are derived
+        """
+        self.num_bundles = num_bundles
+        self.shape = shape
+        self.layout = layout
+        self.seed = seed
+
+    def bundle(self, i: int) -> BundleTuple:
+        if not 0 <= i < self.num_bundles:
+            raise IndexError(i)
+        return synthetic_bundle(self.shape, self.layout, seed=f'{self.seed}/{i}')
+
+    def __len__(self) -> int:
+        return self.num_bundles
+
+    def __iter__(self) -> Iterator[BundleTuple]:
+        return map(self.bundle, range(self.num_bundles))
+
+
+class _Generator:
+
+    def __init__(self, shape: BundleShape, rng: random.Random) -> None:
+        self.shape = shape
+        self.rng = rng
+        self.version = self._version()
+        self.documents: List[Tuple[str, str, str, JSON]] = []  # core type, schema name, document ID, content
+        self.links: List[Tuple[str, List[str], str, List[str], str, List[str]]] = []
+        self.protocol_types: MutableMapping[str, str] = {}
+        self.data_files: List[JSON] = []
+
+    def _uuid(self) -> str:
+        return str(UUID(int=self.rng.getrandbits(128), version=4))
+
+    def _version(self) -> str:
+        t = 1514764800 + self.rng.randrange(2 * 365 * 24 * 3600)  # a date in 2018 or 2019
+        return time.strftime('%Y-%m-%dT%H%M%S', time.gmtime(t)) + f'.{self.rng.randrange(1000000):06}Z'
+
+    def _ontology(self, vocabulary: List[str]) -> JSON:
+        i = self.rng.randrange(len(vocabulary))
+        return dict(text=vocabulary[i], ontology_label=vocabulary[i], ontology=f'FOO:{i:07}')
+
+    def _document(self, core_type: str, schema_name: str, content: JSON) -> str:
+        document_id = self._uuid()
+        self.documents.append((core_type, schema_name, document_id, content))
+        return document_id
+
+    def _biomaterial(self, schema_name: str, **content) -> str:
+        core = dict(biomaterial_id=f'{schema_name}_{len(self.documents)}', ncbi_taxon_id=[9606])
+        return self._document('biomaterial', schema_name, dict(content, biomaterial_core=core))
+
+    def _protocols(self, schema_name: str, **content) -> List[str]:
+        protocol_ids = []
+        for i in range(self.shape.protocols):
+            core = dict(protocol_id=f'{schema_name}_{i}')
+            protocol_id = self._document('protocol', schema_name, dict(content, protocol_core=core))
+            self.protocol_types[protocol_id] = schema_name
+            protocol_ids.append(protocol_id)
+        return protocol_ids
+
+    def _processes(self, inputs: List[str], input_type: str, outputs: List[str], output_type: str,
+                   *protocols: List[str]) -> None:
+        fan_out = self.shape.fan_out
+        for i in range(0, len(outputs), fan_out):
+            core = dict(process_id=f'process_{len(self.links)}')
+            process_id = self._document('process', 'process', dict(process_core=core))
+            protocol_ids = [protocol_ids[len(self.links) % len(protocol_ids)] for protocol_ids in protocols]
+            self.links.append((process_id, inputs, input_type, outputs[i:i + fan_out], output_type, protocol_ids))
+
+    def _sequence_file(self) -> str:
+        i = len(self.data_files)
+        read_index = _read_indexes[i % len(_read_indexes)]
+        file_name = f'sample_{i // len(_read_indexes)}_{read_index}.fastq.gz'
+        core = dict(file_name=file_name, file_format='fastq.gz')
+        content = dict(file_core=core, read_index=read_index, lane_index=1 + self.rng.randrange(8))
+        self.data_files.append(self._manifest_entry(file_name, 'application/gzip', False, self.rng.randrange(1 << 32)))
+        return self._document('file', 'sequence_file', content)
+
+    def _manifest_entry(self, name: str, content_type: str, indexed: bool, size: int) -> JSON:
+        return {
+            'content-type': content_type,
+            'crc32c': f'{self.rng.getrandbits(32):08x}',
+            'indexed': indexed,
+            'name': name,
+            's3_etag': f'{self.rng.getrandbits(128):032x}',
+            'sha1': f'{self.rng.getrandbits(160):040x}',
+            'sha256': f'{self.rng.getrandbits(256):064x}',
+            'size': size,
+            'uuid': self._uuid(),
+            'version': self.version
+        }
+
+    def bundle(self, layout: str) -> BundleTuple:
+        shape, rng = self.shape, self.rng
+        uuid = self._uuid()
+        self._document('project', 'project', dict(project_core=dict(project_short_name=f'project_{uuid[:8]}',
+                                                                    project_title=f'Synthetic project {uuid}')))
+        collection = self._protocols('collection_protocol')
+        dissociation = self._protocols('dissociation_protocol')
+        enrichment = self._protocols('enrichment_protocol') if shape.chain_depth > 1 else []
+        library_preparation = self._protocols('library_preparation_protocol',
+                                              library_construction_method=self._ontology(_library_construction_methods))
+        sequencing = self._protocols('sequencing_protocol',
+                                     instrument_manufacturer_model=self._ontology(_instruments),
+                                     paired_end=True)
+        for _ in range(shape.donors):
+            donor = self._biomaterial('donor_organism',
+                                      genus_species=[self._ontology(_species)],
+                                      diseases=[self._ontology(_diseases)],
+                                      organism_age=str(rng.randrange(1, 90)),
+                                      organism_age_unit=dict(text='year', ontology_label='year'),
+                                      sex=rng.choice(_sexes))
+            specimens = [self._biomaterial('specimen_from_organism',
+                                           organ=self._ontology(_organs),
+                                           diseases=[self._ontology(_diseases)])
+                         for _ in range(shape.specimens)]
+            self._processes([donor], 'biomaterial', specimens, 'biomaterial', collection)
+            for specimen in specimens:
+                suspensions = [self._suspension() for _ in range(shape.suspensions)]
+                self._processes([specimen], 'biomaterial', suspensions, 'biomaterial', dissociation)
+                for suspension in suspensions:
+                    for _ in range(shape.chain_depth - 1):
+                        enriched = self._suspension()
+                        self._processes([suspension], 'biomaterial', [enriched], 'biomaterial', enrichment)
+                        suspension = enriched
+                    files = [self._sequence_file() for _ in range(shape.files)]
+                    self._processes([suspension], 'biomaterial', files, 'file', library_preparation, sequencing)
+        if layout == 'v5':
+            metadata_files = self._v5_metadata_files()
+        elif layout == 'vx':
+            metadata_files = self._vx_metadata_files()
+        else:
+            raise ValueError('Unknown bundle layout', layout)
+        manifest = [
+            self._manifest_entry(file_name, 'application/json; dcp-type="metadata"', True, rng.randrange(1 << 16))
+            for file_name in metadata_files.keys()
+        ]
+        return uuid, self.version, manifest + self.data_files, metadata_files
+
+    def _suspension(self):
+        return self._biomaterial('cell_suspension',
+                                 estimated_cell_count=self.rng.randrange(100, 100000),
+                                 selected_cell_types=[self._ontology(_cell_types)])
+
+    def _content(self, core_type: str, schema_name: str, content: JSON) -> JSON:
+        described_by = f'https://schema.humancellatlas.org/type/{core_type}/5.1.0/{schema_name}'
+        return dict(content, describedBy=described_by, schema_type=core_type)
+
+    def _v5_metadata_files(self) -> JSON:
+        update_date = self.version[:13] + ':' + self.version[13:15] + ':' + self.version[15:20] + 'Z'
+        entities_by_core_type = defaultdict(list)
+        for core_type, schema_name, document_id, content in self.documents:
+            entities_by_core_type[core_type].append({
+                'content': self._content(core_type, schema_name, content),
+                'hca_ingest': {
+                    'document_id': document_id,
+                    'updateDate': update_date
+                }
+            })
+        project, = entities_by_core_type.pop('project')
+        metadata_files = {'project.json': project}
+        for core_type, entities in entities_by_core_type.items():
+            key = 'processes' if core_type == 'process' else core_type + 's'
+            metadata_files[core_type + '.json'] = {key: entities}
+        metadata_files['links.json'] = {
+            'links': [
+                dict(source_id=source_id,
+                     source_type=source_type,
+                     destination_id=destination_id,
+                     destination_type=destination_type)
+                for process_id, inputs, input_type, outputs, output_type, protocol_ids in self.links
+                for source_id, source_type, destination_id, destination_type in chain(
+                    ((input_id, input_type, process_id, 'process') for input_id in inputs),
+                    ((process_id, 'process', output_id, output_type) for output_id in outputs),
+                    ((process_id, 'process', protocol_id, 'protocol') for protocol_id in protocol_ids))
+            ]
+        }
+        return metadata_files
+
+    def _vx_metadata_files(self) -> JSON:
+        update_date = self.version[:13] + ':' + self.version[13:15] + ':' + self.version[15:20] + 'Z'
+        counters: MutableMapping[str, Iterator[int]] = defaultdict(count)
+        metadata_files = {}
+        for core_type, schema_name, document_id, content in self.documents:
+            file_name = f'{schema_name}_{next(counters[schema_name])}.json'
+            metadata_files[file_name] = {
+                **self._content(core_type, schema_name, content),
+                'provenance': {
+                    'document_id': document_id,
+                    'update_date': update_date
+                }
+            }
+        metadata_files['links.json'] = {
+            'links': [
+                dict(process=process_id,
+                     inputs=inputs,
+                     input_type=input_type,
+                     outputs=outputs,
+                     output_type=output_type,
+                     protocols=[dict(protocol_id=protocol_id, protocol_type=self.protocol_types[protocol_id])
+                                for protocol_id in protocol_ids])
+                for process_id, inputs, input_type, outputs, output_type, protocol_ids in self.links
+            ]
+        }
+        return metadata_files
+
+
+class LocalDSSClient:
+    """
+    A stand-in for the DSS client that serves bundles from memory. It implements the subset of the DSSClient API
+    used by download_bundle_metadata() and by crawlers listing bundles: get_bundle() with pagination, get_file() and
+    post_search.iterate(). Search queries are ignored, every bundle matches.
+
+    >>> client = LocalDSSClient(SyntheticCorpus(3, seed=1), page_size=4)
+    >>> fqids = [hit['bundle_fqid'] for hit in client.post_search.iterate(es_query={}, replica='aws')]
+    >>> len(fqids)
+    3
+    >>> uuid, _, version = fqids[0].partition('.')
+    >>> pages = list(client.get_bundle.paginate(uuid=uuid, version=version, replica='aws'))
+    >>> [len(page['bundle']['files']) for page in pages]
+    [4, 4, 4, 4, 1]
+    >>> client.get_bundle(uuid=uuid, replica='aws')['bundle']['version'] == version
+    True
+    >>> client.get_file(uuid=uuid, version=version, replica='aws')
+    Traceback (most recent call last):
+    ...
+    hca.util.exceptions.SwaggerAPIException: Not Found, code 404
+    """
+
+    def __init__(self, bundles: Iterable[BundleTuple] = (), page_size: int = 500, latency: float = 0.0) -> None:
+        """
+        :param bundles: the bundles to serve, as tuples of UUID, version, manifest and metadata files
+
+        :param page_size: the maximum number of manifest entries per page returned by get_bundle.paginate()
+
+        :param latency: the number of seconds to sleep in each request, to simulate network latency
+        """
+        self.page_size = page_size
+        self.latency = latency
+        self.bundles: MutableMapping[str, MutableMapping[str, List[JSON]]] = defaultdict(dict)
+        self.files: MutableMapping[Tuple[str, str], JSON] = {}
+        self.get_bundle = _GetBundle(self)
+        self.post_search = _PostSearch(self)
+        for bundle in bundles:
+            self.add(*bundle)
+
+    def add(self, uuid: str, version: str, manifest: List[JSON], metadata_files: Mapping[str, JSON]) -> None:
+        """
+        Add a bundle to the bundles served by this client.
+        """
+        self.bundles[uuid][version] = manifest
+        for entry in manifest:
+            try:
+                file_contents = metadata_files[entry['name']]
+            except KeyError:
+                pass
+            else:
+                self.files[entry['uuid'], entry['version']] = file_contents
+
+    def get_file(self, uuid: str, replica: str, version: Optional[str] = None) -> JSON:
+        self._sleep()
+        if version is None:
+            versions = [v for u, v in self.files.keys() if u == uuid]
+            if not versions:
+                raise _not_found()
+            version = max(versions)
+        try:
+            return self.files[uuid, version]
+        except KeyError:
+            raise _not_found()
+
+    def _manifest(self, uuid: str, version: Optional[str]) -> Tuple[str, List[JSON]]:
+        try:
+            versions = self.bundles.get(uuid, {})
+            if version is None:
+                version = max(versions)
+            return version, versions[version]
+        except (KeyError, ValueError):
+            raise _not_found()
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _GetBundle:
+
+    def __init__(self, client: LocalDSSClient) -> None:
+        self.client = client
+
+    def __call__(self, uuid: str, replica: str, version: Optional[str] = None, per_page: Optional[int] = None,
+                 **kwargs) -> JSON:
+        self.client._sleep()
+        version, manifest = self.client._manifest(uuid, version)
+        return {'bundle': {'uuid': uuid, 'version': version, 'files': manifest[:per_page]}}
+
+    def paginate(self, uuid: str, replica: str, version: Optional[str] = None, **kwargs) -> Iterator[JSON]:
+        version, manifest = self.client._manifest(uuid, version)
+        page_size = self.client.page_size
+        for i in range(0, max(1, len(manifest)), page_size):
+            self.client._sleep()
+            yield {'bundle': {'uuid': uuid, 'version': version, 'files': manifest[i:i + page_size]}}
+
+
+class _PostSearch:
+
+    def __init__(self, client: LocalDSSClient) -> None:
+        self.client = client
+
+    def iterate(self, es_query: JSON, replica: str, **kwargs) -> Iterator[JSON]:
+        for uuid, versions in list(self.client.bundles.items()):
+            for version in sorted(versions):
+                yield {'bundle_fqid': f'{uuid}.{version}'}
+
+
+def _not_found() -> Exception:
+    from hca.util.exceptions import SwaggerAPIException
+    from requests import Response
+    response = Response()
+    response.status_code = 404
+    response.reason = 'Not Found'
+    response._content = b''
+    return SwaggerAPIException(response=response)
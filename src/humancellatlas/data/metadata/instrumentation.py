@@ -0,0 +1,161 @@
+from abc import (
+    ABC,
+    abstractmethod,
+)
+from contextlib import contextmanager
+from threading import Lock
+import time
+from typing import (
+    Callable,
+    MutableMapping,
+    Optional,
+)
+
+from dataclasses import dataclass
+
+
+class Instrument(ABC):
+    """
+    Receives measurements from the stages of downloading, constructing and serializing a bundle. Pass an instance to
+    download_bundle_metadata(), Bundle() or as_json() to enable instrumentation. Instrumentation is disabled by
+    default, in which case none of the measurements are taken.
+
+    Implementations must be thread-safe because download_bundle_metadata() downloads files in parallel.
+
+    These are the stages currently reported:
+
+    `cache`: looking up a bundle in the cache passed to download_bundle_metadata()
+
+    `manifest_cache`: a bundle manifest found in the manifest cache passed to download_bundle_metadata(), with the
+    number of manifest entries
+
+    `get_bundle`: the retrieval of one page of the bundle manifest, with the number of manifest entries in that page
+
+    `get_file`: the download of one metadata file, with the size of that file according to the manifest. The time
+    includes the decoding of the file's JSON if the DSS client decodes it, which is not the case for clients returned
+    by dss_client().
+
+    `retry.<failure class>`: a retry of a failed request to the DSS by the Retrier passed to
+    download_bundle_metadata(), with the time spent backing off before the retry
+
+    `wire`: the number of bytes transferred to download one metadata file, which is less than the file's size if
+    the server compressed the response
+
+    `compress`: the compression of one file or record written to a local mirror or pack, with its uncompressed size
+
+    `disk`: the number of bytes written to disk for one file or record in a local mirror or pack
+
+    `json_decode`: the decoding of one JSON file by decode_json(), with its size in bytes, when downloading files
+    from the DSS or reading them from a local bundle source
+
+    `manifest`: the creation of all manifest entries of a bundle, with the number of entries
+
+    `construct.<EntityClass>`: the construction of one entity of the given class from its JSON
+
+    `links`: the parsing of the links in a bundle, with the number of links
+
+    `connect`: connecting the entities of a bundle according to its links
+
+    `as_json`: the serialization of a bundle or entity
+    """
+
+    @abstractmethod
+    def record(self, stage: str, seconds: float, count: int = 0, size: int = 0) -> None:
+        """
+        Record the time spent in one invocation of a stage.
+
+        :param stage: the name of the stage
+
+        :param seconds: the wall clock time spent in the stage
+
+        :param count: the number of items (files, entries, links) processed by the stage, if applicable
+
+        :param size: the number of bytes processed by the stage, if applicable
+        """
+        raise NotImplementedError()
+
+
+class CallbackInstrument(Instrument):
+    """
+    An instrument that passes every measurement to the given callable.
+
+    >>> i = CallbackInstrument(lambda *args: print(*args))
+    >>> i.record('links', 0.5, count=2)
+    links 0.5 2 0
+    """
+
+    def __init__(self, callback: Callable[[str, float, int, int], None]) -> None:
+        self.callback = callback
+
+    def record(self, stage: str, seconds: float, count: int = 0, size: int = 0) -> None:
+        self.callback(stage, seconds, count, size)
+
+
+@dataclass
+class StageTiming:
+    calls: int = 0
+    seconds: float = 0.0
+    count: int = 0
+    size: int = 0
+
+
+class TimingReport(Instrument):
+    """
+    An instrument that accumulates the measurements for each stage. Use one instance per bundle to get a timing
+    report for that bundle, or share an instance between bundles to get aggregated timings.
+
+    >>> r = TimingReport()
+    >>> r.record('get_file', 0.25, count=1, size=1000)
+    >>> r.record('get_file', 0.5, count=1, size=24)
+    >>> r.stages['get_file']
+    StageTiming(calls=2, seconds=0.75, count=2, size=1024)
+    >>> r.total_seconds
+    0.75
+    >>> print(r)
+    stage                              calls   seconds    count       bytes
+    get_file                               2     0.750        2        1024
+    """
+
+    def __init__(self) -> None:
+        self.stages: MutableMapping[str, StageTiming] = {}
+        self._lock = Lock()
+
+    def record(self, stage: str, seconds: float, count: int = 0, size: int = 0) -> None:
+        with self._lock:
+            try:
+                timing = self.stages[stage]
+            except KeyError:
+                timing = self.stages[stage] = StageTiming()
+            timing.calls += 1
+            timing.seconds += seconds
+            timing.count += count
+            timing.size += size
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(timing.seconds for timing in self.stages.values())
+
+    def __str__(self) -> str:
+        lines = [f"{'stage':<32} {'calls':>7} {'seconds':>9} {'count':>8} {'bytes':>11}"]
+        for stage, timing in self.stages.items():
+            lines.append(f'{stage:<32} {timing.calls:>7} {timing.seconds:>9.3f} {timing.count:>8} {timing.size:>11}')
+        return '\n'.join(lines)
+
+
+@contextmanager
+def timed(instrument: Optional[Instrument], stage: str, count: int = 0, size: int = 0):
+    """
+    A context manager that reports the time spent in its body to the given instrument, if any.
+
+    >>> with timed(CallbackInstrument(lambda stage, seconds, count, size: print(stage, count)), 'connect', 3):
+    ...     pass
+    connect 3
+    >>> with timed(None, 'connect'):
+    ...     pass
+    """
+    if instrument is None:
+        yield
+    else:
+        start = time.perf_counter()
+        yield
+        instrument.record(stage, time.perf_counter() - start, count, size)
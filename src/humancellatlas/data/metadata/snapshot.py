@@ -0,0 +1,508 @@
+"""
+A compact binary snapshot format for constructed Bundle instances.
+
+Reconstructing a bundle from its manifest and metadata files involves JSON parsing, UUID construction and the
+extraction of every entity field. A snapshot stores the result of that work: the extracted entity fields, the manifest
+entries and the links between entities. The raw JSON of each entity is not included. Entities loaded from a snapshot
+therefore have their `json` attribute set to None.
+
+A snapshot consists of a fixed-size header followed by these sections, all little-endian:
+
+1) the length in code points of each string in the string table (uint32 array)
+
+2) the UTF-8 encoded concatenation of all strings in the string table
+
+3) the UUID table, 16 bytes per UUID
+
+4) a table of integers that are too large to be inlined (int64 array)
+
+5) a table of floating point values (float64 array)
+
+6) the value stream (uint32 array), a sequence of tagged words describing record schemas, the manifest and the
+   entities. The manifest is stored column by column.
+
+7) the links, four uint32 words per link: source UUID, source type, destination UUID and destination type
+
+Each record in the value stream refers to a schema listing the names of the record's fields. Schemas are stored in the
+snapshot itself, so a snapshot written by one version of this library can be read by another as long as the record
+types it refers to still exist. Fields missing from a snapshot are set to None, fields unknown to the reader are
+ignored.
+"""
+from array import array
+import io
+from functools import lru_cache
+from itertools import (
+    accumulate,
+    chain,
+    islice,
+)
+import mmap
+import struct
+import sys
+from typing import (
+    BinaryIO,
+    Callable,
+    List,
+    Mapping,
+    MutableMapping,
+    Sequence,
+    Tuple,
+    Type,
+    Union,
+)
+from uuid import UUID
+
+from dataclasses import fields
+
+from humancellatlas.data.metadata.api import (
+    Biomaterial,
+    Bundle,
+    Entity,
+    File,
+    ImagingTarget,
+    Link,
+    ManifestEntry,
+    Process,
+    Project,
+    ProjectContact,
+    ProjectPublication,
+    Protocol,
+    core_types,
+    entity_types,
+    init_link_fields,
+    link_fields,
+    schema_names,
+)
+
+MAGIC = b'HCAB'
+
+FORMAT_VERSION = 1
+
+# magic, format version, flags, total size, then the element counts of the sections
+#
+_header = struct.Struct('<4sHHIIIIIIII')
+
+_T_NONE = 0
+_T_FALSE = 1
+_T_TRUE = 2
+_T_INT = 3  # payload is the value
+_T_BIGINT = 4  # payload is an index into the integer table
+_T_FLOAT = 5
+_T_STR = 6
+_T_UUID = 7
+_T_LIST = 8  # payload is the number of elements that follow
+_T_SET = 9
+_T_TUPLE = 10
+_T_RECORD = 11  # payload is the schema index, the field values follow
+_T_MANIFEST_ENTRY = 12  # payload is an index into the manifest
+
+_TAG_BITS = 4
+_TAG_MASK = (1 << _TAG_BITS) - 1
+_MAX_PAYLOAD = (1 << (32 - _TAG_BITS)) - 1
+
+# Value types that may occur in entity fields, by name
+#
+_value_types = {
+    cls.__name__: cls for cls in (ProjectPublication, ProjectContact, ImagingTarget)
+}
+
+_core_type_fields = {
+    Project: 'projects',
+    Biomaterial: 'biomaterials',
+    Process: 'processes',
+    Protocol: 'protocols',
+    File: 'files',
+}
+
+_little_endian = sys.byteorder == 'little'
+
+_manifest_field_names = [f.name for f in fields(ManifestEntry)]
+
+_value_type_field_names = {
+    name: [f.name for f in fields(cls)] for name, cls in _value_types.items()
+}
+
+
+@lru_cache(maxsize=None)
+def _field_names(cls: type) -> List[str]:
+    return [f.name for f in fields(cls) if f.name != 'json' and f.name not in link_fields]
+
+
+class _Writer:
+
+    def __init__(self) -> None:
+        self.strings: MutableMapping[str, int] = {}
+        self.uuids: MutableMapping[UUID, int] = {}
+        self.big_ints = array('q')
+        self.floats = array('d')
+        self.words = array('I')
+        self.schemas: MutableMapping[str, Tuple[int, List[str]]] = {}
+        self.manifest: MutableMapping[int, int] = {}
+
+    def word(self, tag: int, payload: int) -> None:
+        if payload > _MAX_PAYLOAD:
+            raise OverflowError('Snapshot section too large', payload)
+        self.words.append(tag | payload << _TAG_BITS)
+
+    def string(self, s: str) -> int:
+        try:
+            return self.strings[s]
+        except KeyError:
+            i = self.strings[s] = len(self.strings)
+            return i
+
+    def uuid(self, u: UUID) -> int:
+        try:
+            return self.uuids[u]
+        except KeyError:
+            i = self.uuids[u] = len(self.uuids)
+            return i
+
+    def schema(self, name: str, cls: type) -> int:
+        try:
+            i, _ = self.schemas[name]
+        except KeyError:
+            i = len(self.schemas)
+            self.schemas[name] = i, _field_names(cls)
+        return i
+
+    def value(self, v) -> None:
+        if v is None:
+            self.word(_T_NONE, 0)
+        elif v is True:
+            self.word(_T_TRUE, 0)
+        elif v is False:
+            self.word(_T_FALSE, 0)
+        elif isinstance(v, str):
+            self.word(_T_STR, self.string(v))
+        elif isinstance(v, UUID):
+            self.word(_T_UUID, self.uuid(v))
+        elif isinstance(v, int):
+            if 0 <= v <= _MAX_PAYLOAD:
+                self.word(_T_INT, v)
+            else:
+                self.word(_T_BIGINT, len(self.big_ints))
+                self.big_ints.append(v)
+        elif isinstance(v, float):
+            self.word(_T_FLOAT, len(self.floats))
+            self.floats.append(v)
+        elif isinstance(v, (list, set, frozenset, tuple)):
+            tag = _T_LIST if isinstance(v, list) else _T_TUPLE if isinstance(v, tuple) else _T_SET
+            self.word(tag, len(v))
+            for e in v:
+                self.value(e)
+        elif isinstance(v, ManifestEntry):
+            self.word(_T_MANIFEST_ENTRY, self.manifest[id(v)])
+        elif isinstance(v, Entity):
+            self.record(schema_names[type(v)], v)
+        elif type(v).__name__ in _value_types:
+            self.record(type(v).__name__, v)
+        else:
+            raise TypeError('Cannot store value in bundle snapshot', type(v))
+
+    def scalar(self, v) -> None:
+        if v is None or isinstance(v, (str, UUID, int, float)):
+            self.value(v)
+        else:
+            raise TypeError('Expected scalar value', type(v))
+
+    def record(self, name: str, obj) -> None:
+        i = self.schema(name, type(obj))
+        self.word(_T_RECORD, i)
+        for field_name in self.schemas[name][1]:
+            self.value(getattr(obj, field_name))
+
+    def write(self, bundle: Bundle, fp: BinaryIO) -> None:
+        self.value(bundle.uuid)
+        self.value(bundle.version)
+        # The manifest is stored column by column, one column per field of ManifestEntry
+        manifest = list(bundle.manifest.values())
+        field_names = _manifest_field_names
+        self.word(_T_LIST, len(manifest))
+        self.value(field_names)
+        for field_name in field_names:
+            for entry in manifest:
+                self.scalar(getattr(entry, field_name))
+        for i, entry in enumerate(manifest):
+            self.manifest[id(entry)] = i
+        self.word(_T_LIST, len(bundle.entities))
+        for entity in bundle.entities.values():
+            self.value(entity)
+        links = array('I')
+        for link in bundle.links:
+            links.extend((self.uuid(link.source_id),
+                          self.string(link.source_type),
+                          self.uuid(link.destination_id),
+                          self.string(link.destination_type)))
+
+        # The schema table is prepended to the value stream because the schemas are only known after all records
+        # were written.
+        words, self.words = self.words, array('I')
+        self.word(_T_LIST, len(self.schemas))
+        for name, (_, field_names) in self.schemas.items():
+            self.word(_T_STR, self.string(name))
+            self.word(_T_LIST, len(field_names))
+            for field_name in field_names:
+                self.word(_T_STR, self.string(field_name))
+        self.words.extend(words)
+
+        strings = list(self.strings.keys())
+        string_lengths = array('I', map(len, strings))
+        string_data = ''.join(strings).encode()
+        uuid_data = b''.join(u.bytes for u in self.uuids.keys())
+        sections = [string_lengths, string_data, uuid_data, self.big_ints, self.floats, self.words, links]
+        if not _little_endian:  # pragma: no cover
+            for section in sections:
+                if isinstance(section, array):
+                    section.byteswap()
+        sections = [section if isinstance(section, bytes) else section.tobytes() for section in sections]
+        size = _header.size + sum(map(len, sections))
+        fp.write(_header.pack(MAGIC, FORMAT_VERSION, 0, size,
+                              len(strings),
+                              len(string_data),
+                              len(self.uuids),
+                              len(self.big_ints),
+                              len(self.floats),
+                              len(self.words),
+                              len(bundle.links)))
+        for section in sections:
+            fp.write(section)
+
+
+def dump(bundle: Bundle, fp: BinaryIO) -> None:
+    """
+    Write a snapshot of the given bundle to the given binary file object.
+    """
+    _Writer().write(bundle, fp)
+
+
+def dumps(bundle: Bundle) -> bytes:
+    """
+    Return a snapshot of the given bundle.
+    """
+    buf = io.BytesIO()
+    dump(bundle, buf)
+    return buf.getvalue()
+
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+def load(fp: BinaryIO) -> Bundle:
+    """
+    Read a bundle snapshot starting at the current position of the given binary file object and leave the position
+    at the end of the snapshot. If the file object has a file descriptor, the snapshot is read through a memory map
+    instead of being copied into memory first.
+    """
+    try:
+        fileno = fp.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        buf = fp.read(_header.size)
+        buf += fp.read(_size(buf) - len(buf))
+        bundle = loads(buf)
+    else:
+        offset = fp.tell()
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as buf:
+            view = memoryview(buf)
+            try:
+                bundle = loads(view[offset:])
+                offset += _size(view[offset:])
+            finally:
+                view.release()
+        fp.seek(offset)
+    return bundle
+
+
+def _size(buf: Buffer) -> int:
+    if len(buf) < _header.size:
+        raise ValueError('Not a bundle snapshot')
+    magic, version, _, size, *_ = _header.unpack_from(buf)
+    if magic != MAGIC:
+        raise ValueError('Not a bundle snapshot')
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported bundle snapshot version', version)
+    return size
+
+
+def loads(buf: Buffer) -> Bundle:
+    """
+    Read a bundle from the snapshot at the beginning of the given buffer. Any data following the snapshot is ignored.
+    """
+    if len(buf) < _size(buf):
+        raise ValueError('Truncated bundle snapshot')
+    (_, _, _, _,
+     num_strings,
+     string_data_size,
+     num_uuids,
+     num_big_ints,
+     num_floats,
+     num_words,
+     num_links) = _header.unpack_from(buf)
+    view = memoryview(buf)
+    offset = _header.size
+
+    def section(typecode: str, n: int) -> array:
+        nonlocal offset
+        a = array(typecode)
+        size = n * a.itemsize
+        a.frombytes(view[offset:offset + size])
+        offset += size
+        if not _little_endian:  # pragma: no cover
+            a.byteswap()
+        return a
+
+    string_lengths = section('I', num_strings)
+    string_data = str(view[offset:offset + string_data_size], 'utf-8')
+    offset += string_data_size
+    ends = list(accumulate(string_lengths))
+    strings = [string_data[i:j] for i, j in zip(chain((0,), ends), ends)]
+    uuid_data = view[offset:offset + 16 * num_uuids]
+    offset += len(uuid_data)
+    from_bytes = int.from_bytes
+    uuids = [UUID(int=from_bytes(uuid_data[i:i + 16], 'big')) for i in range(0, len(uuid_data), 16)]
+    big_ints = section('q', num_big_ints).tolist()
+    floats = section('d', num_floats).tolist()
+    words = section('I', num_words).tolist()
+    links = section('I', 4 * num_links).tolist()
+    view.release()
+    return _Reader(strings, uuids, big_ints, floats, words).read(links)
+
+
+class _Reader:
+
+    def __init__(self,
+                 strings: Sequence[str],
+                 uuids: Sequence[UUID],
+                 big_ints: Sequence[int],
+                 floats: Sequence[float],
+                 words: Sequence[int]) -> None:
+        self.strings = strings
+        self.uuids = uuids
+        self.big_ints = big_ints
+        self.floats = floats
+        self.words = iter(words)
+        self.next_word = self.words.__next__
+        self.schemas: List[Callable[[], object]] = []
+        self.manifest: List[ManifestEntry] = []
+
+    def value(self):
+        return self.decode(self.next_word())
+
+    def decode(self, w: int):
+        tag, payload = w & _TAG_MASK, w >> _TAG_BITS
+        if tag == _T_STR:
+            return self.strings[payload]
+        elif tag == _T_NONE:
+            return None
+        elif tag == _T_UUID:
+            return self.uuids[payload]
+        elif tag == _T_SET:
+            return {self.value() for _ in range(payload)}
+        elif tag == _T_RECORD:
+            return self.schemas[payload]()
+        elif tag == _T_MANIFEST_ENTRY:
+            return self.manifest[payload]
+        elif tag == _T_INT:
+            return payload
+        elif tag == _T_TRUE:
+            return True
+        elif tag == _T_FALSE:
+            return False
+        elif tag == _T_LIST:
+            return [self.value() for _ in range(payload)]
+        elif tag == _T_TUPLE:
+            return tuple(self.value() for _ in range(payload))
+        elif tag == _T_FLOAT:
+            return self.floats[payload]
+        elif tag == _T_BIGINT:
+            return self.big_ints[payload]
+        else:
+            raise ValueError('Corrupt bundle snapshot', tag)
+
+    def column(self, n: int) -> List:
+        words = list(islice(self.words, n))
+        tags = {w & _TAG_MASK for w in words}
+        if tags == {_T_STR}:
+            strings = self.strings
+            return [strings[w >> _TAG_BITS] for w in words]
+        elif tags == {_T_UUID}:
+            uuids = self.uuids
+            return [uuids[w >> _TAG_BITS] for w in words]
+        elif tags == {_T_INT}:
+            return [w >> _TAG_BITS for w in words]
+        else:
+            return list(map(self.decode, words))
+
+    def manifest_entries(self) -> List[ManifestEntry]:
+        n = self._count()
+        stored_field_names = self.value()
+        columns = {field_name: self.column(n) for field_name in stored_field_names}
+        field_names = _manifest_field_names
+        if stored_field_names != field_names:
+            columns = {field_name: columns.get(field_name, [None] * n) for field_name in field_names}
+        return list(map(ManifestEntry, *columns.values()))
+
+    def factory(self, name: str, stored_field_names: List[str]) -> Callable[[], object]:
+        value = self.value
+        if name in _value_types:
+            cls = _value_types[name]
+            field_names = _value_type_field_names[name]
+            if stored_field_names == field_names:
+                def new_record():
+                    return cls(*[value() for _ in field_names])
+            else:
+                def new_record():
+                    kwargs = dict.fromkeys(field_names)
+                    for field_name in stored_field_names:
+                        kwargs[field_name] = value()
+                    return cls(**{k: v for k, v in kwargs.items() if k in field_names})
+        else:
+            try:
+                cls = entity_types[name]
+            except KeyError:
+                raise ValueError('Unknown record type in bundle snapshot', name)
+            defaults = dict.fromkeys(_field_names(cls))
+            defaults['json'] = None
+            new = cls.__new__
+
+            def new_record():
+                entity = new(cls)
+                attrs = entity.__dict__
+                attrs.update(defaults)
+                for field_name in stored_field_names:
+                    attrs[field_name] = value()
+                init_link_fields(entity)
+                return entity
+        return new_record
+
+    def read(self, links: Sequence[int]) -> Bundle:
+        value = self.value
+        for _ in range(self._count()):
+            name = value()
+            field_names = value()
+            self.schemas.append(self.factory(name, field_names))
+        bundle = Bundle.__new__(Bundle)
+        bundle.uuid = value()
+        bundle.version = value()
+        self.manifest = self.manifest_entries()
+        bundle.manifest = {entry.name: entry for entry in self.manifest}
+        entities_by_core_type: Mapping[Type[Entity], MutableMapping[UUID, Entity]] = {
+            core_type: {} for core_type in _core_type_fields.keys()
+        }
+        for _ in range(self._count()):
+            entity = value()
+            entities_by_core_type[core_types[type(entity)]][entity.document_id] = entity
+        for core_type, entities in entities_by_core_type.items():
+            setattr(bundle, _core_type_fields[core_type], entities)
+        bundle.entities = {k: v for entities in entities_by_core_type.values() for k, v in entities.items()}
+        uuids, strings = self.uuids, self.strings
+        bundle.links = [Link(uuids[links[i]], strings[links[i + 1]], uuids[links[i + 2]], strings[links[i + 3]])
+                        for i in range(0, len(links), 4)]
+        bundle._connect_entities()
+        return bundle
+
+    def _count(self) -> int:
+        w = self.next_word()
+        if w & _TAG_MASK != _T_LIST:
+            raise ValueError('Corrupt bundle snapshot', w & _TAG_MASK)
+        return w >> _TAG_BITS
@@ -0,0 +1,180 @@
+"""
+Micro-benchmarks for the construction, traversal and serialization of Bundle objects.
+
+Run `python test/benchmark.py --help` for usage. The benchmark times each operation on the canned bundles in
+test/cans and on synthetic bundles of increasing size in both the v5 and the vx layout. For every case and
+operation it reports the best wall-clock time of several repetitions and the peak memory allocated during one
+additional, traced repetition.
+
+Results can be saved as a baseline and later runs can be compared against that baseline. An operation regresses if
+its time or its peak memory exceeds that of the baseline by more than the given fraction, in which case the exit
+status is non-zero.
+Timings are only comparable between runs on the same machine.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from typing import (
+    Callable,
+    Iterator,
+    List,
+    Mapping,
+    Tuple,
+)
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    JSON,
+)
+from humancellatlas.data.metadata.helpers.json import as_json
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    synthetic_bundle,
+)
+
+import canning
+
+log = logging.getLogger(__name__)
+
+# The name, number of entities, UUID, version, manifest and metadata files of a bundle to be benchmarked
+#
+Case = Tuple[str, int, str, str, List[JSON], JSON]
+
+# The best time in seconds and the peak number of bytes allocated by an operation
+#
+Measurement = Tuple[float, int]
+
+default_sizes = (10, 100, 1000, 10000, 100000)
+
+# Bundles with at least this many entities are slow enough to be measured reliably by a single invocation
+#
+single_invocation_entities = 1000
+
+
+def cases(sizes: List[int], canned: bool = True) -> Iterator[Case]:
+    if canned:
+        for uuid, version, manifest, metadata_files in canning.canned_bundles():
+            num_entities = len(Bundle(uuid, version, manifest, metadata_files).entities)
+            yield f'canned/{uuid}.{version}', num_entities, uuid, version, manifest, metadata_files
+    # Each donor adds the same number of entities to the project and protocols common to all donors
+    per_donor = BundleShape(donors=2).num_entities - BundleShape(donors=1).num_entities
+    common = BundleShape(donors=1).num_entities - per_donor
+    for layout in ('v5', 'vx'):
+        for size in sizes:
+            shape = BundleShape(donors=max(1, (size - common) // per_donor))
+            yield (f'synthetic/{layout}/{size}', shape.num_entities, *synthetic_bundle(shape, layout, seed=size))
+
+
+def operations(case: Case) -> Iterator[Tuple[str, Callable[[], object]]]:
+    """
+    Yield the name and a callable for each benchmarked operation on the given case.
+    """
+    name, _, uuid, version, manifest, metadata_files = case
+    yield 'construct', lambda: Bundle(uuid, version, manifest, metadata_files)
+    bundle = Bundle(uuid, version, manifest, metadata_files)
+    yield 'root_entities', bundle.root_entities
+    yield 'sequencing_output', lambda: bundle.sequencing_output
+    yield 'as_json', lambda: as_json(bundle)
+
+
+def measure(operation: Callable[[], object], repeat: int) -> Measurement:
+    """
+    Return the best time of the given number of invocations of the given callable and the peak memory allocated
+    during an additional invocation.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def repetitions(case: Case, repeat: int) -> int:
+    """
+    Return the number of times to invoke each operation on the given case when measuring its time.
+    """
+    num_entities = case[1]
+    return repeat if num_entities < single_invocation_entities else 1
+
+
+def run(sizes: List[int], repeat: int, canned: bool = True) -> Mapping[str, Mapping[str, Measurement]]:
+    results = {}
+    for case in cases(sizes, canned):
+        name = case[0]
+        results[name] = {}
+        for operation_name, operation in operations(case):
+            seconds, peak = results[name][operation_name] = measure(operation, repetitions(case, repeat))
+            log.info('%-72s %-18s %10.6fs %12i bytes', name, operation_name, seconds, peak)
+    return results
+
+
+def regressions(results: Mapping[str, Mapping[str, Measurement]],
+                baseline: Mapping[str, Mapping[str, Measurement]],
+                threshold: float) -> List[str]:
+    """
+    Return a description of every operation whose time or peak memory exceeds that of the baseline by more than the
+    given fraction.
+
+    >>> baseline = {'a': {'x': (1.0, 1000), 'y': (1.0, 1000)}}
+    >>> regressions({'a': {'x': (1.3, 1000), 'y': (1.1, 1300)}, 'b': {'x': (1.0, 0)}}, baseline, 0.2)
+    ['a x: 1.300000s vs. 1.000000s (+30%)', 'a y: 1300 bytes vs. 1000 bytes (+30%)']
+    """
+    messages = []
+    for name, measurements in results.items():
+        for operation_name, (seconds, peak) in measurements.items():
+            try:
+                baseline_seconds, baseline_peak = baseline[name][operation_name]
+            except KeyError:
+                continue
+            if seconds > baseline_seconds * (1 + threshold):
+                change = seconds / baseline_seconds - 1
+                messages.append(f'{name} {operation_name}: {seconds:.6f}s vs. {baseline_seconds:.6f}s ({change:+.0%})')
+            if peak > baseline_peak * (1 + threshold):
+                change = peak / baseline_peak - 1 if baseline_peak else float('inf')
+                messages.append(f'{name} {operation_name}: {peak} bytes vs. {baseline_peak} bytes ({change:+.0%})')
+    return messages
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='*', default=default_sizes,
+                        help='The approximate number of entities in each synthetic bundle')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='The number of times to invoke each operation on small bundles')
+    parser.add_argument('--no-canned', dest='canned', action='store_false',
+                        help='Skip the canned bundles')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Save the results as a baseline to the given file')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='Compare the results against the baseline in the given file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='The fraction by which an operation may exceed its baseline time and peak memory')
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    results = run(options.sizes, options.repeat, options.canned)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=4)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        messages = regressions(results, baseline, options.threshold)
+        for message in messages:
+            log.error('Regression in %s', message)
+        if messages:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
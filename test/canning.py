@@ -0,0 +1,18 @@
+import os
+from typing import (
+    Iterator,
+    List,
+    Tuple,
+)
+
+from humancellatlas.data.metadata.api import JSON
+from humancellatlas.data.metadata.helpers.source import DirectoryBundleSource
+
+cans_dir = os.path.join(os.path.dirname(__file__), 'cans')
+
+
+def canned_bundles() -> Iterator[Tuple[str, str, List[JSON], JSON]]:
+    """
+    Yield the UUID, version, manifest and metadata files of every canned bundle in the test/cans directory
+    """
+    return DirectoryBundleSource(cans_dir).bundles()
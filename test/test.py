@@ -2,13 +2,18 @@ from concurrent.futures import (
     ThreadPoolExecutor,
     wait,
 )
+import copy
 import doctest
+import gc
+import io
 from itertools import chain
 from more_itertools import one
 import json
 import logging
 import os
 import re
+import threading
+import time
 from unittest import (
     TestCase,
     skip,
@@ -16,11 +21,11 @@ from unittest import (
 from unittest.mock import Mock
 from uuid import UUID
 import warnings
-
-from atomicwrites import atomic_write
+import weakref
 
 from humancellatlas.data.metadata.api import (
     AgeRange,
+    BackReferences,
     Biomaterial,
     Bundle,
     DonorOrganism,
@@ -35,13 +40,25 @@ from humancellatlas.data.metadata.api import (
     SequencingProtocol,
     SupplementaryFile,
     ImagedSpecimen,
+    link_fields,
 )
+from humancellatlas.data.metadata.helpers.diff import diff_bundles
 from humancellatlas.data.metadata.helpers.dss import (
+    ManifestCache,
     download_bundle_metadata,
     dss_client,
+    resolve_latest_versions,
+    schema_filter,
 )
 from humancellatlas.data.metadata.helpers.json import as_json
 from humancellatlas.data.metadata.helpers.schema_examples import download_example_bundle
+from humancellatlas.data.metadata.helpers.source import DirectoryBundleSource
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    LocalDSSClient,
+    synthetic_bundle,
+)
+from humancellatlas.data.metadata.instrumentation import TimingReport
 
 
 def setUpModule():
@@ -138,33 +155,25 @@ class TestAccessorApi(TestCase):
                             metadata_files=metadata_files,
                             **kwargs)
 
-    def _canned_bundle_path(self, directory, uuid, version):
-        return os.path.join(os.path.dirname(__file__), 'cans', directory, uuid, version)
+    def _canned_bundle_source(self, directory):
+        return DirectoryBundleSource(os.path.join(os.path.dirname(__file__), 'cans', directory))
 
     def _can_bundle(self, directory, uuid, version, manifest, metadata_files):  # pragma: no cover
         """
         Save a bundle's manifest & metadata files to a local directory
         """
-        dir_path = self._canned_bundle_path(directory, uuid, version)
-        os.makedirs(dir_path, exist_ok=True)
-        with atomic_write(os.path.join(dir_path, 'manifest.json'), overwrite=True) as f:
-            json.dump(manifest, f)
-        with atomic_write(os.path.join(dir_path, 'metadata.json'), overwrite=True) as f:
-            json.dump(metadata_files, f)
+        self._canned_bundle_source(directory).put(uuid, version, manifest, metadata_files)
 
     def _canned_bundle(self, directory, uuid, version):
         """
         Load a previously canned bundle
         """
-        dir_path = self._canned_bundle_path(directory, uuid, version)
-        if os.path.isdir(dir_path):
-            with open(os.path.join(dir_path, 'manifest.json')) as f:
-                manifest = json.load(f)
-            with open(os.path.join(dir_path, 'metadata.json')) as f:
-                metadata_files = json.load(f)
-            return manifest, metadata_files
-        else:
+        try:
+            _, manifest, metadata_files = self._canned_bundle_source(directory).get(uuid, version)
+        except KeyError:
             return None, None
+        else:
+            return manifest, metadata_files
 
     def _load_bundle(self, uuid, version, replica='aws', deployment='prod'):
         """
@@ -672,6 +681,342 @@ class TestAccessorApi(TestCase):
 
         assert_bundle()
 
+    def test_manifest_referenced_only(self):
+        uuid = '86e7b58e-b9f0-4020-8b34-c61d6da02d44'
+        version = '2019-09-20T103932.395795Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        bundle = Bundle(uuid, version, manifest, metadata_files)
+        compact_bundle = Bundle(uuid, version, manifest, metadata_files, manifest_referenced_only=True)
+        self.assertEqual(len(manifest), len(bundle.manifest))
+        file_names = {file.manifest_entry.name for file in bundle.files.values()}
+        self.assertLess(len(file_names), len(manifest))
+        self.assertEqual(file_names, compact_bundle.manifest.keys())
+        self.assertIs(dict, type(compact_bundle.manifest))
+        for file in compact_bundle.files.values():
+            self.assertIs(file.manifest_entry, compact_bundle.manifest[file.manifest_entry.name])
+            self.assertEqual(bundle.manifest[file.manifest_entry.name], file.manifest_entry)
+        self.assertFalse(hasattr(file.manifest_entry, '__dict__'))
+        self.assertTrue(isinstance(json.dumps(as_json(compact_bundle)), str))
+
+    def test_interned_labels(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        bundles = [Bundle(uuid, version, json.loads(json.dumps(manifest)), json.loads(json.dumps(metadata_files)))
+                   for _ in range(2)]
+        donors, files = [], []
+        for bundle in bundles:
+            donors.append(next(b for b in bundle.biomaterials.values() if isinstance(b, DonorOrganism)))
+            files.append(next(f for f in bundle.files.values() if isinstance(f, SequenceFile)))
+        self.assertIs(one(donors[0].genus_species), one(donors[1].genus_species))
+        self.assertIs(donors[0].sex, donors[1].sex)
+        self.assertIs(files[0].format, files[1].format)
+        self.assertIs(files[0].manifest_entry.content_type, files[1].manifest_entry.content_type)
+
+    def test_link_uuids(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        bundle = Bundle(uuid, version, manifest, metadata_files)
+        document_ids = {id(document_id): document_id for document_id in bundle.entities.keys()}
+        for link in bundle.links:
+            self.assertIs(document_ids[id(link.source_id)], link.source_id)
+            self.assertIs(document_ids[id(link.destination_id)], link.destination_id)
+            self.assertFalse(hasattr(link, '__dict__'))
+
+    def test_reference_counting(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        gc.collect()
+        gc.disable()
+        try:
+            bundle = Bundle(uuid, version, manifest, metadata_files, suspend_gc=True)
+            self.assertFalse(gc.isenabled())
+        finally:
+            gc.enable()
+        sequence_file = bundle.sequencing_output[0]
+        self.assertTrue(sequence_file.from_processes)
+        refs = list(map(weakref.ref, bundle.entities.values()))
+        # Without cycles, dropping the bundle frees its entities, except for the one still referenced here
+        gc.disable()
+        try:
+            del bundle
+            self.assertEqual([sequence_file], [entity for entity in (ref() for ref in refs) if entity is not None])
+            self.assertFalse(sequence_file.from_processes)
+        finally:
+            gc.enable()
+        with Bundle(uuid, version, manifest, metadata_files, suspend_gc=True) as bundle:
+            self.assertTrue(gc.isenabled())
+            sequence_file = bundle.sequencing_output[0]
+            self.assertEqual(sequence_file.from_processes.keys(), {p.document_id for p in bundle.processes.values()
+                                                                   if sequence_file in p.output_files.values()})
+        self.assertEqual({}, bundle.entities)
+        self.assertFalse(sequence_file.from_processes)
+
+    def test_back_references(self):
+        class Thing:
+            pass
+
+        things = [Thing() for _ in range(3)]
+        refs = BackReferences()
+        for i, thing in enumerate(things):
+            refs[UUID(int=i)] = thing
+        refs[UUID(int=0)] = things[0]
+        self.assertEqual(3, len(refs))
+        del refs[UUID(int=1)]
+        self.assertEqual(2, len(refs))
+        refs[UUID(int=2)] = things[1]
+        del things[2]
+        self.assertEqual((2, True), (len(refs), bool(refs)))
+        del things[:]
+        self.assertEqual((0, False, []), (len(refs), bool(refs), list(refs)))
+        refs[UUID(int=3)] = Thing()
+        refs.clear()
+        self.assertEqual((0, False), (len(refs), bool(refs)))
+
+    def test_root_entities_scaling(self):
+        """
+        Finding the root entities takes time proportional to the number of entities
+        """
+
+        def seconds(donors):
+            bundle = Bundle(*synthetic_bundle(BundleShape(donors=donors), seed=1))
+            best = float('inf')
+            for _ in range(3):
+                start = time.perf_counter()
+                roots = bundle.root_entities()
+                best = min(best, time.perf_counter() - start)
+            self.assertEqual(donors, sum(isinstance(root, DonorOrganism) for root in roots.values()))
+            return best
+
+        self.assertLess(seconds(1000), 30 * seconds(100))
+
+    def test_selective_download(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        client = LocalDSSClient([(uuid, version, manifest, metadata_files)])
+        bundle = Bundle(uuid, version, manifest, metadata_files)
+        for include in [{'sequence_file', 'cell_suspension'},
+                        {'sequence_file', 'process', 'library_preparation_protocol', 'sequencing_protocol'},
+                        set()]:
+            with self.subTest(include=include):
+                _, _manifest, _metadata_files = download_bundle_metadata(client, 'aws', uuid, version,
+                                                                         num_workers=0,
+                                                                         file_filter=schema_filter(include))
+                self.assertEqual(manifest, _manifest)
+                self.assertEqual({'links.json', *(n for n in metadata_files if n.rpartition('_')[0] in include)},
+                                 set(_metadata_files.keys()))
+                self.assertRaises((KeyError, RuntimeError), Bundle, uuid, version, _manifest, _metadata_files)
+                partial_bundle = Bundle(uuid, version, _manifest, _metadata_files, allow_missing_entities=True)
+                self.assertEqual({k for k, v in bundle.entities.items() if v.schema_name in include},
+                                 partial_bundle.entities.keys())
+                for link in partial_bundle.links:
+                    self.assertIn(link, bundle.links)
+                    self.assertIn(link.source_id, partial_bundle.entities)
+                    self.assertIn(link.destination_id, partial_bundle.entities)
+                if 'process' in include:
+                    self.assertEqual({f.document_id for f in bundle.sequencing_output},
+                                     {f.document_id for f in partial_bundle.sequencing_output})
+
+    def test_manifest_cache(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        new_version = '2019-01-04T000000.000000Z'
+        client = LocalDSSClient([(uuid, version, manifest, metadata_files),
+                                 (uuid, new_version, manifest, metadata_files)], page_size=10)
+        client.get_bundle.paginate = Mock(wraps=client.get_bundle.paginate)
+        now = [0.0]
+        cache = ManifestCache(latest_ttl=60, clock=lambda: now[0])
+
+        def download(version=None):
+            return download_bundle_metadata(client, 'aws', uuid, version, num_workers=0, manifest_cache=cache)
+
+        self.assertEqual((new_version, manifest, metadata_files), download())
+        self.assertEqual(1, client.get_bundle.paginate.call_count)
+        # The latest version and the manifest come from the cache
+        self.assertEqual((new_version, manifest, metadata_files), download())
+        self.assertEqual((new_version, manifest, metadata_files), download(new_version))
+        self.assertEqual(1, client.get_bundle.paginate.call_count)
+        self.assertEqual((version, manifest, metadata_files), download(version))
+        self.assertEqual((version, manifest, metadata_files), download(version))
+        self.assertEqual(2, client.get_bundle.paginate.call_count)
+        # A newer version is only noticed once the cached latest version expires
+        newest_version = '2019-01-05T000000.000000Z'
+        client.add(uuid, newest_version, manifest, metadata_files)
+        self.assertEqual(new_version, download()[0])
+        now[0] += 61
+        self.assertEqual(newest_version, download()[0])
+        self.assertEqual(3, client.get_bundle.paginate.call_count)
+        # Batch resolution
+        other_uuid = '00000000-0000-0000-0000-000000000000'
+        client.get_bundle = Mock(wraps=client.get_bundle)
+        self.assertEqual({uuid: newest_version}, resolve_latest_versions(client, 'aws', [uuid, other_uuid],
+                                                                         manifest_cache=cache))
+        self.assertEqual(1, client.get_bundle.call_count)
+        now[0] += 61
+        self.assertEqual({uuid: newest_version}, resolve_latest_versions(client, 'aws', [uuid, other_uuid],
+                                                                         manifest_cache=cache, num_workers=2))
+        self.assertEqual(3, client.get_bundle.call_count)
+        self.assertEqual(newest_version, cache.latest_version(uuid))
+
+    def test_manifest_cache_expiration(self):
+        """
+        The cached latest version expires even if bundle downloads keep hitting it while the manifest is not cached
+        """
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        new_version = '2019-01-04T000000.000000Z'
+        client = LocalDSSClient([(uuid, version, manifest, metadata_files),
+                                 (uuid, new_version, manifest, metadata_files)])
+        now = [0.0]
+        # Room for only one manifest
+        cache = ManifestCache(max_entries=len(manifest), latest_ttl=60, clock=lambda: now[0])
+
+        def download(version=None):
+            return download_bundle_metadata(client, 'aws', uuid, version, num_workers=0, manifest_cache=cache)[0]
+
+        self.assertEqual(new_version, download())
+        newest_version = '2019-01-05T000000.000000Z'
+        client.add(uuid, newest_version, manifest, metadata_files)
+        for _ in range(3):
+            now[0] += 15
+            # Evict the manifest of the cached latest version
+            self.assertEqual(version, download(version))
+            self.assertIsNone(cache.manifest(uuid, new_version))
+            self.assertEqual(new_version, download())
+        now[0] += 16
+        self.assertEqual(newest_version, download())
+
+    def test_incremental_bundle(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        new_version = '2019-01-04T000000.000000Z'
+        new_manifest = copy.deepcopy(manifest)
+        new_metadata_files = copy.deepcopy(metadata_files)
+        specimen_file = 'specimen_from_organism_0.json'
+        new_metadata_files[specimen_file]['organ'] = {'text': 'spleen', 'ontology_label': 'spleen'}
+        links = new_metadata_files['links.json']['links']
+        link = next(link for link in links if link['protocols'])
+        protocol = link['protocols'].pop()
+        for entry in new_manifest:
+            if entry['name'] in (specimen_file, 'links.json'):
+                entry['version'] = new_version
+                entry['sha256'] = entry['sha256'][::-1]
+        client = LocalDSSClient([(uuid, version, manifest, metadata_files),
+                                 (uuid, new_version, new_manifest, new_metadata_files)])
+        previous = download_bundle_metadata(client, 'aws', uuid, version, num_workers=0)
+        old_bundle = Bundle(uuid, *previous)
+        client.get_file = Mock(wraps=client.get_file)
+        instrument = TimingReport()
+        _, _manifest, _metadata_files = download_bundle_metadata(client, 'aws', uuid, new_version,
+                                                                 num_workers=0,
+                                                                 instrument=instrument,
+                                                                 previous=previous[1:])
+        self.assertEqual(new_metadata_files, _metadata_files)
+        self.assertEqual(list(new_metadata_files.keys()), list(_metadata_files.keys()))
+        self.assertEqual(2, client.get_file.call_count)
+        self.assertEqual(len(metadata_files) - 2, instrument.stages['reuse'].count)
+        bundle = Bundle(uuid, new_version, _manifest, _metadata_files, previous=old_bundle)
+        self.assertEqual(as_json(Bundle(uuid, new_version, _manifest, _metadata_files)), as_json(bundle))
+        for document_id, entity in bundle.entities.items():
+            old_entity = old_bundle.entities[document_id]
+            self.assertIsNot(old_entity, entity)
+            if entity.json is new_metadata_files[specimen_file]:
+                self.assertEqual('spleen', entity.organ)
+            else:
+                self.assertIs(old_entity.json, entity.json)
+                for field_name, value in vars(entity).items():
+                    if field_name not in link_fields and field_name != 'manifest_entry':
+                        self.assertIs(getattr(old_entity, field_name), value)
+        diff = diff_bundles(old_bundle, bundle)
+        specimen_id = UUID(new_metadata_files[specimen_file]['provenance']['document_id'])
+        self.assertEqual(set(), diff.added_entities | diff.removed_entities)
+        self.assertEqual({specimen_id}, diff.changed_entities)
+        self.assertEqual(set(), diff.added_links)
+        self.assertEqual({(UUID(link['process']), 'process', UUID(protocol['protocol_id']), protocol['protocol_type'])},
+                         diff.removed_links)
+        self.assertFalse(diff_bundles(bundle, bundle))
+        # Loaded from a snapshot, entities have no JSON and are compared by their fields
+        diff = diff_bundles(self._snapshot(old_bundle), self._snapshot(bundle))
+        self.assertEqual({specimen_id}, diff.changed_entities)
+
+    def _snapshot(self, bundle):
+        f = io.BytesIO()
+        bundle.dump(f)
+        f.seek(0)
+        return Bundle.load(f)
+
+    def test_fingerprints(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        bundle = Bundle(uuid, version, manifest, metadata_files)
+        fingerprints = {document_id: entity.fingerprint for document_id, entity in bundle.entities.items()}
+        self.assertEqual(len(bundle.entities), len(set(fingerprints.values())))
+        # Stable across reconstruction, snapshots and pre-signed URLs
+        new_manifest = copy.deepcopy(manifest)
+        for entry in new_manifest:
+            entry['url'] = 'https://example.com/' + entry['name']
+        for other_bundle in (Bundle(uuid, version, new_manifest, copy.deepcopy(metadata_files)),
+                             self._snapshot(bundle)):
+            self.assertEqual(fingerprints, {k: v.fingerprint for k, v in other_bundle.entities.items()})
+            self.assertEqual(bundle.link_fingerprint, other_bundle.link_fingerprint)
+        # Changes that don't affect the extracted fields don't affect the fingerprint
+        new_metadata_files = copy.deepcopy(metadata_files)
+        specimen_file = 'specimen_from_organism_0.json'
+        specimen_id = UUID(new_metadata_files[specimen_file]['provenance']['document_id'])
+        new_metadata_files[specimen_file]['provenance']['update_date'] = '2019-01-04T00:00:00.000000Z'
+        new_metadata_files['links.json']['links'].reverse()
+        new_bundle = Bundle(uuid, version, manifest, new_metadata_files)
+        self.assertEqual(fingerprints, {k: v.fingerprint for k, v in new_bundle.entities.items()})
+        self.assertEqual(bundle.link_fingerprint, new_bundle.link_fingerprint)
+        # Changes that do, do
+        new_metadata_files[specimen_file]['organ'] = {'text': 'spleen', 'ontology_label': 'spleen'}
+        new_metadata_files['links.json']['links'].pop()
+        new_bundle = Bundle(uuid, version, manifest, new_metadata_files)
+        self.assertEqual({specimen_id}, {k for k, v in new_bundle.entities.items() if v.fingerprint != fingerprints[k]})
+        self.assertNotEqual(bundle.link_fingerprint, new_bundle.link_fingerprint)
+
+    def test_download_order(self):
+        uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
+        version = '2019-01-03T163633.780215Z'
+        manifest, metadata_files = self._load_bundle(uuid, version, replica='aws', deployment='prod')
+        sizes = {f['name']: f['size'] for f in manifest if f['indexed']}
+        small_file_size = sorted(sizes.values())[len(sizes) // 2]
+        calls = []
+
+        class Client(LocalDSSClient):
+
+            def get_file(self, uuid, replica, version=None):
+                calls.append((threading.current_thread(), uuid))
+                return super().get_file(uuid, replica, version)
+
+        client = Client([(uuid, version, manifest, metadata_files)])
+        names = {f['uuid']: f['name'] for f in manifest}
+        for kwargs in [dict(num_workers=0), dict(num_workers=1), dict(num_workers=1, small_file_size=small_file_size)]:
+            with self.subTest(**kwargs):
+                calls.clear()
+                _version, _manifest, _metadata_files = download_bundle_metadata(client, 'aws', uuid, version, **kwargs)
+                self.assertEqual((version, manifest, metadata_files), (_version, _manifest, _metadata_files))
+                self.assertEqual(list(metadata_files.keys()), list(_metadata_files.keys()))
+                lanes = {}
+                for thread, file_uuid in calls:
+                    lanes.setdefault(thread, []).append(sizes[names[file_uuid]])
+                if 'small_file_size' in kwargs:
+                    small, large = sorted(lanes.values(), key=max)
+                    self.assertTrue(all(size > small_file_size for size in large))
+                    self.assertTrue(all(size <= small_file_size for size in small))
+                else:
+                    large, = lanes.values()
+                    small = []
+                self.assertEqual(sorted(large, reverse=True), large)
+                self.assertEqual(sorted(small, reverse=True), small)
+
     def test_link_destination_type(self):
         uuid = '6b498499-c5b4-452f-9ff9-2318dbb86000'
         version = '2019-01-03T163633.780215Z'
@@ -706,4 +1051,20 @@ def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.age_range'))
     tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.lookup'))
     tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.api'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.pack'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.instrumentation'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.synthetic'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.dss'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.pipeline'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.source'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.archive'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.index'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.inverted_index'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.summary'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.diff'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.fingerprint'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.decoder'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.retry'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.compression'))
+    tests.addTests(doctest.DocTestSuite('humancellatlas.data.metadata.helpers.crawl'))
     return tests
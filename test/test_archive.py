@@ -0,0 +1,97 @@
+import io
+import json
+import tarfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from dcplib.checksumming_io import ChecksummingSink
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers import archive
+from humancellatlas.data.metadata.helpers.archive import (
+    crc32c,
+    iter_bundle_archive,
+    read_bundle_archive,
+)
+from humancellatlas.data.metadata.helpers.synthetic import synthetic_bundle
+
+
+class UnseekableReader(io.RawIOBase):
+
+    def __init__(self, data: bytes):
+        self._f = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self._f.readinto(b)
+
+
+class TestBundleArchive(TestCase):
+
+    def setUp(self):
+        self.uuid, self.version, _, self.metadata_files = synthetic_bundle(layout='vx', seed=7)
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+            self._add(tf, 'top_level_0.json', b'{}')
+            self._add(tf, 'repo-abc/README.md', b'Not metadata')
+            self._add(tf, 'repo-abc/other/project_0.json', b'{}')
+            for file_name, contents in self.metadata_files.items():
+                self._add(tf, f'repo-abc/bundles/b/{file_name}', json.dumps(contents).encode())
+        self.tarball = buf.getvalue()
+
+    def _add(self, tf, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tf.addfile(info, io.BytesIO(data))
+
+    def test_read(self):
+        manifest, metadata_files = read_bundle_archive(UnseekableReader(self.tarball),
+                                                       path='bundles/b/',
+                                                       strip_components=1)
+        self.assertEqual(self.metadata_files, metadata_files)
+        entries = {entry['name']: entry for entry in manifest}
+        for file_name, contents in self.metadata_files.items():
+            data = json.dumps(contents).encode()
+            sink = ChecksummingSink(64 * 2 ** 20)
+            sink.write(data)
+            entry = entries[file_name]
+            self.assertEqual(sink.get_checksums(), {k: entry[k] for k in ('crc32c', 's3_etag', 'sha1', 'sha256')})
+            self.assertEqual(len(data), entry['size'])
+            self.assertTrue(entry['indexed'])
+        data_files = [entry for entry in manifest if not entry['indexed']]
+        self.assertEqual(len([f for f in self.metadata_files if f.startswith('sequence_file_')]), len(data_files))
+        bundle = Bundle(self.uuid, self.version, manifest, metadata_files)
+        self.assertEqual(len(data_files), len(bundle.files))
+
+    def test_iter(self):
+        names = [name for name, _, _ in iter_bundle_archive(io.BytesIO(self.tarball), strip_components=1)]
+        self.assertEqual(['other/project_0.json', *(f'bundles/b/{name}' for name in self.metadata_files)], names)
+        with self.assertRaises(ValueError):
+            list(iter_bundle_archive(io.BytesIO(self.tarball), path='bundles'))
+        names = [name for name, _, _ in iter_bundle_archive(io.BytesIO(self.tarball), strip_components=2)]
+        self.assertEqual(['project_0.json', *(f'b/{name}' for name in self.metadata_files)], names)
+        names = [name for name, _, _ in iter_bundle_archive(io.BytesIO(self.tarball))]
+        self.assertEqual('top_level_0.json', names[0])
+
+    def test_multipart_checksums(self):
+        data = bytes(range(256)) * 40
+        for part_size in (1000, 2560, 10240, 20000):
+            with self.subTest(part_size=part_size):
+                checksums = archive._Checksums(chunk_size=768)
+                with patch.object(archive, 's3_part_size', part_size):
+                    self.assertEqual(data, bytes(checksums.read(io.BytesIO(data), len(data))))
+                    actual = checksums.hexdigests()
+                sink = ChecksummingSink(part_size)
+                # The reference implementation requires writes not to span more than two parts
+                for i in range(0, len(data), 256):
+                    sink.write(data[i:i + 256])
+                self.assertEqual(sink.get_checksums(), actual)
+
+    def test_crc32c_fallback(self):
+        data = bytes(range(256)) * 3
+        expected = crc32c(data)
+        with patch.object(archive, '_crc32c', None):
+            self.assertEqual(expected, crc32c(data))
+            self.assertEqual(expected, crc32c(data[100:], crc32c(data[:100])))
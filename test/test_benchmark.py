@@ -0,0 +1,42 @@
+import doctest
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.synthetic import BundleShape
+
+import benchmark
+
+
+class TestBenchmark(TestCase):
+
+    def test_regressions(self):
+        baseline = {'a': {'time': (1.0, 1000), 'memory': (1.0, 1000), 'both': (1.0, 1000), 'zero': (1.0, 0)}}
+        results = {'a': {'time': (1.5, 900), 'memory': (0.5, 1500), 'both': (1.5, 1500), 'zero': (1.0, 10)}}
+        self.assertEqual(['a time: 1.500000s vs. 1.000000s (+50%)',
+                          'a memory: 1500 bytes vs. 1000 bytes (+50%)',
+                          'a both: 1.500000s vs. 1.000000s (+50%)',
+                          'a both: 1500 bytes vs. 1000 bytes (+50%)',
+                          'a zero: 10 bytes vs. 0 bytes (+inf%)'],
+                         benchmark.regressions(results, baseline, 0.2))
+        self.assertEqual(['a zero: 10 bytes vs. 0 bytes (+inf%)'], benchmark.regressions(results, baseline, 0.5))
+
+    def test_case_sizes(self):
+        sizes = [100, 1000]
+        per_donor = BundleShape(donors=2).num_entities - BundleShape().num_entities
+        for (name, num_entities, *bundle), size in zip(benchmark.cases(sizes, canned=False), sizes * 2):
+            self.assertEqual(len(Bundle(*bundle).entities), num_entities)
+            self.assertLessEqual(num_entities, size)
+            self.assertGreater(num_entities, size - per_donor)
+
+    def test_repetitions(self):
+        sizes = [100, 10000]
+        # A v5 bundle has the same number of metadata files regardless of its size
+        expected = [5, 1] * 2
+        actual = [benchmark.repetitions(case, 5) for case in benchmark.cases(sizes, canned=False)]
+        self.assertEqual(expected, actual)
+        canned = [benchmark.repetitions(case, 5) for case in benchmark.cases([])]
+        self.assertTrue(canned)
+        self.assertTrue(all(repeat == 5 for repeat in canned))
+
+    def test_doctests(self):
+        self.assertEqual(0, doctest.testmod(benchmark).failed)
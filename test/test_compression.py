@@ -0,0 +1,68 @@
+import gzip
+import io
+import json
+import os
+from unittest import (
+    TestCase,
+    skipIf,
+)
+
+from requests import Response
+from urllib3 import HTTPResponse
+
+from humancellatlas.data.metadata.helpers.compression import (
+    Codec,
+    is_compressed,
+    train_dictionary,
+    zstandard,
+)
+from humancellatlas.data.metadata.helpers.dss import _wire_size
+
+import canning
+
+
+class TestCompression(TestCase):
+
+    def setUp(self):
+        self.documents = sorted({json.dumps(contents).encode()
+                                 for _, _, _, metadata_files in canning.canned_bundles()
+                                 for contents in metadata_files.values()})
+
+    def _ratio(self, codec, documents):
+        return sum(map(len, documents)) / sum(len(codec.compress(document)) for document in documents)
+
+    def _test_codec(self, name):
+        training, test = self.documents[::2], self.documents[1::2]
+        codec = Codec(name)
+        dictionary_codec = Codec(name, dictionary=train_dictionary(training))
+        for c in (codec, dictionary_codec):
+            for document in test:
+                frame = c.compress(document)
+                self.assertTrue(is_compressed(frame))
+                self.assertEqual(document, c.decompress(frame))
+                self.assertEqual(document, c.decompress(memoryview(frame)))
+        self.assertGreater(self._ratio(dictionary_codec, test), 1.5 * self._ratio(codec, test))
+        self.assertRaises(ValueError, codec.decompress, dictionary_codec.compress(test[0]))
+        self.assertRaises(ValueError, dictionary_codec.decompress, codec.compress(test[0]))
+
+    def test_zlib(self):
+        self._test_codec('zlib')
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        self._test_codec('zstd')
+
+    def test_dictionary_size(self):
+        self.assertGreaterEqual(1000, len(train_dictionary(self.documents, size=1000)))
+        self.assertEqual(b'', train_dictionary([]))
+
+    def test_wire_size(self):
+        content = os.urandom(100) * 100
+        body = gzip.compress(content)
+        response = Response()
+        response.raw = HTTPResponse(body=io.BytesIO(body),
+                                    headers={'Content-Encoding': 'gzip'},
+                                    status=200,
+                                    preload_content=False)
+        self.assertEqual(content, response.content)
+        self.assertEqual(len(body), _wire_size(response, response.content))
@@ -0,0 +1,180 @@
+from collections import Counter
+import multiprocessing
+import os
+import random
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.crawl import (
+    CrawlCoordinator,
+    HashRing,
+    LeaseLostError,
+    crawl,
+    merge_outputs,
+    plan_crawl,
+)
+from humancellatlas.data.metadata.helpers.inverted_index import (
+    InvertedIndex,
+    InvertedIndexBuilder,
+)
+from humancellatlas.data.metadata.helpers.summary import FacetSummary
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    LocalDSSClient,
+    SyntheticCorpus,
+)
+
+corpus = SyntheticCorpus(24, BundleShape(donors=2), seed=5)
+
+missing_uuid = '00000000-0000-4000-8000-000000000000'
+
+
+def _work(path, node, results):
+    stats = crawl(CrawlCoordinator(path, node), LocalDSSClient(corpus), 'aws')
+    results.put((node, stats))
+
+
+class TestCrawl(TestCase):
+
+    def setUp(self):
+        self._dir = TemporaryDirectory()
+        self.path = self._dir.name
+        self.fqids = [(uuid, version) for uuid, version, _, _ in corpus]
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_hash_ring(self):
+        nodes = [f'node-{i}' for i in range(4)]
+        ring = HashRing(nodes)
+        uuids = [f'{i:08x}-0000-4000-8000-000000000000' for i in range(4000)]
+        shards = Counter(map(ring.node, uuids))
+        self.assertEqual(set(nodes), set(shards))
+        self.assertLess(max(shards.values()), 2 * min(shards.values()))
+        shuffled = nodes[:]
+        random.Random(1).shuffle(shuffled)
+        self.assertEqual(list(map(ring.node, uuids)), list(map(HashRing(shuffled).node, uuids)))
+        self.assertEqual(ring.node(uuids[0]), ring.node(uuids[0].upper()))
+        # Only the bundles of the added node move
+        bigger_ring = HashRing(nodes + ['node-4'])
+        moved = [uuid for uuid in uuids if ring.node(uuid) != bigger_ring.node(uuid)]
+        self.assertEqual({'node-4'}, set(map(bigger_ring.node, moved)))
+        self.assertRaises(ValueError, HashRing, [])
+
+    def test_plan(self):
+        num_batches = plan_crawl(self.path, self.fqids + self.fqids[:3], ['a', 'b'], batch_size=5)
+        with TemporaryDirectory() as other_path:
+            self.assertEqual(num_batches, plan_crawl(other_path, self.fqids[::-1], ['b', 'a'], batch_size=5))
+            self.assertEqual(CrawlCoordinator(self.path, 'a').batches, CrawlCoordinator(other_path, 'a').batches)
+        self.assertRaises(ValueError, plan_crawl, self.path, self.fqids, ['a'])
+        coordinator = CrawlCoordinator(self.path, 'a')
+        self.assertEqual(dict(done=0, leased=0, pending=num_batches), coordinator.status())
+        ring = HashRing(['a', 'b'])
+        items = []
+        for batch_id, node in coordinator.batches.items():
+            with open(os.path.join(self.path, 'batches', batch_id + '.json')) as f:
+                batch = f.read()
+            self.assertLessEqual(batch.count('"'), 4 * 5)
+            items.extend((batch_id, node, fqid) for fqid in self.fqids if fqid[0] in batch)
+        self.assertEqual(sorted(self.fqids), sorted(fqid for _, _, fqid in items))
+        self.assertTrue(all(ring.node(fqid[0]) == node for _, node, fqid in items))
+
+    def test_leases(self):
+        plan_crawl(self.path, self.fqids, ['a', 'b'], batch_size=3)
+        now = [1000.0]
+
+        def clock():
+            return now[0]
+
+        a = CrawlCoordinator(self.path, 'a', lease_seconds=10, clock=clock)
+        b = CrawlCoordinator(self.path, 'b', lease_seconds=10, clock=clock)
+        a_batches = [batch_id for batch_id, node in a.batches.items() if node == 'a']
+        b_batches = [batch_id for batch_id, node in a.batches.items() if node == 'b']
+        lease = a.claim()
+        self.assertEqual((a_batches[0], 'a', 1, 1010.0, 'a'),
+                         (lease.batch_id, lease.node, lease.generation, lease.expires, lease.owner))
+        self.assertEqual(a_batches[1], a.claim().batch_id)
+        now[0] += 5
+        lease = a.renew(lease)
+        self.assertEqual(1015.0, lease.expires)
+        # Node b starts with its own batches and then steals from the back of a's batches
+        for batch_id in b_batches:
+            b_lease = b.claim()
+            self.assertEqual(batch_id, b_lease.batch_id)
+            b.complete(b_lease)
+        b_lease = b.claim()
+        self.assertEqual((a_batches[-1], 'a'), (b_lease.batch_id, b_lease.owner))
+        b.complete(b_lease)
+        # The second lease of a expires and is taken over by b
+        now[0] += 6
+        b_lease = b.claim()
+        self.assertEqual((a_batches[1], 2), (b_lease.batch_id, b_lease.generation))
+        b.complete(b_lease)
+        # The first lease of a was renewed, b can't take it over yet
+        self.assertIsNone(b.claim())
+        self.assertEqual(dict(done=len(b_batches) + 2, leased=1, pending=0), b.status())
+        now[0] += 10
+        stolen = b.claim()
+        self.assertEqual((a_batches[0], 2), (stolen.batch_id, stolen.generation))
+        self.assertRaises(LeaseLostError, a.renew, lease)
+        self.assertRaises(LeaseLostError, a.complete, lease)
+        b.complete(stolen)
+        self.assertRaises(LeaseLostError, b.renew, stolen)
+        self.assertEqual(2, a.done_generation(a_batches[0]))
+        self.assertIsNone(a.done_generation(a_batches[0] + 'x'))
+
+    def test_crashed_claim(self):
+        """
+        A lease file that was created but never written expires
+        """
+        plan_crawl(self.path, self.fqids, ['a'], batch_size=100)
+        batch_id = '000000'
+        os.makedirs(os.path.join(self.path, 'leases', batch_id))
+        with open(os.path.join(self.path, 'leases', batch_id, '1'), 'w'):
+            pass
+        coordinator = CrawlCoordinator(self.path, 'a', lease_seconds=60)
+        self.assertIsNone(coordinator.claim())
+        coordinator = CrawlCoordinator(self.path, 'a', lease_seconds=0)
+        self.assertEqual(2, coordinator.claim().generation)
+
+    def test_processes(self):
+        fqids = self.fqids + [(missing_uuid, None)]
+        num_batches = plan_crawl(self.path, fqids, ['a', 'b', 'c'], batch_size=3)
+        c_batches = sum(node == 'c' for node in CrawlCoordinator(self.path, 'a').batches.values())
+        self.assertGreater(c_batches, 0)
+        results = multiprocessing.Queue()
+        # Node c never shows up, its batches are stolen by the workers of the other nodes
+        processes = [multiprocessing.Process(target=_work, args=(self.path, node, results))
+                     for node in ('a', 'a', 'b')]
+        for process in processes:
+            process.start()
+        stats = [results.get(timeout=60) for _ in processes]
+        for process in processes:
+            process.join()
+            self.assertEqual(0, process.exitcode)
+        self.assertEqual(num_batches, sum(s.batches for _, s in stats))
+        self.assertEqual(len(fqids), sum(s.bundles for _, s in stats))
+        self.assertEqual(1, sum(s.errors for _, s in stats))
+        self.assertGreaterEqual(sum(s.stolen for _, s in stats), c_batches)
+        self.assertEqual(0, sum(s.lost for _, s in stats))
+        self.assertEqual(dict(done=num_batches, leased=0, pending=0), CrawlCoordinator(self.path, 'a').status())
+
+        index_path = os.path.join(self.path, 'index')
+        summary, errors = merge_outputs(self.path, index_path)
+        self.assertEqual([(missing_uuid, None)], errors)
+        expected_index, expected_summary = InvertedIndexBuilder(), FacetSummary()
+        for bundle in corpus:
+            bundle = Bundle(*bundle)
+            expected_index.add(bundle)
+            expected_summary.add(bundle)
+        self.assertEqual(expected_summary, summary)
+        expected_index.write(index_path + '.expected')
+        with InvertedIndex(index_path) as index, InvertedIndex(index_path + '.expected') as expected:
+            self.assertEqual(list(expected.fqids), list(index.fqids))
+            self.assertEqual(list(expected.items()), list(index.items()))
+
+    def test_incomplete(self):
+        plan_crawl(self.path, self.fqids, ['a', 'b'], batch_size=5)
+        crawl(CrawlCoordinator(self.path, 'a'), LocalDSSClient(corpus), 'aws', max_batches=1)
+        self.assertRaises(ValueError, merge_outputs, self.path, os.path.join(self.path, 'index'))
@@ -0,0 +1,85 @@
+import glob
+import json
+import math
+import os
+import tempfile
+from unittest import (
+    TestCase,
+    skipIf,
+)
+
+from humancellatlas.data.metadata.helpers.decoder import (
+    decode_json,
+    decoders,
+    orjson,
+    read_json,
+    stdlib_decoder,
+)
+from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+from humancellatlas.data.metadata.helpers.source import DirectoryBundleSource
+from humancellatlas.data.metadata.helpers.synthetic import (
+    LocalDSSClient,
+    synthetic_bundle,
+)
+from humancellatlas.data.metadata.instrumentation import TimingReport
+
+cans_dir = os.path.join(os.path.dirname(__file__), 'cans')
+
+
+class TestDecoder(TestCase):
+
+    def test_decoders_agree(self):
+        paths = glob.glob(os.path.join(cans_dir, '**', '*.json'), recursive=True)
+        self.assertTrue(paths)
+        for path in paths:
+            with open(path, 'rb') as f:
+                data = f.read()
+            expected = json.loads(data)
+            for name, decoder in decoders.items():
+                with self.subTest(path=path, decoder=name):
+                    self.assertEqual(expected, decoder(data))
+                    self.assertEqual(expected, decoder(memoryview(data)))
+                    self.assertEqual(expected, read_json(path, decoder=decoder))
+
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_fallback(self):
+        decoder = decoders['orjson']
+        self.assertTrue(math.isnan(decoder(b'{"a": NaN}')['a']))
+        self.assertEqual(2 ** 70, decoder(b'[1180591620717411303424]')[0])
+        for data in (b'', b'{"a": ', b'\xff'):
+            for decoder in decoders.values():
+                with self.subTest(data=data, decoder=decoder):
+                    self.assertRaises(ValueError, decoder, data)
+
+    def test_read_empty_file(self):
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertRaises(json.JSONDecodeError, read_json, f.name, decoder=stdlib_decoder)
+
+    def test_directory_source(self):
+        uuid, version, manifest, metadata_files = synthetic_bundle(seed=3)
+        with tempfile.TemporaryDirectory() as d:
+            DirectoryBundleSource(d).put(uuid, version, manifest, metadata_files)
+            instrument = TimingReport()
+            source = DirectoryBundleSource(d, instrument=instrument)
+            self.assertEqual((version, manifest, metadata_files), source.get(uuid, version))
+        self.assertEqual(2, instrument.stages['json_decode'].count)
+        self.assertGreater(instrument.stages['json_decode'].size, 0)
+
+    def test_download_raw(self):
+        """
+        Clients providing get_file_bytes() have the raw body decoded by decode_json()
+        """
+        uuid, version, manifest, metadata_files = synthetic_bundle(seed=3)
+
+        class Client(LocalDSSClient):
+
+            def get_file_bytes(self, uuid, replica, version=None, instrument=None):
+                return json.dumps(self.get_file(uuid=uuid, replica=replica, version=version)).encode()
+
+        client = Client([(uuid, version, manifest, metadata_files)])
+        instrument = TimingReport()
+        _version, _manifest, _metadata_files = download_bundle_metadata(client, 'aws', uuid, version,
+                                                                        num_workers=0, instrument=instrument)
+        self.assertEqual(metadata_files, _metadata_files)
+        self.assertEqual(len(metadata_files), instrument.stages['json_decode'].count)
+        self.assertEqual(decode_json(b'{"a": 1}'), {'a': 1})
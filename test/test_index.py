@@ -0,0 +1,99 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    DonorOrganism,
+    SequenceFile,
+    SpecimenFromOrganism,
+)
+from humancellatlas.data.metadata.helpers.index import BundleIndex
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    SyntheticCorpus,
+)
+
+import canning
+
+
+class TestBundleIndex(TestCase):
+
+    def setUp(self):
+        self.bundles = [Bundle(*bundle) for bundle in SyntheticCorpus(6, BundleShape(donors=3), seed=4)]
+
+    def _expected(self, bundles, organs, species):
+        hits = []
+        for bundle in bundles:
+            for entity in bundle.entities.values():
+                if isinstance(entity, SequenceFile):
+                    ancestors = []
+                    entity.ancestors(type('Visitor', (), {'visit': lambda self, e: ancestors.append(e)})())
+                    if (any(isinstance(a, SpecimenFromOrganism) and a.organ in organs for a in ancestors)
+                            and any(isinstance(a, DonorOrganism) and species in a.genus_species for a in ancestors)):
+                        hits.append((f'{bundle.uuid}.{bundle.version}', entity.document_id))
+        return sorted(hits, key=lambda hit: (hit[0], hit[1].bytes))
+
+    def test_find(self):
+        index = BundleIndex()
+        self.assertEqual(len(self.bundles), index.update(self.bundles))
+        all_expected = []
+        for organs in [['pancreas'], ['lung'], ['brain', 'liver', 'heart']]:
+            with self.subTest(organs=organs):
+                expected = self._expected(self.bundles, organs, 'Homo sapiens')
+                all_expected.extend(expected)
+                actual = index.find('sequence_file',
+                                    ancestors={'specimen_from_organism': {'organ': organs},
+                                               'donor_organism': {'genus_species': 'Homo sapiens'}})
+                self.assertEqual(expected, actual)
+        self.assertTrue(all_expected)
+        bundle = self.bundles[0]
+        fqid = f'{bundle.uuid}.{bundle.version}'
+        self.assertEqual(sorted(d.bytes for d in bundle.processes),
+                         [d.bytes for f, d in index.find('process') if f == fqid])
+        file_names = [f.manifest_entry.name for f in bundle.files.values() if f.read_index == 'read1']
+        hits = index.find('sequence_file', {'name': file_names, 'read_index': 'read1'})
+        self.assertEqual(sorted(f.document_id.bytes for f in bundle.files.values() if f.read_index == 'read1'),
+                         [d.bytes for f, d in hits if f == fqid])
+        with self.assertRaises(ValueError):
+            index.find('sequence_file', {'foo': 'bar'})
+        with self.assertRaises(ValueError):
+            index.find('process', {'process_id': 'bar'})
+
+    def test_upsert(self):
+        with TemporaryDirectory() as d:
+            path = os.path.join(d, 'index.sqlite')
+            with BundleIndex(path) as index:
+                index.update(self.bundles[:3])
+            old, new = self.bundles[0], self.bundles[3]
+            # Pretend that the fourth bundle is a newer version of the first
+            new.uuid, new.version = old.uuid, old.version + 'x'
+            with BundleIndex(path) as index:
+                self.assertEqual(3, len(index))
+                self.assertIn(f'{old.uuid}.{old.version}', index)
+                self.assertTrue(index.add(new))
+                self.assertFalse(index.add(new))
+                self.assertFalse(index.add(old))
+                self.assertEqual(3, len(index))
+                self.assertEqual(new.version, index.version(str(old.uuid)))
+                self.assertNotIn(f'{old.uuid}.{old.version}', index)
+                hits = index.find('donor_organism')
+                self.assertEqual(sorted(d.bytes for b in self.bundles[1:4] for d in b.biomaterials
+                                        if isinstance(b.biomaterials[d], DonorOrganism)),
+                                 sorted(d.bytes for _, d in hits))
+                self.assertTrue(index.remove(str(old.uuid)))
+                self.assertFalse(index.remove(str(old.uuid)))
+                self.assertEqual(sorted((str(b.uuid), b.version) for b in self.bundles[1:3]), list(index.bundles()))
+                self.assertEqual(0, index.connection.execute(
+                    'SELECT count(*) FROM link WHERE bundle NOT IN (SELECT id FROM bundle)').fetchone()[0])
+
+    def test_canned_bundles(self):
+        index = BundleIndex()
+        bundles = [Bundle(*bundle) for bundle in canning.canned_bundles()]
+        index.update(bundles)
+        self.assertEqual(len({b.uuid for b in bundles}), len(index))
+        hits = index.find('sequence_file')
+        self.assertTrue(hits)
+        self.assertEqual(set(index.find('sequence_file', {'format': ['fastq.gz', 'fastq']})),
+                         {hit for hit in hits if hit in set(index.find('sequence_file', {'format': 'fastq.gz'}))
+                          or hit in set(index.find('sequence_file', {'format': 'fastq'}))})
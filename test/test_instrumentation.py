@@ -0,0 +1,51 @@
+from unittest import TestCase
+from unittest.mock import Mock
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+from humancellatlas.data.metadata.helpers.json import as_json
+from humancellatlas.data.metadata.instrumentation import (
+    CallbackInstrument,
+    TimingReport,
+)
+
+import canning
+
+
+class TestInstrumentation(TestCase):
+
+    def test_bundle(self):
+        uuid, version, manifest, metadata_files = next(canning.canned_bundles())
+        client = Mock()
+        client.get_bundle.paginate.return_value = [{'bundle': {'version': version, 'files': manifest[:5]}},
+                                                   {'bundle': {'version': version, 'files': manifest[5:]}}]
+        client.get_file.side_effect = lambda uuid, version, replica: next(
+            metadata_files[f['name']] for f in manifest if f['uuid'] == uuid)
+        report = TimingReport()
+        _, manifest, metadata_files = download_bundle_metadata(client, 'aws', uuid, version, instrument=report)
+        bundle = Bundle(uuid, version, manifest, metadata_files, instrument=report)
+        as_json(bundle, instrument=report)
+
+        stages = report.stages
+        self.assertEqual(2, stages['get_bundle'].calls)
+        self.assertEqual(len(manifest), stages['get_bundle'].count)
+        self.assertEqual(len(metadata_files), stages['get_file'].calls)
+        self.assertEqual(sum(f['size'] for f in manifest if f['indexed']), stages['get_file'].size)
+        self.assertEqual(len(manifest), stages['manifest'].count)
+        self.assertEqual(len(bundle.links), stages['connect'].count)
+        self.assertEqual(len(bundle.entities),
+                         sum(timing.calls for stage, timing in stages.items() if stage.startswith('construct.')))
+        self.assertEqual(1, stages['construct.Project'].calls)
+        self.assertEqual(1, stages['as_json'].calls)
+        self.assertGreater(report.total_seconds, 0)
+        self.assertIn('construct.Project', str(report))
+
+    def test_disabled(self):
+        records = []
+        instrument = CallbackInstrument(lambda *args: records.append(args))
+        uuid, version, manifest, metadata_files = next(canning.canned_bundles())
+        as_json(Bundle(uuid, version, manifest, metadata_files))
+        self.assertEqual([], records)
+        as_json(Bundle(uuid, version, manifest, metadata_files, instrument=instrument))
+        self.assertEqual({'manifest', 'links', 'connect'}, {stage for stage, *_ in records} - {
+            stage for stage, *_ in records if stage.startswith('construct.')})
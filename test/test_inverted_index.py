@@ -0,0 +1,83 @@
+from collections import defaultdict
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from uuid import UUID
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.inverted_index import (
+    InvertedIndex,
+    InvertedIndexBuilder,
+    merge,
+)
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    SyntheticCorpus,
+)
+
+import canning
+
+
+class TestInvertedIndex(TestCase):
+
+    def setUp(self):
+        self._dir = TemporaryDirectory()
+        self.bundles = [Bundle(*bundle) for bundle in canning.canned_bundles()]
+        self.bundles.extend(Bundle(*bundle) for bundle in SyntheticCorpus(5, BundleShape(donors=2), seed=9))
+        # A second version of a bundle shares all of its document IDs with the first
+        uuid, version, manifest, metadata_files = next(iter(SyntheticCorpus(1, BundleShape(donors=2), seed=9)))
+        self.bundles.append(Bundle(uuid, version + 'x', manifest, metadata_files))
+        self.expected = defaultdict(set)
+        for bundle in self.bundles:
+            fqid = f'{bundle.uuid}.{bundle.version}'
+            for document_id in bundle.entities.keys():
+                self.expected[document_id].add(fqid)
+            for file in bundle.files.values():
+                self.expected[file.manifest_entry.uuid].add(fqid)
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self._dir.name, name)
+
+    def _assert_index(self, path):
+        with InvertedIndex(path) as index:
+            self.assertEqual(len(self.expected), len(index))
+            self.assertEqual(sorted(self.expected.keys(), key=lambda k: k.bytes), list(index))
+            for key, fqids in self.expected.items():
+                self.assertIn(key, index)
+                self.assertIn(str(key), index)
+                self.assertEqual(sorted(fqids), index.bundles(key))
+            self.assertNotIn(UUID(int=0), index)
+            self.assertNotIn(UUID(int=2 ** 128 - 1), index)
+            self.assertEqual([], index.bundles(UUID(int=0)))
+
+    def test_build(self):
+        builder = InvertedIndexBuilder()
+        for bundle in self.bundles:
+            builder.add(bundle)
+        # Adding the same bundle twice is harmless
+        builder.add(self.bundles[0])
+        builder.write(self._path('index'))
+        self._assert_index(self._path('index'))
+
+    def test_merge(self):
+        shards = []
+        for i in range(3):
+            builder = InvertedIndexBuilder()
+            # The shards overlap
+            for bundle in self.bundles[i::3] + self.bundles[:1]:
+                builder.add(bundle)
+            shards.append(self._path(f'shard{i}'))
+            builder.write(shards[-1])
+        empty = self._path('empty')
+        InvertedIndexBuilder().write(empty)
+        with InvertedIndex(empty) as index:
+            self.assertEqual(0, len(index))
+            self.assertNotIn(UUID(int=0), index)
+        merge([*shards, empty], self._path('index'))
+        self._assert_index(self._path('index'))
+        with open(self._path('index'), 'rb') as f:
+            # Compact: well under 32 bytes per key and posting
+            self.assertLess(len(f.read()), 32 * sum(map(len, self.expected.values())))
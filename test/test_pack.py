@@ -0,0 +1,115 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import Mock
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.compression import (
+    Codec,
+    train_dictionary,
+)
+from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+from humancellatlas.data.metadata.helpers.pack import BundlePack
+from humancellatlas.data.metadata.instrumentation import TimingReport
+
+import canning
+
+
+class TestBundlePack(TestCase):
+
+    def setUp(self):
+        self._dir = TemporaryDirectory()
+        self.path = os.path.join(self._dir.name, 'bundles.pack')
+        # The canned example bundles all share the same FQID
+        self.bundles = list({(uuid, version): (uuid, version, manifest, metadata_files)
+                             for uuid, version, manifest, metadata_files in canning.canned_bundles()}.values())
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _fill(self, **kwargs):
+        with BundlePack(self.path, **kwargs) as pack:
+            for uuid, version, manifest, metadata_files in self.bundles:
+                pack.put(uuid, version, manifest, metadata_files)
+            self.assertEqual(len(self.bundles), len(pack))
+
+    def _assert_pack(self, pack):
+        self.assertEqual([f'{uuid}.{version}' for uuid, version, _, _ in self.bundles], list(pack))
+        for uuid, version, manifest, metadata_files in self.bundles:
+            self.assertIn(f'{uuid}.{version}', pack)
+            self.assertEqual((manifest, metadata_files), pack.get(uuid, version))
+            bundle = pack.bundle(uuid, version)
+            self.assertIsInstance(bundle, Bundle)
+            self.assertEqual(str(bundle.uuid), uuid)
+
+    def test_put_get(self):
+        self._fill()
+        with BundlePack(self.path) as pack:
+            self._assert_pack(pack)
+            size = os.path.getsize(self.path)
+            uuid, version, manifest, metadata_files = self.bundles[0]
+            pack.put(uuid, version, manifest, metadata_files)
+            self.assertEqual(size, os.path.getsize(self.path))
+            uuid = self.bundles[-1][0]
+            self.assertEqual([version for u, version, _, _ in self.bundles if u == uuid], pack.versions(uuid))
+
+    def test_reindex(self):
+        self._fill()
+        os.unlink(self.path + '.idx')
+        with BundlePack(self.path) as pack:
+            self._assert_pack(pack)
+        with BundlePack(self.path) as pack:
+            self._assert_pack(pack)
+
+    def test_compression(self):
+        samples = [json.dumps(contents).encode()
+                   for _, _, _, metadata_files in self.bundles
+                   for contents in metadata_files.values()]
+        codec = Codec('zlib', dictionary=train_dictionary(samples))
+        # Start with an uncompressed record
+        with BundlePack(self.path) as pack:
+            pack.put(*self.bundles[0])
+            uncompressed_size = pack.size
+        instrument = TimingReport()
+        with BundlePack(self.path, codec=codec, instrument=instrument) as pack:
+            for bundle in self.bundles[1:]:
+                pack.put(*bundle)
+        disk = instrument.stages['disk']
+        self.assertEqual(len(self.bundles) - 1, disk.count)
+        self.assertEqual(os.path.getsize(self.path) - uncompressed_size, disk.size)
+        self.assertLess(disk.size * 3, instrument.stages['compress'].size)
+        os.unlink(self.path + '.idx')
+        with BundlePack(self.path, codec=codec) as pack:
+            self._assert_pack(pack)
+        with BundlePack(self.path, codec=Codec('zlib')) as pack:
+            uuid, version, _, _ = self.bundles[0]
+            pack.get(uuid, version)
+            uuid, version, _, _ = self.bundles[1]
+            self.assertRaises(ValueError, pack.get, uuid, version)
+
+    def test_truncated_record(self):
+        self._fill()
+        with open(self.path, 'ab') as f:
+            f.write(b'HCAP\xff\xff\x00\x00{"uuid"')
+        with open(self.path + '.idx', 'a') as f:
+            f.write('foo')
+        with BundlePack(self.path) as pack:
+            self._assert_pack(pack)
+            uuid, version, manifest, metadata_files = self.bundles[0]
+            pack.put(uuid, version + 'x', manifest, metadata_files)
+        with BundlePack(self.path) as pack:
+            self.assertEqual((manifest, metadata_files), pack.get(uuid, version + 'x'))
+
+    def test_dss_cache(self):
+        uuid, version, manifest, metadata_files = self.bundles[0]
+        client = Mock()
+        client.get_bundle.paginate.return_value = [{'bundle': {'version': version, 'files': manifest}}]
+        client.get_file.side_effect = lambda uuid, version, replica: next(
+            metadata_files[f['name']] for f in manifest if f['uuid'] == uuid)
+        with BundlePack(self.path) as pack:
+            for _ in range(2):
+                result = download_bundle_metadata(client, 'aws', uuid, version, num_workers=0, cache=pack)
+                self.assertEqual((version, manifest, metadata_files), result)
+            self.assertEqual(1, client.get_bundle.paginate.call_count)
+            self.assertEqual(len(metadata_files), client.get_file.call_count)
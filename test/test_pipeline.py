@@ -0,0 +1,119 @@
+from itertools import islice
+import threading
+import time
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.json import as_json
+from humancellatlas.data.metadata.helpers.pipeline import (
+    Pipeline,
+    Stage,
+    bundle_pipeline,
+)
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    LocalDSSClient,
+    SyntheticCorpus,
+)
+
+
+class TestPipeline(TestCase):
+
+    def setUp(self):
+        self.corpus = SyntheticCorpus(12, BundleShape(donors=3, specimens=2), seed=4)
+        self.client = LocalDSSClient(self.corpus)
+
+    def test_bundle_pipeline(self):
+        expected = {uuid: as_json(Bundle(uuid, version, manifest, metadata_files))
+                    for uuid, version, manifest, metadata_files in self.corpus}
+        for processes in (False, True):
+            with self.subTest(processes=processes):
+                results = {}
+
+                def sink(uuid, version, bundle_json):
+                    results[uuid] = bundle_json
+                    return uuid
+
+                pipeline = bundle_pipeline(self.client, 'aws', sink,
+                                           download_workers=4,
+                                           construct_workers=2,
+                                           processes=processes)
+                fqids = [(uuid, None) for uuid in expected.keys()]
+                self.assertEqual(set(expected.keys()), set(pipeline.run(fqids + [('foo', None)])))
+                self.assertEqual(expected, results)
+                stage_names = ['download', 'construct', 'sink'] if processes else [
+                    'download', 'construct', 'serialize', 'sink']
+                self.assertEqual(stage_names, [m.name for m in pipeline.metrics])
+                download, *others = pipeline.metrics
+                self.assertEqual((13, 12, 1), (download.items_in, download.items_out, download.errors))
+                for metrics in others:
+                    self.assertEqual((12, 12, 0), (metrics.items_in, metrics.items_out, metrics.errors))
+                    self.assertGreater(metrics.throughput, 0)
+                (stage_name, item, error), = pipeline.errors
+                self.assertEqual(('download', ('foo', None)), (stage_name, item))
+                self.assertIn('sink', str(pipeline))
+
+    def test_backpressure(self):
+        in_flight, max_in_flight = [0], [0]
+        lock = threading.Lock()
+
+        def produce(i):
+            with lock:
+                in_flight[0] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+            return i
+
+        def consume(i):
+            time.sleep(0.01)
+            with lock:
+                in_flight[0] -= 1
+            return i
+
+        pipeline = Pipeline([Stage('produce', produce, workers=4, queue_size=1),
+                             Stage('consume', consume, queue_size=2)])
+        self.assertEqual(list(range(50)), sorted(pipeline.run(range(50))))
+        # At most two items waiting in the queue, one being consumed, four being produced or waiting to be
+        # enqueued and one in the output queue
+        self.assertLessEqual(max_in_flight[0], 8)
+        self.assertLessEqual(pipeline.metrics[1].max_queue_depth, 2)
+        self.assertEqual(0, pipeline.metrics[1].queue_depth)
+
+    def test_early_exit(self):
+        pipeline = Pipeline([Stage('identity', lambda i: i, workers=2)])
+        results = pipeline.run(iter(range(1000000)))
+        self.assertEqual(3, len(list(islice(results, 3))))
+        results.close()
+        self.assertLess(pipeline.metrics[0].items_in, 100)
+        self.assertFalse([t for t in threading.enumerate() if t.name.startswith('pipeline-')])
+
+    def test_rerun(self):
+        def check(i):
+            if i == 3:
+                raise ValueError(i)
+            return i
+
+        pipeline = Pipeline([Stage('check', check, workers=2)])
+        for _ in range(2):
+            self.assertEqual([0, 1, 2, 4], sorted(pipeline.run(range(5))))
+            metrics, = pipeline.metrics
+            self.assertEqual((5, 4, 1), (metrics.items_in, metrics.items_out, metrics.errors))
+            self.assertEqual([('check', 3)], [(stage_name, item) for stage_name, item, _ in pipeline.errors])
+            time.sleep(0.2)
+            self.assertLess(metrics.elapsed_seconds, 0.2)
+
+    def test_dead_worker(self):
+        class Fatal(BaseException):
+            pass
+
+        def fail(i):
+            if i == 0:
+                raise Fatal()
+            return i
+
+        pipeline = Pipeline([Stage('fail', fail, workers=2), Stage('identity', lambda i: i)])
+        results = []
+        thread = threading.Thread(target=lambda: results.extend(pipeline.run(range(10))), daemon=True)
+        thread.start()
+        thread.join(timeout=10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(list(range(1, 10)), sorted(results))
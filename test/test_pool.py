@@ -0,0 +1,47 @@
+import json
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    EntityPool,
+    File,
+    LinkedEntity,
+    link_fields,
+)
+from humancellatlas.data.metadata.helpers.json import as_json
+
+import canning
+
+
+class TestEntityPool(TestCase):
+
+    def test_shared_entities(self):
+        pool = EntityPool()
+        for uuid, version, manifest, metadata_files in canning.canned_bundles():
+            with self.subTest(uuid=uuid):
+                pool.clear()
+                unpooled = Bundle(uuid, version, manifest, metadata_files)
+                bundle1 = Bundle(uuid, version, manifest, metadata_files, pool=pool)
+                bundle2 = Bundle(uuid, version, json.loads(json.dumps(manifest)),
+                                 json.loads(json.dumps(metadata_files)), pool=pool)
+                self.assertEqual(json.dumps(as_json(unpooled)), json.dumps(as_json(bundle2)))
+                for document_id, entity1 in bundle1.entities.items():
+                    entity2 = bundle2.entities[document_id]
+                    self.assertIsNot(entity1, entity2)
+                    self.assertIs(type(entity1), type(entity2))
+                    if isinstance(entity1, File) or len(pool) == 0:
+                        self.assertIsNot(entity1.json, entity2.json)
+                    else:
+                        self.assertIs(entity1.json, entity2.json)
+                        for field_name, value in vars(entity1).items():
+                            if field_name in link_fields:
+                                self.assertIsNot(value, getattr(entity2, field_name))
+                                self.assertEqual(value.keys(), getattr(entity2, field_name).keys())
+                            else:
+                                self.assertIs(value, getattr(entity2, field_name))
+                    if isinstance(entity2, LinkedEntity):
+                        for child in entity2.children.values():
+                            self.assertIs(child, bundle2.entities[child.document_id])
+                if len(pool):
+                    self.assertEqual(pool.misses, pool.hits)
+                    self.assertEqual(pool.misses, len(pool))
@@ -0,0 +1,156 @@
+from unittest import TestCase
+
+from requests import Response
+from requests.exceptions import (
+    ConnectTimeout,
+    ConnectionError,
+)
+
+from hca.util.exceptions import SwaggerAPIException
+
+from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+from humancellatlas.data.metadata.helpers.retry import (
+    CircuitBreaker,
+    CircuitOpenError,
+    Retrier,
+    RetryBudget,
+    RetryPolicy,
+    classify,
+)
+from humancellatlas.data.metadata.helpers.synthetic import (
+    LocalDSSClient,
+    synthetic_bundle,
+)
+from humancellatlas.data.metadata.instrumentation import TimingReport
+
+
+def http_error(status: int, **headers) -> SwaggerAPIException:
+    response = Response()
+    response.status_code = status
+    response.reason = 'Error'
+    response.headers.update(headers)
+    response._content = b''
+    return SwaggerAPIException(response=response)
+
+
+class Failing:
+    """
+    A callable raising the given exceptions in turn, then returning 'ok'
+    """
+
+    def __init__(self, *exceptions):
+        self.exceptions = list(exceptions)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.exceptions:
+            raise self.exceptions.pop(0)
+        return 'ok'
+
+
+class TestRetry(TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.delays = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.delays.append(seconds)
+        self.now += seconds
+
+    def retrier(self, **kwargs):
+        breaker = kwargs.pop('breaker', None) or CircuitBreaker(clock=self.clock)
+        return Retrier(breaker=breaker, sleep=self.sleep, random=lambda: 1.0, **kwargs)
+
+    def test_classify(self):
+        self.assertEqual('timeout', classify(ConnectTimeout()))
+        self.assertEqual('connection', classify(ConnectionError()))
+        self.assertEqual('throttled', classify(http_error(429)))
+        self.assertEqual('throttled', classify(http_error(503)))
+        self.assertEqual('server', classify(http_error(502)))
+        self.assertIsNone(classify(http_error(404)))
+        self.assertIsNone(classify(ValueError()))
+
+    def test_per_class_limits(self):
+        policy = RetryPolicy(max_retries={'server': 2, 'timeout': 1}, base_delay=1, max_delay=3)
+        retrier = self.retrier(policy=policy)
+        func = Failing(http_error(500), ConnectTimeout(), http_error(500))
+        self.assertEqual('ok', retrier.call(func))
+        self.assertEqual([1.0, 2.0, 3.0], self.delays)
+        func = Failing(http_error(500), http_error(500), http_error(500))
+        self.assertRaises(SwaggerAPIException, retrier.call, func)
+        self.assertEqual(3, func.calls)
+        func = Failing(http_error(404))
+        self.assertRaises(SwaggerAPIException, retrier.call, func)
+        self.assertEqual(1, func.calls)
+        func = Failing(ConnectionError())
+        self.assertRaises(ConnectionError, retrier.call, func)
+        self.assertEqual(1, func.calls)
+        metrics = retrier.metrics()
+        self.assertEqual(4, metrics.calls)
+        self.assertEqual({'server': 4, 'timeout': 1}, metrics.retries)
+        self.assertEqual(2, metrics.failures)
+
+    def test_retry_after(self):
+        retrier = self.retrier(policy=RetryPolicy(max_delay=10))
+        self.assertEqual('ok', retrier.call(Failing(http_error(503, **{'Retry-After': '7'}),
+                                                    http_error(503, **{'Retry-After': '70'}))))
+        self.assertEqual([7.0, 10.0], self.delays)
+
+    def test_budget(self):
+        retrier = self.retrier(budget=RetryBudget(ratio=0.5, capacity=2))
+        self.assertEqual('ok', retrier.call(Failing(*[ConnectionError()] * 2)))
+        # One call deposits half a token, the budget is now 0.5 tokens short of a retry
+        self.assertRaises(ConnectionError, retrier.call, Failing(ConnectionError()))
+        self.assertEqual(1, retrier.metrics().budget_exhausted)
+        self.assertEqual('ok', retrier.call(Failing(ConnectionError())))
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, clock=self.clock)
+        retrier = self.retrier(policy=RetryPolicy(max_retries={'connection': 1}, base_delay=1), breaker=breaker)
+        self.assertRaises(ConnectionError, retrier.call, Failing(ConnectionError(), ConnectionError()))
+        self.assertRaises(ConnectionError, retrier.call, Failing(ConnectionError()))
+        # The breaker is open, calls fail fast without being attempted
+        func = Failing()
+        with self.assertRaises(CircuitOpenError) as cm:
+            retrier.call(func)
+        self.assertEqual(0, func.calls)
+        self.assertEqual(60.0, cm.exception.seconds)
+        self.now += 60
+        # A failed trial keeps it open
+        self.assertRaises(ConnectionError, retrier.call, Failing(ConnectionError()))
+        self.assertRaises(CircuitOpenError, retrier.call, func)
+        self.now += 60
+        self.assertEqual('ok', retrier.call(func))
+        self.assertEqual('ok', retrier.call(func))
+        metrics = retrier.metrics()
+        self.assertEqual(1, metrics.circuit_opened)
+        self.assertEqual(2, metrics.circuit_rejected)
+        self.assertEqual(120.0, metrics.circuit_open_seconds)
+
+    def test_download(self):
+        uuid, version, manifest, metadata_files = synthetic_bundle(seed=3)
+        test = self
+
+        class Client(LocalDSSClient):
+            failures = 0
+
+            def get_file(self, uuid, replica, version=None):
+                self.failures += 1
+                if self.failures % 3:
+                    raise http_error(503)
+                return super().get_file(uuid, replica, version)
+
+        client = Client([(uuid, version, manifest, metadata_files)])
+        instrument = TimingReport()
+        retrier = Retrier(policy=RetryPolicy(base_delay=0.001), budget=RetryBudget(capacity=100))
+        result = download_bundle_metadata(client, 'aws', uuid, version, num_workers=2,
+                                          instrument=instrument, retrier=retrier)
+        test.assertEqual((version, manifest, metadata_files), result)
+        num_files = len(metadata_files)
+        test.assertEqual(2 * num_files, instrument.stages['retry.throttled'].count)
+        test.assertEqual({'throttled': 2 * num_files}, retrier.metrics().retries)
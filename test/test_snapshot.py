@@ -0,0 +1,79 @@
+from io import BytesIO
+import json
+import os
+from tempfile import TemporaryFile
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    LinkedEntity,
+)
+from humancellatlas.data.metadata.helpers.json import as_json
+from humancellatlas.data.metadata import snapshot
+
+import canning
+
+
+def canned_bundles():
+    for uuid, version, manifest, metadata_files in canning.canned_bundles():
+        yield Bundle(uuid, version, manifest, metadata_files)
+
+
+class TestSnapshot(TestCase):
+
+    def _assert_equal_bundles(self, expected: Bundle, actual: Bundle):
+        self.assertEqual(expected.uuid, actual.uuid)
+        self.assertEqual(expected.version, actual.version)
+        self.assertEqual(expected.manifest, actual.manifest)
+        self.assertEqual(expected.links, actual.links)
+        for attr in ('projects', 'biomaterials', 'processes', 'protocols', 'files', 'entities'):
+            self.assertEqual(list(getattr(expected, attr).keys()), list(getattr(actual, attr).keys()))
+        for document_id, expected_entity in expected.entities.items():
+            actual_entity = actual.entities[document_id]
+            self.assertIs(type(expected_entity), type(actual_entity))
+            self.assertIsNone(actual_entity.json)
+            for field_name in snapshot._field_names(type(expected_entity)):
+                self.assertEqual(getattr(expected_entity, field_name), getattr(actual_entity, field_name))
+            if isinstance(expected_entity, LinkedEntity):
+                self.assertEqual(expected_entity.children.keys(), actual_entity.children.keys())
+                self.assertEqual(expected_entity.parents.keys(), actual_entity.parents.keys())
+        self.assertEqual(expected.root_entities().keys(), actual.root_entities().keys())
+        self.assertEqual([f.document_id for f in expected.sequencing_output],
+                         [f.document_id for f in actual.sequencing_output])
+        # Set-valued fields may serialize in a different order so we only compare the size of the JSON
+        self.assertEqual(len(json.dumps(as_json(expected))), len(json.dumps(as_json(actual))))
+
+    def test_round_trip(self):
+        for bundle in canned_bundles():
+            with self.subTest(bundle=bundle.uuid):
+                buf = BytesIO()
+                bundle.dump(buf)
+                buf.seek(0)
+                self._assert_equal_bundles(bundle, Bundle.load(buf))
+                self.assertEqual(buf.tell(), len(buf.getvalue()))
+
+    def test_memory_mapped(self):
+        bundles = list(canned_bundles())[:3]
+        with TemporaryFile() as f:
+            f.write(b'garbage')
+            for bundle in bundles:
+                bundle.dump(f)
+            f.seek(len(b'garbage'))
+            for bundle in bundles:
+                self._assert_equal_bundles(bundle, Bundle.load(f))
+            self.assertEqual(f.tell(), os.fstat(f.fileno()).st_size)
+
+    def test_manifest_entry_identity(self):
+        bundle = next(canned_bundles())
+        loaded = snapshot.loads(snapshot.dumps(bundle))
+        for file in loaded.files.values():
+            self.assertIs(file.manifest_entry, loaded.manifest[file.manifest_entry.name])
+
+    def test_bad_snapshot(self):
+        data = snapshot.dumps(next(canned_bundles()))
+        for buf, message in [(b'HCAX' + data[4:], 'Not a bundle snapshot'),
+                             (data[:10], 'Not a bundle snapshot'),
+                             (data[:-1], 'Truncated bundle snapshot')]:
+            with self.assertRaises(ValueError) as cm:
+                snapshot.loads(buf)
+            self.assertEqual(cm.exception.args[0], message)
@@ -0,0 +1,158 @@
+import io
+import os
+import tarfile
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from humancellatlas.data.metadata.api import Bundle
+from humancellatlas.data.metadata.helpers.compression import Codec
+from humancellatlas.data.metadata.helpers.pack import BundlePack
+from humancellatlas.data.metadata.helpers.source import (
+    DSSBundleSource,
+    DirectoryBundleSource,
+    PackBundleSource,
+    TarballBundleSource,
+)
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    LocalDSSClient,
+    SyntheticCorpus,
+)
+
+import canning
+
+
+class TestBundleSource(TestCase):
+
+    def setUp(self):
+        self._dir = TemporaryDirectory()
+        self.corpus = SyntheticCorpus(4, BundleShape(donors=2), layout='v5', seed=6)
+        self.bundles = sorted(self.corpus)
+        uuid, version, manifest, metadata_files = self.bundles[1]
+        # A second version of the same bundle
+        self.bundles.insert(2, (uuid, version + 'x', manifest, metadata_files))
+        self.fqids = [(uuid, version) for uuid, version, _, _ in self.bundles]
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def _assert_source(self, source, ordered=True):
+        bundles = list(source.bundles())
+        self.assertEqual(self.bundles, bundles if ordered else sorted(bundles))
+        fqids = list(source.list_bundles())
+        self.assertEqual(self.fqids, fqids if ordered else sorted(fqids))
+        self.assertEqual(self.bundles[::-1], list(source.bundles(reversed(self.fqids))))
+        uuid, version, manifest, metadata_files = self.bundles[2]
+        self.assertEqual((version, manifest, metadata_files), source.get(uuid))
+        self.assertEqual((version, manifest, metadata_files), source.get(uuid, version))
+        self.assertIsInstance(source.bundle(uuid, version), Bundle)
+        self.assertRaises(KeyError, source.get, uuid, 'foo')
+        self.assertRaises(KeyError, source.get, 'foo')
+
+    def _mirror(self, codec=None):
+        source = DirectoryBundleSource(os.path.join(self._dir.name, 'mirror'), codec=codec)
+        for i, bundle in enumerate(self.bundles):
+            source.put(*bundle, directory='prod' if i % 2 else None)
+        return source
+
+    def test_directory(self):
+        self._assert_source(self._mirror(), ordered=False)
+        canned = list(DirectoryBundleSource(canning.cans_dir))
+        self.assertEqual(canned, list(canning.canned_bundles()))
+        self.assertGreater(len(canned), len(set((uuid, version) for uuid, version, _, _ in canned)))
+
+    def test_directory_lookup(self):
+        mirror = self._mirror()
+        source = DirectoryBundleSource(mirror.path)
+        with patch('os.walk', side_effect=os.walk) as walk:
+            self.assertEqual(self.bundles, list(source.bundles(self.fqids)))
+            self.assertEqual(1, walk.call_count)
+            uuid, version, manifest, metadata_files = self.bundles[0]
+            source.put(uuid, version + 'y', manifest, metadata_files, directory='other')
+            self.assertEqual((version + 'y', manifest, metadata_files), source.get(uuid))
+            self.assertEqual(1, walk.call_count)
+            # A bundle added by another writer is found by walking the tree again
+            mirror.put('foo', version, manifest, metadata_files)
+            self.assertEqual((version, manifest, metadata_files), source.get('foo'))
+            self.assertEqual(2, walk.call_count)
+
+    def test_failed_put(self):
+        mirror = self._mirror()
+        uuid, version, manifest, metadata_files = self.bundles[0]
+        with patch('os.replace', side_effect=OSError):
+            self.assertRaises(OSError, mirror.put, uuid, version, manifest, metadata_files)
+        bundle_dir = os.path.join(mirror.path, uuid, version)
+        self.assertEqual(['manifest.json', 'metadata.json'], sorted(os.listdir(bundle_dir)))
+        self.assertEqual((version, manifest, metadata_files), mirror.get(uuid, version))
+
+    def test_compressed_directory(self):
+        self._mirror()
+        plain_size = self._size()
+        codec = Codec('zlib')
+        mirror = self._mirror(codec)
+        self.assertLess(self._size() * 2, plain_size)
+        self._assert_source(mirror, ordered=False)
+        self._assert_source(DirectoryBundleSource(mirror.path), ordered=False)
+        # Writing uncompressed files replaces the compressed ones
+        self._mirror()
+        self.assertEqual(plain_size, self._size())
+
+    def _size(self):
+        return sum(os.path.getsize(os.path.join(dir_path, file_name))
+                   for dir_path, _, file_names in os.walk(os.path.join(self._dir.name, 'mirror'))
+                   for file_name in file_names)
+
+    def test_compressed_tarball(self):
+        mirror = self._mirror(Codec('zlib'))
+        path = os.path.join(self._dir.name, 'mirror.tar')
+        with tarfile.open(path, 'w') as tf:
+            tf.add(mirror.path, arcname='mirror')
+        self._assert_source(TarballBundleSource(path), ordered=False)
+
+    def _add(self, tf, name, contents=b'{}', type=tarfile.REGTYPE):
+        info = tarfile.TarInfo(name)
+        info.type = type
+        if type == tarfile.REGTYPE:
+            info.size = len(contents)
+            tf.addfile(info, io.BytesIO(contents))
+        else:
+            tf.addfile(info)
+
+    def test_tarball(self):
+        mirror = self._mirror()
+        path = os.path.join(self._dir.name, 'mirror.tar.gz')
+        with tarfile.open(path, 'w:gz') as tf:
+            # Members that aren't nested deeply enough to be in a bundle directory, or aren't files
+            self._add(tf, 'metadata.json')
+            self._add(tf, 'manifest.json', b'[]')
+            self._add(tf, './foo/manifest.json', b'[]')
+            self._add(tf, './foo/metadata.json')
+            self._add(tf, 'mirror/foo/bar/manifest.json', type=tarfile.DIRTYPE)
+            tf.add(mirror.path, arcname='mirror')
+        self._assert_source(TarballBundleSource(path), ordered=False)
+        with open(path, 'rb') as f:
+            self._assert_source(TarballBundleSource(f), ordered=False)
+        with open(path, 'rb') as f:
+
+            class Unseekable(io.RawIOBase):
+
+                def readinto(self, b):
+                    data = f.read(len(b))
+                    b[:len(data)] = data
+                    return len(data)
+
+            source = TarballBundleSource(Unseekable())
+            self.assertEqual(self.bundles, sorted(source.bundles()))
+
+    def test_pack(self):
+        with BundlePack(os.path.join(self._dir.name, 'bundles.pack')) as pack:
+            for bundle in self.bundles:
+                pack.put(*bundle)
+            self._assert_source(PackBundleSource(pack))
+
+    def test_dss(self):
+        client = LocalDSSClient(self.bundles)
+        for num_workers in (0, 3):
+            with self.subTest(num_workers=num_workers):
+                self._assert_source(DSSBundleSource(client, 'aws', num_workers=num_workers))
@@ -0,0 +1,84 @@
+from collections import Counter
+import copy
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    CellSuspension,
+    DonorOrganism,
+    SpecimenFromOrganism,
+)
+from humancellatlas.data.metadata.helpers.summary import FacetSummary
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    SyntheticCorpus,
+)
+
+import canning
+
+
+class TestFacetSummary(TestCase):
+
+    def setUp(self):
+        self.bundles = [Bundle(*bundle) for bundle in canning.canned_bundles()]
+        self.bundles.extend(Bundle(*bundle) for bundle in SyntheticCorpus(6, BundleShape(donors=2), seed=2))
+
+    def _entities(self, bundles):
+        entities = {}
+        for bundle in bundles:
+            for entity in bundle.entities.values():
+                entities[entity.document_id] = entity
+        return entities
+
+    def test_counts(self):
+        summary = FacetSummary()
+        summary.update(self.bundles)
+        entities = self._entities(self.bundles).values()
+        self.assertEqual(Counter(s.organ for s in entities if isinstance(s, SpecimenFromOrganism) and s.organ),
+                         summary.counts('organ'))
+        self.assertEqual(Counter(gs for d in entities if isinstance(d, DonorOrganism) for gs in d.genus_species),
+                         summary.counts('genus_species'))
+        self.assertEqual(sum(cs.estimated_cell_count or 0 for cs in entities if isinstance(cs, CellSuspension)),
+                         summary.estimated_cell_count)
+        self.assertGreater(summary.estimated_cell_count, 0)
+        self.assertIn('fastq.gz', summary.counts('file_format'))
+        self.assertTrue(summary.counts('library_construction_method'))
+        self.assertEqual({}, summary.counts('foo'))
+        # Adding bundles again does not change the summary
+        json = summary.to_json()
+        summary.update(self.bundles)
+        self.assertEqual(json, summary.to_json())
+
+    def test_merge(self):
+        shards = [FacetSummary() for _ in range(3)]
+        for i, bundle in enumerate(self.bundles):
+            shards[i % 3].add(bundle)
+            shards[(i + 1) % 3].add(bundle)
+        summary = FacetSummary()
+        for shard in shards:
+            summary.merge(FacetSummary.from_bytes(shard.to_bytes()))
+        expected = FacetSummary()
+        expected.update(self.bundles)
+        self.assertEqual(expected, summary)
+        self.assertEqual(expected.to_json(), summary.to_json())
+        self.assertLess(len(summary.to_bytes()), 64 * len(summary))
+
+    def test_newer_document(self):
+        uuid, version, manifest, metadata_files = next(iter(SyntheticCorpus(1, BundleShape(donors=1), seed=3)))
+        summary = FacetSummary()
+        summary.add(Bundle(uuid, version, manifest, metadata_files))
+        metadata_files = copy.deepcopy(metadata_files)
+        for file_name, json in metadata_files.items():
+            if file_name.startswith('specimen_from_organism_'):
+                organ = json['organ']['ontology_label']
+                json['organ']['text'] = json['organ']['ontology_label'] = 'spleen'
+                json['provenance']['update_date'] += 'x'
+        newer = FacetSummary()
+        newer.add(Bundle(uuid, version, manifest, metadata_files))
+        old = FacetSummary.from_bytes(summary.to_bytes())
+        summary.merge(newer)
+        self.assertEqual({'spleen': 1}, summary.counts('organ'))
+        newer.merge(old)
+        self.assertEqual({'spleen': 1}, newer.counts('organ'))
+        old.merge(FacetSummary())
+        self.assertEqual({organ: 1}, old.counts('organ'))
@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+from humancellatlas.data.metadata.api import (
+    Bundle,
+    CellSuspension,
+    DonorOrganism,
+    SequenceFile,
+)
+from humancellatlas.data.metadata.helpers.dss import download_bundle_metadata
+from humancellatlas.data.metadata.helpers.synthetic import (
+    BundleShape,
+    LocalDSSClient,
+    SyntheticCorpus,
+    synthetic_bundle,
+)
+
+
+class TestSynthetic(TestCase):
+    shapes = [
+        BundleShape(),
+        BundleShape(donors=3, specimens=2, suspensions=3, files=5, protocols=2, fan_out=3, chain_depth=3),
+        BundleShape(donors=2, specimens=4, fan_out=4, chain_depth=2)
+    ]
+
+    def test_shapes(self):
+        for shape in self.shapes:
+            for layout in ('v5', 'vx'):
+                with self.subTest(shape=shape, layout=layout):
+                    bundle = Bundle(*synthetic_bundle(shape, layout, seed=1))
+                    self.assertEqual(shape.num_entities, len(bundle.entities))
+                    num_files = shape.donors * shape.specimens * shape.suspensions * shape.files
+                    self.assertEqual(num_files, len(bundle.sequencing_output))
+                    self.assertEqual(num_files, sum(isinstance(f, SequenceFile) for f in bundle.files.values()))
+                    self.assertEqual(shape.donors * shape.specimens, len(bundle.specimens))
+                    num_suspensions = shape.donors * shape.specimens * shape.suspensions * shape.chain_depth
+                    self.assertEqual(num_suspensions, sum(isinstance(b, CellSuspension)
+                                                          for b in bundle.biomaterials.values()))
+                    roots = bundle.root_entities().values()
+                    self.assertEqual(shape.donors, len(roots))
+                    self.assertTrue(all(isinstance(root, DonorOrganism) for root in roots))
+                    for process in bundle.processes.values():
+                        self.assertLessEqual(len(process.output_biomaterials) + len(process.output_files),
+                                             shape.fan_out)
+                    num_protocol_types = len({type(p) for p in bundle.protocols.values()})
+                    self.assertEqual(4 if shape.chain_depth == 1 else 5, num_protocol_types)
+                    self.assertEqual(num_protocol_types * shape.protocols, len(bundle.protocols))
+
+    def test_reproducible(self):
+        shape = self.shapes[1]
+        for layout in ('v5', 'vx'):
+            with self.subTest(layout=layout):
+                self.assertEqual(synthetic_bundle(shape, layout, seed=1), synthetic_bundle(shape, layout, seed=1))
+                self.assertNotEqual(synthetic_bundle(shape, layout, seed=1), synthetic_bundle(shape, layout, seed=2))
+        corpus = SyntheticCorpus(5, shape, seed='foo')
+        bundles = list(corpus)
+        self.assertEqual(bundles, list(SyntheticCorpus(5, shape, seed='foo')))
+        self.assertEqual(5, len({uuid for uuid, _, _, _ in bundles}))
+        self.assertEqual(bundles[3], corpus.bundle(3))
+        self.assertRaises(IndexError, corpus.bundle, 5)
+
+    def test_local_dss_client(self):
+        corpus = SyntheticCorpus(4, self.shapes[1], layout='v5', seed=3)
+        client = LocalDSSClient(corpus, page_size=7)
+        for uuid, version, manifest, metadata_files in corpus:
+            for num_workers in (0, 2):
+                result = download_bundle_metadata(client, 'aws', uuid, version, num_workers=num_workers)
+                self.assertEqual((version, manifest, metadata_files), result)
+        uuid, version, manifest, metadata_files = corpus.bundle(0)
+        client.add(uuid, '2020-01-01T000000.000000Z', manifest, metadata_files)
+        self.assertEqual('2020-01-01T000000.000000Z', download_bundle_metadata(client, 'aws', uuid)[0])
+        fqids = [hit['bundle_fqid'] for hit in client.post_search.iterate(es_query={}, replica='aws')]
+        self.assertEqual(5, len(fqids))
+        from hca.util.exceptions import SwaggerAPIException
+        with self.assertRaises(SwaggerAPIException) as cm:
+            download_bundle_metadata(client, 'aws', uuid, '2021-01-01T000000.000000Z')
+        self.assertEqual(404, cm.exception.code)